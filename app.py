@@ -1,9 +1,12 @@
 import os
+import time
 os.environ['KMP_DUPLICATE_LIB_OK'] = 'TRUE'
+_startup_started = time.perf_counter()
 
 from flask import Flask, redirect, url_for, send_from_directory, jsonify
 from flask_login import login_required, current_user
-from services import get_collection
+from werkzeug.serving import is_running_from_reloader
+from services import get_collection, recover_collections
 from diary_blueprint import diary_bp
 
 from extensions import db, login_manager
@@ -14,9 +17,17 @@ from chat_blueprint import chat_bp, general_chat_bp, diary_chat_bp
 from model_download import model_download_bp
 from model_downloader import model_downloader_bp
 from upload_blueprint import upload_bp
+from metrics_blueprint import metrics_bp
+from job_queue import init_job_queue
+from model_registry import report_startup
 
 
-def create_app():
+def create_app(start_workers=True):
+    """Create the app.
+
+    start_workers=False skips crash recovery and the ingestion workers, for
+    a process that will not serve requests itself (the reloader's parent).
+    """
     app = Flask(__name__, static_folder='static')
     
     app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-change-this-in-production')
@@ -40,6 +51,7 @@ def create_app():
     app.register_blueprint(model_download_bp)
     app.register_blueprint(model_downloader_bp)
     app.register_blueprint(diary_bp)
+    app.register_blueprint(metrics_bp)
 
 
     
@@ -48,6 +60,14 @@ def create_app():
     with app.app_context():
         db.create_all()
     
+    if start_workers:
+        # Finish or undo collection writes interrupted by a crash before any
+        # worker touches the collections again
+        recover_collections()
+        
+        # Start the background workers for memory ingestion
+        init_job_queue(app)
+    
     @app.route('/')
     def index():
         from flask_login import current_user
@@ -171,10 +191,15 @@ def create_app():
     def serve_static(path):
         return send_from_directory('static', path)
     
+    report_startup(_startup_started)
     return app
 
 if __name__ == '__main__':
-    app = create_app()
+    # With the reloader this module runs twice: in a watcher process that
+    # only restarts the server, and in the child that serves. Only the
+    # child should run jobs, or the watcher's copy would run stale code
+    # alongside it.
+    app = create_app(start_workers=is_running_from_reloader())
     app.run(debug=True, port=5000)
 
 
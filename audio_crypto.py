@@ -0,0 +1,185 @@
+"""
+Chunked authenticated encryption for stored audio files.
+
+A file is a short header followed by fixed-size plaintext chunks, each
+sealed separately with AES-256-GCM, so any byte range can be decrypted by
+reading only the chunks that cover it. This is what lets playback serve HTTP
+Range requests straight from the encrypted file.
+
+    header:  MAGIC (8) | chunk size (4, big-endian) | nonce prefix (8)
+    chunk i: ciphertext of up to chunk-size bytes | GCM tag (16)
+
+Chunk i uses the nonce prefix followed by i as its nonce, and is
+authenticated together with the header, i and a flag marking the last chunk,
+so chunks cannot be reordered, dropped or truncated without failing to
+decrypt. The plaintext size follows from the file size, so files can be
+encrypted in one pass from a stream of unknown length.
+
+Per-user keys are derived with HKDF from a master key of its own,
+AUDIO_ENCRYPTION_KEY, so rotating the session SECRET_KEY leaves recordings
+readable. Only the audio routes read it, through load_encryption_key, so the
+rest of the app runs without one; every call here takes it explicitly, so
+the key never depends on whether a Flask context happens to exist. Recordings written before the key was split out
+were derived from SECRET_KEY; set AUDIO_ENCRYPTION_KEY to that value to keep
+reading them. Files written by the older whole-file scheme in utils are
+still readable through decrypt_file; cryptography is imported on first use.
+"""
+import os
+import struct
+from functools import lru_cache
+
+MAGIC = b"MEMAUD\x01\x00"
+CHUNK_SIZE = int(os.environ.get('AUDIO_CRYPTO_CHUNK_BYTES', 64 * 1024))
+TAG_SIZE = 16
+NONCE_PREFIX_SIZE = 8
+HEADER_SIZE = len(MAGIC) + 4 + NONCE_PREFIX_SIZE
+
+# The example value config files ship with, never accepted as a real key
+PLACEHOLDER_KEY = 'your-secret-key-change-this-in-production'
+
+def load_encryption_key():
+    """Read the master key for stored audio from AUDIO_ENCRYPTION_KEY.
+
+    Raises RuntimeError if it is unset or still the placeholder, so audio is
+    refused rather than encrypted under a guessable key.
+    """
+    key = os.environ.get('AUDIO_ENCRYPTION_KEY', '')
+    if not key or key == PLACEHOLDER_KEY:
+        raise RuntimeError("AUDIO_ENCRYPTION_KEY must be set to a secret value to store or play audio recordings")
+    return key
+
+@lru_cache(maxsize=256)
+def _derive_key(secret, user_id):
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    if isinstance(secret, str):
+        secret = secret.encode()
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=f"audio-file:{user_id}".encode())
+    return hkdf.derive(secret)
+
+def _get_cipher(user_id, key):
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    return AESGCM(_derive_key(key, str(user_id)))
+
+def _chunk_aad(header, index, final):
+    return header + struct.pack(">I?", index, final)
+
+def _parse_header(header):
+    if len(header) != HEADER_SIZE or not header.startswith(MAGIC):
+        raise ValueError("Not a chunked encrypted audio file")
+    chunk_size = struct.unpack(">I", header[len(MAGIC):len(MAGIC) + 4])[0]
+    return chunk_size, header[len(MAGIC) + 4:]
+
+def is_chunked_file(path):
+    """Check whether a file was written by this module"""
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+def encrypt_stream(reader, writer, user_id, key, chunk_size=None):
+    """Encrypt everything read from reader into writer in a single pass.
+
+    reader only needs a read(size) method, so this works on upload streams
+    as well as files. Returns the number of plaintext bytes encrypted.
+    """
+    chunk_size = chunk_size or CHUNK_SIZE
+    cipher = _get_cipher(user_id, key)
+    nonce_prefix = os.urandom(NONCE_PREFIX_SIZE)
+    header = MAGIC + struct.pack(">I", chunk_size) + nonce_prefix
+    writer.write(header)
+
+    def read_chunk():
+        # Fill a whole chunk even when the reader returns short reads
+        parts = []
+        remaining = chunk_size
+        while remaining:
+            data = reader.read(remaining)
+            if not data:
+                break
+            parts.append(data)
+            remaining -= len(data)
+        return b"".join(parts)
+
+    # Read one chunk ahead to know which chunk is the last; an empty input
+    # still gets one (empty) final chunk
+    index = 0
+    total = 0
+    chunk = read_chunk()
+    while True:
+        next_chunk = read_chunk() if len(chunk) == chunk_size else b""
+        final = not next_chunk
+        nonce = nonce_prefix + struct.pack(">I", index)
+        writer.write(cipher.encrypt(nonce, chunk, _chunk_aad(header, index, final)))
+        total += len(chunk)
+        if final:
+            return total
+        chunk = next_chunk
+        index += 1
+
+def encrypt_file(src_path, dst_path, user_id, key):
+    """Encrypt src_path into dst_path, returning the plaintext size"""
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        return encrypt_stream(src, dst, user_id, key)
+
+def encrypt_file_in_place(path, user_id, key):
+    """Replace a plaintext file with its encrypted form"""
+    tmp_path = f"{path}.enc-tmp"
+    try:
+        encrypt_file(path, tmp_path, user_id, key)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _get_layout(f, file_size):
+    """Read the header and work out (header, chunk_size, chunk_count, plaintext_size)"""
+    f.seek(0)
+    header = f.read(HEADER_SIZE)
+    chunk_size, _ = _parse_header(header)
+    body = file_size - HEADER_SIZE
+    sealed = chunk_size + TAG_SIZE
+    chunk_count = max(1, -(-body // sealed))
+    plaintext_size = body - chunk_count * TAG_SIZE
+    if plaintext_size < 0:
+        raise ValueError("Encrypted audio file is truncated")
+    return header, chunk_size, chunk_count, plaintext_size
+
+def get_plaintext_size(path):
+    """Size of the decrypted content of a chunked file"""
+    with open(path, 'rb') as f:
+        return _get_layout(f, os.fstat(f.fileno()).st_size)[3]
+
+def iter_decrypted(path, user_id, key, start=0, end=None):
+    """Yield the decrypted bytes [start, end) of a chunked file.
+
+    Only the chunks overlapping the range are read and decrypted. Raises
+    cryptography's InvalidTag if any of them has been tampered with.
+    """
+    cipher = _get_cipher(user_id, key)
+    with open(path, 'rb') as f:
+        header, chunk_size, chunk_count, plaintext_size = _get_layout(f, os.fstat(f.fileno()).st_size)
+        nonce_prefix = _parse_header(header)[1]
+        end = plaintext_size if end is None else min(end, plaintext_size)
+        if start >= end:
+            return
+
+        first = start // chunk_size
+        last = (end - 1) // chunk_size
+        f.seek(HEADER_SIZE + first * (chunk_size + TAG_SIZE))
+        for index in range(first, last + 1):
+            sealed = f.read(chunk_size + TAG_SIZE)
+            nonce = nonce_prefix + struct.pack(">I", index)
+            chunk = cipher.decrypt(nonce, sealed, _chunk_aad(header, index, index == chunk_count - 1))
+            chunk_start = index * chunk_size
+            yield chunk[max(start - chunk_start, 0):end - chunk_start]
+
+def decrypt_file(src_path, dst_path, user_id, key):
+    """Decrypt a stored audio file to dst_path, whichever scheme wrote it"""
+    if not is_chunked_file(src_path):
+        from utils import decrypt_file as decrypt_legacy_file
+        return decrypt_legacy_file(src_path, dst_path, user_id)
+    with open(dst_path, 'wb') as dst:
+        for data in iter_decrypted(src_path, user_id, key):
+            dst.write(data)
@@ -0,0 +1,134 @@
+"""
+Benchmark the approximate collection indexes against the exact flat index.
+
+Builds each index type from index_policy on the same unit-length vectors and
+reports build time, search latency, estimated memory and recall@k, the share
+of the flat index's true top k that the approximate index also returns.
+Searches go through index_policy.IndexSearcher like query_collection, so
+IVF-PQ results are re-ranked exactly from the vectors.
+
+It then deletes --delete-fraction of the vectors the way delete_memory does:
+remove_ids for flat and IVF-PQ, tombstones for HNSW. It reports the delete
+time and recall@k against the flat index after the deletes.
+
+By default the vectors are synthetic: a mixture of Gaussian clusters on the
+unit sphere, which is closer to real text embeddings than uniform noise.
+--collection reads the embedding store of a real collection directory
+instead. Queries are perturbed copies of random stored vectors.
+
+Usage: python benchmarks/bench_ann_index.py [--vectors 100000] [--queries 500] [--k 10]
+                                            [--delete-fraction 0.1]
+                                            [--collection collections/user_1/<id>]
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import faiss
+import index_policy
+from embedding_store import load_embeddings
+
+DIMENSION = 768
+
+def synthetic_vectors(count, clusters, rng):
+    """Unit vectors drawn around random cluster centres"""
+    centres = rng.standard_normal((clusters, DIMENSION)).astype('float32')
+    faiss.normalize_L2(centres)
+    vectors = np.empty((count, DIMENSION), dtype='float32')
+    block = 50000
+    for start in range(0, count, block):
+        stop = min(count, start + block)
+        assignment = rng.integers(0, clusters, stop - start)
+        noise = rng.standard_normal((stop - start, DIMENSION)).astype('float32') * 0.04
+        vectors[start:stop] = centres[assignment] + noise
+    faiss.normalize_L2(vectors)
+    return vectors
+
+def make_queries(vectors, count, rng):
+    rows = rng.choice(len(vectors), count, replace=False)
+    queries = vectors[rows] + rng.standard_normal((count, DIMENSION)).astype('float32') * 0.02
+    faiss.normalize_L2(queries)
+    return queries
+
+def search_one_by_one(searcher, queries, k):
+    """Search like query_collection does, one query per call"""
+    ids = np.empty((len(queries), k), dtype='int64')
+    started = time.perf_counter()
+    for i in range(len(queries)):
+        ids[i] = searcher.search(queries[i:i + 1], k)[1][0]
+    return ids, (time.perf_counter() - started) / len(queries)
+
+def delete_vectors(index, deleted_ids):
+    """Delete like delete_memory does; returns the searcher's tombstones"""
+    if index_policy.supports_remove(index):
+        index.remove_ids(faiss.IDSelectorBatch(deleted_ids))
+        return None
+    return deleted_ids
+
+def recall_at_k(found, truth):
+    hits = sum(len(np.intersect1d(row, expected)) for row, expected in zip(found, truth))
+    return hits / truth.size
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--vectors', type=int, default=100000)
+    parser.add_argument('--clusters', type=int, default=1000)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--delete-fraction', type=float, default=0.1)
+    parser.add_argument('--collection', help="collection directory to read embeddings from")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    if args.collection:
+        matrix, _, _ = load_embeddings(args.collection, DIMENSION)
+        vectors = np.array(matrix, dtype='float32')
+        faiss.normalize_L2(vectors)
+        source = args.collection
+    else:
+        vectors = synthetic_vectors(args.vectors, args.clusters, rng)
+        source = f"{args.clusters} synthetic clusters"
+    vector_ids = np.arange(len(vectors), dtype='int64')
+    queries = make_queries(vectors, min(args.queries, len(vectors)), rng)
+    print(f"{len(vectors)} vectors from {source}, {len(queries)} queries, k={args.k}, "
+          f"policy 'auto' picks {index_policy.choose_index_type(len(vectors))}")
+
+    deleted_ids = np.sort(rng.choice(vector_ids, int(len(vector_ids) * args.delete_fraction), replace=False))
+    live = ~np.isin(vector_ids, deleted_ids)
+
+    truth = truth_after_delete = None
+    for index_type in ("flat", "hnsw", "ivfpq"):
+        if index_type == "ivfpq" and len(vectors) < index_policy.IVFPQ_MIN_TRAIN_VECTORS:
+            print(f"{index_type:<6} skipped, needs {index_policy.IVFPQ_MIN_TRAIN_VECTORS} vectors")
+            continue
+        started = time.perf_counter()
+        index = index_policy.build_index(index_type, DIMENSION, vectors, vector_ids)
+        build_seconds = time.perf_counter() - started
+
+        searcher = index_policy.IndexSearcher(index, vectors=vectors, vector_ids=vector_ids)
+        found, seconds_per_query = search_one_by_one(searcher, queries, args.k)
+        if truth is None:
+            truth = found
+        print(f"{index_type:<6} build {build_seconds:7.1f}s   {seconds_per_query * 1000:7.3f} ms/query   "
+              f"{searcher.nbytes() / 1e6:8.1f} MB   "
+              f"recall@{args.k} {recall_at_k(found, truth):.3f}")
+
+        if not len(deleted_ids):
+            continue
+        started = time.perf_counter()
+        tombstones = delete_vectors(index, deleted_ids)
+        delete_seconds = time.perf_counter() - started
+        searcher = index_policy.IndexSearcher(index, tombstones, vectors[live], vector_ids[live])
+        found, seconds_per_query = search_one_by_one(searcher, queries, args.k)
+        if truth_after_delete is None:
+            truth_after_delete = found
+        print(f"{'':<6} delete {len(deleted_ids)} {delete_seconds:7.3f}s   {seconds_per_query * 1000:7.3f} ms/query   "
+              f"recall@{args.k} {recall_at_k(found, truth_after_delete):.3f}   "
+              f"deleted ids returned {np.isin(found, deleted_ids).sum()}")
+
+if __name__ == '__main__':
+    main()
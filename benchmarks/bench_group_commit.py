@@ -0,0 +1,113 @@
+"""
+Benchmark committing many memories to one collection from concurrent workers.
+
+"single" commits every memory on its own (one index rewrite and one metadata
+transaction each), as ingestion did before group commit; "group" goes through
+collection_writer, which coalesces the commits that overlap. Embeddings are
+random, so neither Ollama nor any extraction is involved; --existing sets how
+many vectors the collection already holds, since that is what every index
+rewrite has to write out again.
+
+Usage: python benchmarks/bench_group_commit.py [--memories 200] [--workers 8] [--existing 20000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import services
+import collection_writer
+
+USER_ID = 1
+
+def make_item(user_id, collection_id, rng, chunks=3):
+    """A processed memory ready to commit, with its upload saved"""
+    memory_id = str(uuid.uuid4())
+    filename = f"{memory_id}.pdf"
+    with open(os.path.join(services.get_collection_documents_path(user_id, collection_id), filename), 'wb') as f:
+        f.write(b"%PDF-1.4\n")
+    metadata = {
+        "id": memory_id,
+        "title": memory_id[:8],
+        "description": "",
+        "type": "pdf",
+        "filename": filename,
+        "original_filename": "document.pdf",
+        "created_at": "2024-01-01T00:00:00",
+        "chunks": [[i * 1000, (i + 1) * 1000] for i in range(chunks)],
+    }
+    vectors = rng.standard_normal((chunks, services.EMBEDDING_DIMENSION)).astype('float32')
+    return metadata, "x" * 1000 * chunks, vectors, None
+
+def seed_collection(existing, rng):
+    """Create a collection already holding about existing vectors"""
+    collection_id, _ = services.create_collection(USER_ID, "bench")
+    items = [make_item(USER_ID, collection_id, rng, chunks=10) for _ in range(existing // 10)]
+    if items:
+        services.commit_memories(USER_ID, collection_id, items)
+    return collection_id
+
+def run(mode, collection_id, items, workers):
+    queue = list(items)
+    lock = threading.Lock()
+    errors = []
+
+    def worker():
+        while True:
+            with lock:
+                if not queue:
+                    return
+                item = queue.pop()
+            if mode == "group":
+                _, error = services.commit_memory(USER_ID, collection_id, *item)
+            else:
+                _, error = services.commit_memories(USER_ID, collection_id, [item])[0]
+            if error:
+                errors.append(error)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors[:3]
+    return time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--memories', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--existing', type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        services.COLLECTIONS_DIR = temp_dir
+        services.COLLECTION_DB = os.path.join(temp_dir, 'collections.db')
+        rng = np.random.default_rng(0)
+        print(f"{args.memories} memories from {args.workers} workers into a collection "
+              f"with {args.existing} vectors")
+
+        results = {}
+        for mode in ("single", "group"):
+            collection_id = seed_collection(args.existing, rng)
+            items = [make_item(USER_ID, collection_id, rng) for _ in range(args.memories)]
+            before = collection_writer.get_writer_stats()["batches"]
+            seconds = run(mode, collection_id, items, args.workers)
+            commits = collection_writer.get_writer_stats()["batches"] - before if mode == "group" else len(items)
+
+            index = services.faiss.read_index(services.get_collection_index_path(USER_ID, collection_id))
+            assert index.ntotal == args.existing // 10 * 10 + 3 * args.memories
+            results[mode] = seconds
+            print(f"{mode:<7} {seconds:7.2f}s   {args.memories / seconds:7.1f} memories/s   {commits} index writes")
+
+        print(f"group commit: {results['single'] / results['group']:.1f}x faster")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Benchmark speaker-embedding extraction for the diarization pipeline.
+
+Builds a synthetic multi-speaker recording (speakers differ in pitch and
+formants, taking turns of 1-8 seconds), segments it by turn and compares
+upload_blueprint.get_speaker_embeddings against the previous per-window
+embed_utterance loop, checking that both produce the same embeddings.
+
+Usage: python benchmarks/bench_speaker_embeddings.py [--minutes 30] [--speakers 4]
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import model_registry
+from upload_blueprint import AUDIO_SAMPLE_RATE, DIARIZATION_CONFIG, get_speaker_embeddings
+
+def make_conversation(minutes, speakers, sample_rate=AUDIO_SAMPLE_RATE, seed=0):
+    """Synthesise turns of voiced audio from a few distinct synthetic speakers"""
+    rng = np.random.default_rng(seed)
+    voices = [(rng.uniform(85, 260), rng.uniform(500, 900), rng.uniform(1200, 2400)) for _ in range(speakers)]
+    total = int(minutes * 60 * sample_rate)
+    audio = np.zeros(total, dtype=np.float32)
+    segments = []
+
+    position = 0
+    while position < total:
+        speaker = int(rng.integers(speakers))
+        pitch, formant1, formant2 = voices[speaker]
+        length = min(int(rng.uniform(1.0, 8.0) * sample_rate), total - position)
+        t = np.arange(length) / sample_rate
+        harmonics = np.arange(1, 30)
+        gains = np.exp(-((harmonics * pitch - formant1) / 200) ** 2) + 0.5 * np.exp(-((harmonics * pitch - formant2) / 300) ** 2)
+        voiced = np.sin(2 * np.pi * pitch * np.outer(t, harmonics)) @ gains
+        envelope = 0.6 + 0.4 * np.sin(2 * np.pi * rng.uniform(3, 5) * t)
+        audio[position:position + length] = 0.1 * voiced * envelope / max(gains.sum(), 1e-6)
+        segments.append({"audio": audio[position:position + length], "speaker": speaker})
+        position += length + int(0.3 * sample_rate)
+
+    return segments
+
+def legacy_speaker_embeddings(audio_segments, sr=AUDIO_SAMPLE_RATE):
+    """The per-window implementation get_speaker_embeddings replaced"""
+    from resemblyzer import preprocess_wav
+    voice_encoder = model_registry.get_voice_encoder()
+    frame_length = int(DIARIZATION_CONFIG["embedding_frame_length"] * sr)
+    embeddings = []
+    for segment in audio_segments:
+        audio_data = segment["audio"]
+        if len(audio_data) < frame_length:
+            embeddings.append(voice_encoder.embed_utterance(preprocess_wav(audio_data, source_sr=sr)))
+            continue
+        windows = [
+            voice_encoder.embed_utterance(preprocess_wav(audio_data[i:i + frame_length], source_sr=sr))
+            for i in range(0, len(audio_data) - frame_length + 1, frame_length // 2)
+        ]
+        embeddings.append(np.mean(windows, axis=0))
+    return np.array(embeddings)
+
+def timed(label, fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<24} {elapsed:8.2f}s")
+    return result, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--minutes', type=float, default=30)
+    parser.add_argument('--speakers', type=int, default=4)
+    args = parser.parse_args()
+
+    segments = make_conversation(args.minutes, args.speakers)
+    print(f"{args.minutes:g} min, {args.speakers} speakers, {len(segments)} segments")
+    model_registry.get_voice_encoder()  # load outside the timings
+
+    legacy, legacy_time = timed("per-window loop", legacy_speaker_embeddings, segments)
+    batched, batched_time = timed("batched", get_speaker_embeddings, segments)
+
+    cosine = np.sum(legacy * batched, axis=1) / (np.linalg.norm(legacy, axis=1) * np.linalg.norm(batched, axis=1))
+    print(f"max abs difference: {np.abs(legacy - batched).max():.2e}, min cosine similarity: {cosine.min():.6f}")
+    print(f"speedup: {legacy_time / batched_time:.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Benchmark the storage side of /upload: getting from a saved upload to a
+decoded buffer ready for diarization, with the stored copy encrypted.
+
+The previous route encrypted the saved file in place, decrypted it straight
+back into temp/ and decoded that copy (three full-file writes, two crypto
+passes) before transcription could start. The current route decodes the
+saved file and encrypts it in the background while the buffer is being
+transcribed. --transcribe-seconds stands in for the transcription time the
+background encryption overlaps with.
+
+Usage: python benchmarks/bench_upload.py [--minutes 30] [--transcribe-seconds 0]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import wave
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import audio_crypto
+from upload_blueprint import _get_encrypt_executor, load_audio
+
+USER_ID = 1
+
+def write_recording(path, minutes, sample_rate=44100, seed=0):
+    """Write a stereo 16-bit WAV like a typical browser upload"""
+    rng = np.random.default_rng(seed)
+    frames = int(minutes * 60 * sample_rate)
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        block = sample_rate * 10
+        for start in range(0, frames, block):
+            samples = rng.normal(0, 3000, (min(block, frames - start), 2)).astype(np.int16)
+            wav.writeframes(samples.tobytes())
+
+def legacy_upload(path, temp_dir, transcribe_seconds):
+    """encrypt in place -> decrypt to temp -> decode -> transcribe"""
+    started = time.perf_counter()
+    audio_crypto.encrypt_file_in_place(path, USER_ID)
+    temp_path = os.path.join(temp_dir, "decrypted.wav")
+    audio_crypto.decrypt_file(path, temp_path, USER_ID)
+    audio = load_audio(temp_path)
+    ready = time.perf_counter() - started
+    time.sleep(transcribe_seconds)
+    os.remove(temp_path)
+    return audio, ready, time.perf_counter() - started
+
+def current_upload(path, transcribe_seconds):
+    """decode -> transcribe while the stored copy is encrypted"""
+    started = time.perf_counter()
+    audio = load_audio(path)
+    ready = time.perf_counter() - started
+    encryption = _get_encrypt_executor().submit(audio_crypto.encrypt_file_in_place, path, USER_ID)
+    time.sleep(transcribe_seconds)
+    encryption.result()
+    return audio, ready, time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--minutes', type=float, default=30)
+    parser.add_argument('--transcribe-seconds', type=float, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source = os.path.join(temp_dir, "source.wav")
+        write_recording(source, args.minutes)
+        size_mb = os.path.getsize(source) / 1e6
+        print(f"{args.minutes:g} min upload, {size_mb:.0f} MB")
+
+        results = {}
+        for label in ("legacy", "current"):
+            path = os.path.join(temp_dir, f"{label}.wav")
+            with open(source, 'rb') as src, open(path, 'wb') as dst:
+                dst.write(src.read())
+            if label == "legacy":
+                results[label] = legacy_upload(path, temp_dir, args.transcribe_seconds)
+            else:
+                results[label] = current_upload(path, args.transcribe_seconds)
+            _, ready, total = results[label]
+            assert audio_crypto.is_chunked_file(path)
+            print(f"{label:<8} buffer ready {ready:7.2f}s   done {total:7.2f}s")
+
+        assert np.array_equal(results["legacy"][0], results["current"][0])
+        legacy_ready, current_ready = results["legacy"][1], results["current"][1]
+        print(f"time to transcription start: {legacy_ready / current_ready:.1f}x faster, "
+              f"{legacy_ready - current_ready:.2f}s saved per upload")
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,15 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, Response, stream_with_context
 from flask_login import login_required, current_user
 from models import Chat, ChatMessage
-from services import get_collection
+from services import get_collection, get_collection_memory
 from chat_services import (
     create_chat_session, create_memory_chat_session,
     get_chat_sessions, get_chat_messages, 
     process_chat_query, process_memory_chat_query,
     delete_chat_session, create_diary_chat_session, get_diary_chat_sessions, process_diary_chat_query, 
+    stream_chat_query, stream_diary_chat_query,
 )
+import json
 
 from diary_services import get_diary_with_entries
 
@@ -19,6 +21,26 @@ diary_chat_bp = Blueprint('diary_chat', __name__, url_prefix='/api/diaries')
 general_chat_bp = Blueprint('general_chat', __name__, url_prefix='/api')
 
 
+def sse_response(events):
+    """Send (event, data) pairs to the client as Server-Sent Events"""
+    def generate():
+        try:
+            for event, data in events:
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        except Exception as e:
+            print(f"Error while streaming response: {str(e)}")
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+
 @general_chat_bp.route('/recent-chats', methods=['GET'])
 @login_required
 def get_recent_chats():
@@ -52,11 +74,10 @@ def get_recent_chats():
                 }
                 
                 # Get memory name if applicable
-                if chat.memory_id and collection and 'memories' in collection:
-                    for memory in collection.get('memories', []):
-                        if memory.get('id') == chat.memory_id:
-                            chat_data["memory_name"] = memory.get('title', 'Unknown Memory')
-                            break
+                if chat.memory_id and collection:
+                    memory = get_collection_memory(current_user.id, chat.collection_id, chat.memory_id)
+                    if memory:
+                        chat_data["memory_name"] = memory.get('title', 'Unknown Memory')
                 
                 formatted_chats.append(chat_data)
             except Exception as chat_error:
@@ -205,6 +226,21 @@ def process_query(collection_id, chat_id):
         "relevant_memories": result["relevant_memories"]
     })
 
+@chat_bp.route('/<collection_id>/chat/<chat_id>/query/stream', methods=['POST'])
+@login_required
+def stream_query(collection_id, chat_id):
+    data = request.json
+    query = data.get('query', '')
+    
+    if not query:
+        return jsonify({"success": False, "error": "Query is required"}), 400
+    
+    events, error = stream_chat_query(chat_id, current_user.id, query)
+    if error:
+        return jsonify({"success": False, "error": error}), 500
+    
+    return sse_response(events)
+
 @chat_bp.route('/<collection_id>/chat/<chat_id>', methods=['DELETE'])
 @login_required
 def delete_chat(collection_id, chat_id):
@@ -290,6 +326,32 @@ def process_memory_query(collection_id, memory_id, chat_id):
         "relevant_memories": result["relevant_memories"]
     })
 
+@chat_bp.route('/<collection_id>/memory/<memory_id>/chat/<chat_id>/query/stream', methods=['POST'])
+@login_required
+def stream_memory_query(collection_id, memory_id, chat_id):
+    data = request.json
+    query = data.get('query', '')
+    
+    if not query:
+        return jsonify({"success": False, "error": "Query is required"}), 400
+    
+    # Verify this chat belongs to this memory
+    chat = Chat.query.filter_by(
+        id=chat_id,
+        user_id=current_user.id,
+        collection_id=collection_id,
+        memory_id=memory_id
+    ).first()
+    
+    if not chat:
+        return jsonify({"success": False, "error": "Chat not found for this memory"}), 404
+    
+    events, error = stream_chat_query(chat_id, current_user.id, query)
+    if error:
+        return jsonify({"success": False, "error": error}), 500
+    
+    return sse_response(events)
+
 @diary_chat_bp.route('/<int:diary_id>/chat', methods=['POST'])
 @login_required
 def create_diary_chat(diary_id):
@@ -378,3 +440,28 @@ def process_diary_query(diary_id, chat_id):
         "response": result["response"],
         "relevant_entries": result["relevant_entries"]
     })
+
+@diary_chat_bp.route('/<int:diary_id>/chat/<int:chat_id>/query/stream', methods=['POST'])
+@login_required
+def stream_diary_query(diary_id, chat_id):
+    data = request.json
+    query = data.get('query', '')
+    
+    if not query:
+        return jsonify({"success": False, "error": "Query is required"}), 400
+    
+    # Verify this chat belongs to this diary
+    chat = Chat.query.filter_by(
+        id=chat_id,
+        user_id=current_user.id,
+        diary_id=diary_id
+    ).first()
+    
+    if not chat:
+        return jsonify({"success": False, "error": "Chat not found for this diary"}), 404
+    
+    events, error = stream_diary_chat_query(chat_id, current_user.id, query)
+    if error:
+        return jsonify({"success": False, "error": error}), 500
+    
+    return sse_response(events)
@@ -1,10 +1,9 @@
 from models import Chat, ChatMessage
 from extensions import db
-from services import query_collection, get_collection, generate_response, get_collection_documents_path ,query_specific_memory
+from services import query_collection, get_collection, get_collection_memory, generate_response, get_collection_documents_path ,query_specific_memory, generate_response_stream, stream_llm_response
 from diary_services import get_diary, get_diary_with_entries  # Add get_diary_with_entries
 from datetime import datetime
 import ollama
-import numpy as np
 import os
 
 def query_specific_memory(user_id, collection_id, memory_id, query_text):
@@ -13,23 +12,12 @@ def query_specific_memory(user_id, collection_id, memory_id, query_text):
     if not collection:
         return None, "Collection not found"
     
-    # Find the specific memory in the collection
-    memory_metadata = None
-    memory_index = None
-    for i, mem in enumerate(collection.get("memories", [])):
-        if mem["id"] == memory_id:
-            memory_metadata = mem
-            memory_index = i
-            break
-    
+    memory_metadata = get_collection_memory(user_id, collection_id, memory_id)
     if not memory_metadata:
         return None, "Memory not found"
     
     try:
-        # Generate embedding for the query
-        response = ollama.embeddings(model="nomic-embed-text", prompt=query_text)
-        query_embedding = np.array([response["embedding"]]).astype('float32')
-        
+        # The whole memory is used as context, so the query needs no embedding
         # Get text content of the memory
         memory_dir = get_collection_documents_path(user_id, collection_id)
         text_path = os.path.join(memory_dir, f"{memory_metadata['id']}.txt")
@@ -57,13 +45,7 @@ def create_memory_chat_session(user_id, collection_id, memory_id):
     if not collection:
         return None, "Collection not found"
     
-    # Find the memory in the collection
-    memory = None
-    for mem in collection.get("memories", []):
-        if mem["id"] == memory_id:
-            memory = mem
-            break
-    
+    memory = get_collection_memory(user_id, collection_id, memory_id)
     if not memory:
         return None, "Memory not found"
     
@@ -174,7 +156,11 @@ def process_chat_query(chat_id, user_id, query_text):
     
     response_text = generate_response(query_text, relevant_memories)
     
-    memory_ids = [memory['metadata']['id'] for memory in relevant_memories]
+    # Several chunks can come from the same memory; reference each memory once
+    referenced_memories = {}
+    for memory in relevant_memories:
+        referenced_memories.setdefault(memory['metadata']['id'], memory['metadata'])
+    memory_ids = list(referenced_memories)
     
     ai_message, error = add_message_to_chat(
         chat_id, 
@@ -190,7 +176,7 @@ def process_chat_query(chat_id, user_id, query_text):
     return {
         "query": query_text,
         "response": response_text,
-        "relevant_memories": [m["metadata"] for m in relevant_memories]
+        "relevant_memories": list(referenced_memories.values())
     }, None
     
 def delete_chat_session(chat_id, user_id):
@@ -215,13 +201,7 @@ def create_memory_chat_session(user_id, collection_id, memory_id):
     if not collection:
         return None, "Collection not found"
     
-    # Find the memory in the collection
-    memory = None
-    for mem in collection.get("memories", []):
-        if mem["id"] == memory_id:
-            memory = mem
-            break
-    
+    memory = get_collection_memory(user_id, collection_id, memory_id)
     if not memory:
         return None, "Memory not found"
     
@@ -331,24 +311,8 @@ def get_diary_chat_sessions(user_id, diary_id):
     return Chat.query.filter_by(user_id=user_id, diary_id=diary_id).order_by(Chat.updated_at.desc()).all()
 
 
-def process_diary_chat_query(chat_id, user_id, query_text):
-    """Process a user query for a diary chat"""
-    chat = Chat.query.filter_by(id=chat_id, user_id=user_id).first()
-    if not chat:
-        return None, "Chat session not found"
-    
-    if not chat.diary_id:
-        return None, "This is not a diary chat"
-    
-    user_message, error = add_message_to_chat(chat_id, user_id, query_text, is_user=True)
-    if error:
-        return None, error
-    
-    
-    diary_data = get_diary_with_entries(user_id, chat.diary_id)
-    if not diary_data:
-        return None, "Diary not found"
-
+def build_diary_context(diary_data):
+    """Format diary entries as LLM context, returning (entries_text, entry_ids)"""
     entries_text = ""
     relevant_entry_ids = []
     
@@ -361,11 +325,11 @@ def process_diary_chat_query(chat_id, user_id, query_text):
         entries_text += f"\n--- ENTRY {entry_id} ---\n{entry_text}\n"
         relevant_entry_ids.append(entry_id)
     
-    # Generate response
-    response_text = ""
-    if entries_text:
-        # Use ollama to generate response
-        prompt = f"""
+    return entries_text, relevant_entry_ids
+
+def build_diary_prompt(entries_text, query_text):
+    """Build the LLM prompt for answering a query about diary entries"""
+    return f"""
         You are an AI assistant that helps users interact with their personal diary.
         Based on the following diary entries and the user's question, provide a helpful response.
         
@@ -377,6 +341,34 @@ def process_diary_chat_query(chat_id, user_id, query_text):
         Your response should include references to the specific diary entries you're using to answer.
         Your response:
         """
+
+EMPTY_DIARY_RESPONSE = "I don't see any entries in your diary yet. Add some entries and then we can chat about them!"
+
+def process_diary_chat_query(chat_id, user_id, query_text):
+    """Process a user query for a diary chat"""
+    chat = Chat.query.filter_by(id=chat_id, user_id=user_id).first()
+    if not chat:
+        return None, "Chat session not found"
+    
+    if not chat.diary_id:
+        return None, "This is not a diary chat"
+    
+    user_message, error = add_message_to_chat(chat_id, user_id, query_text, is_user=True)
+    if error:
+        return None, error
+    
+    
+    diary_data = get_diary_with_entries(user_id, chat.diary_id)
+    if not diary_data:
+        return None, "Diary not found"
+
+    entries_text, relevant_entry_ids = build_diary_context(diary_data)
+    
+    # Generate response
+    response_text = ""
+    if entries_text:
+        # Use ollama to generate response
+        prompt = build_diary_prompt(entries_text, query_text)
         
         try:
             output = ollama.generate(
@@ -388,7 +380,7 @@ def process_diary_chat_query(chat_id, user_id, query_text):
             print(f"Error generating response: {e}")
             response_text = f"I had trouble processing your question about your diary. Technical error: {str(e)}"
     else:
-        response_text = "I don't see any entries in your diary yet. Add some entries and then we can chat about them!"
+        response_text = EMPTY_DIARY_RESPONSE
     
     # Store the AI message
     ai_message, error = add_message_to_chat(
@@ -408,3 +400,103 @@ def process_diary_chat_query(chat_id, user_id, query_text):
         "relevant_entries": diary_data.get("entries", [])
     }, None
 
+# Streaming variants. Each returns (events, error) where events is a generator
+# of (event_name, data) pairs: the references first, then "token" events as
+# the LLM produces text, then "done" once the AI message has been stored.
+
+def _stream_and_store(chat_id, user_id, query_text, pieces, relevant_ids, extra_fields):
+    """Relay streamed response text, then store the complete AI message"""
+    response_text = ""
+    for piece in pieces:
+        response_text += piece
+        yield "token", {"text": piece}
+    
+    ai_message, error = add_message_to_chat(
+        chat_id,
+        user_id,
+        response_text,
+        is_user=False,
+        relevant_memory_ids=relevant_ids
+    )
+    if error:
+        yield "error", {"error": error}
+        return
+    
+    yield "done", {
+        "query": query_text,
+        "response": response_text,
+        "message_id": ai_message.id,
+        **extra_fields
+    }
+
+def stream_chat_query(chat_id, user_id, query_text):
+    """Process a collection or memory chat query, streaming the response"""
+    chat = Chat.query.filter_by(id=chat_id, user_id=user_id).first()
+    if not chat:
+        return None, "Chat session not found"
+    
+    user_message, error = add_message_to_chat(chat_id, user_id, query_text, is_user=True)
+    if error:
+        return None, error
+    
+    if chat.memory_id:
+        relevant_memories, error = query_specific_memory(user_id, chat.collection_id, chat.memory_id, query_text)
+    else:
+        relevant_memories, error = query_collection(user_id, chat.collection_id, query_text)
+    if error:
+        return None, error
+    
+    referenced_memories = {}
+    for memory in relevant_memories:
+        referenced_memories.setdefault(memory['metadata']['id'], memory['metadata'])
+    fields = {"relevant_memories": list(referenced_memories.values())}
+    
+    def events():
+        yield "memories", fields
+        yield from _stream_and_store(
+            chat_id,
+            user_id,
+            query_text,
+            generate_response_stream(query_text, relevant_memories),
+            list(referenced_memories),
+            fields
+        )
+    
+    return events(), None
+
+def stream_diary_chat_query(chat_id, user_id, query_text):
+    """Process a diary chat query, streaming the response"""
+    chat = Chat.query.filter_by(id=chat_id, user_id=user_id).first()
+    if not chat:
+        return None, "Chat session not found"
+    
+    if not chat.diary_id:
+        return None, "This is not a diary chat"
+    
+    user_message, error = add_message_to_chat(chat_id, user_id, query_text, is_user=True)
+    if error:
+        return None, error
+    
+    diary_data = get_diary_with_entries(user_id, chat.diary_id)
+    if not diary_data:
+        return None, "Diary not found"
+    
+    entries_text, relevant_entry_ids = build_diary_context(diary_data)
+    if entries_text:
+        pieces = stream_llm_response(build_diary_prompt(entries_text, query_text))
+    else:
+        pieces = iter([EMPTY_DIARY_RESPONSE])
+    fields = {"relevant_entries": diary_data.get("entries", [])}
+    
+    def events():
+        yield "entries", fields
+        yield from _stream_and_store(
+            chat_id,
+            user_id,
+            query_text,
+            pieces,
+            ",".join(map(str, relevant_entry_ids)),
+            fields
+        )
+    
+    return events(), None
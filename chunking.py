@@ -0,0 +1,60 @@
+"""
+Split extracted memory text into overlapping token windows for embedding.
+
+Token counts are approximated with a word/punctuation tokenizer, which tracks
+the embedding model's wordpiece count closely enough to keep every window
+well inside its context. Chunks are returned as [start, end) character
+offsets into the original text so they can be stored compactly and sliced
+back out of the memory's .txt file.
+"""
+import math
+import re
+
+# Window size and overlap, in approximate model tokens
+CHUNK_TOKENS = 256
+CHUNK_OVERLAP_TOKENS = 32
+
+# A memory owns 2**VECTOR_ID_SLOT_BITS vector IDs (see services.py)
+MAX_CHUNKS = 1 << 16
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+_SENTENCE_END = {'.', '!', '?'}
+
+def chunk_text(text, max_tokens=CHUNK_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    """Split text into overlapping windows.
+
+    Returns a list of [start, end] character offsets. Windows prefer to end on
+    a sentence boundary in their last quarter. Empty text yields one empty
+    chunk so every memory has at least one vector.
+    """
+    tokens = [(m.start(), m.end(), m.group()) for m in _TOKEN_RE.finditer(text)]
+    if not tokens:
+        return [[0, len(text)]]
+
+    # Grow the window for huge documents so they still fit the ID block
+    step_needed = math.ceil(len(tokens) / MAX_CHUNKS)
+    max_tokens = max(max_tokens, step_needed + overlap_tokens)
+    overlap_tokens = min(overlap_tokens, max_tokens // 2)
+
+    chunks = []
+    start = 0
+    while start < len(tokens):
+        end = min(start + max_tokens, len(tokens))
+
+        if end < len(tokens):
+            min_end = start + (max_tokens * 3) // 4
+            for i in range(end - 1, min_end - 1, -1):
+                if tokens[i][2] in _SENTENCE_END:
+                    end = i + 1
+                    break
+
+        chunks.append([tokens[start][0], tokens[end - 1][1]])
+        if end == len(tokens):
+            break
+        start = max(end - overlap_tokens, start + 1)
+
+    return chunks
+
+def get_chunk_text(text, chunk):
+    """Slice one chunk back out of the memory text"""
+    return text[chunk[0]:chunk[1]]
@@ -0,0 +1,123 @@
+"""
+Write-ahead journal for changes that span several files of a collection.
+
+Adding or deleting a memory touches the documents directory, the embedding
+store, the FAISS index and the metadata store, and a crash between any two of
+those writes used to leave them out of sync. Each such change is now recorded
+as a small JSON entry in the collection's journal/ directory before the first
+write and removed once the metadata store commit has happened, so after a
+crash services.recover_collections knows exactly which changes to finish or
+undo instead of rebuilding every index.
+
+Every file is written to a temp name, fsynced and renamed over the old one,
+so readers see either the old or the new version, never a torn file.
+"""
+import json
+import os
+
+JOURNAL_DIRNAME = 'journal'
+
+def fsync_dir(path):
+    """Make a rename or unlink in a directory durable (a no-op on Windows)"""
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def replace_file(tmp_path, path):
+    """fsync tmp_path and atomically rename it to path"""
+    with open(tmp_path, 'rb+') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+def write_file_atomic(path, write):
+    """Call write(tmp_path) to produce a file, then move it into place"""
+    tmp_path = f"{path}.tmp"
+    try:
+        write(tmp_path)
+        replace_file(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def write_text_atomic(path, text):
+    """Atomically replace path with UTF-8 text"""
+    def write(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+    write_file_atomic(path, write)
+
+def remove_file(path):
+    """Remove path if it exists, returning whether it did"""
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def get_journal_dir(collection_path):
+    """Get the journal directory of a collection"""
+    return os.path.join(collection_path, JOURNAL_DIRNAME)
+
+def begin(collection_path, entry_id, entry):
+    """Durably record a pending change before any of its files are written"""
+    journal_dir = get_journal_dir(collection_path)
+    try:
+        # Not makedirs: a collection deleted meanwhile must not reappear
+        os.mkdir(journal_dir)
+    except FileExistsError:
+        pass
+    write_text_atomic(os.path.join(journal_dir, f"{entry_id}.json"), json.dumps(entry))
+
+def commit(collection_path, entry_id):
+    """Mark a change as fully applied"""
+    journal_dir = get_journal_dir(collection_path)
+    if remove_file(os.path.join(journal_dir, f"{entry_id}.json")):
+        fsync_dir(journal_dir)
+
+def read_entries(collection_path):
+    """List a collection's pending changes as (entry_id, entry), oldest first"""
+    journal_dir = get_journal_dir(collection_path)
+    if not os.path.isdir(journal_dir):
+        return []
+
+    entries = []
+    for name in os.listdir(journal_dir):
+        path = os.path.join(journal_dir, name)
+        if name.endswith('.tmp'):
+            # begin() never finished, so none of the change's files were written
+            remove_file(path)
+            continue
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Skipping unreadable journal entry {path}: {str(e)}")
+            continue
+        entries.append((os.path.getmtime(path), name[:-len('.json')], entry))
+
+    entries.sort(key=lambda item: item[0])
+    return [(entry_id, entry) for _, entry_id, entry in entries]
+
+def find_pending(collections_dir):
+    """Yield (user_id, collection_id, entry_id, entry) for every pending change"""
+    if not os.path.isdir(collections_dir):
+        return
+    for user_dir in sorted(os.listdir(collections_dir)):
+        if not user_dir.startswith('user_'):
+            continue
+        user_path = os.path.join(collections_dir, user_dir)
+        if not os.path.isdir(user_path):
+            continue
+        for collection_id in sorted(os.listdir(user_path)):
+            collection_path = os.path.join(user_path, collection_id)
+            if not os.path.isdir(get_journal_dir(collection_path)):
+                continue
+            for entry_id, entry in read_entries(collection_path):
+                yield user_dir[len('user_'):], collection_id, entry_id, entry
@@ -0,0 +1,228 @@
+"""
+Per-collection reader/writer locks.
+
+Writers to a collection (ingestion, deletes, rebuilds, crash recovery) read
+the index and metadata, change them and write them back, so two of them
+running at once on the same collection would lose one of the changes. Each
+collection gets its own lock: writers to the same collection run one at a
+time, while work on different collections never waits. Readers only exclude
+writers, and a waiting writer blocks new readers so a steady stream of
+queries cannot starve it.
+
+Locks are reentrant within a thread: a writer may take the read or write
+lock of its collection again, e.g. when a delete loads the index. Taking the
+write lock while holding only the read lock is an error, since two threads
+doing so would deadlock.
+
+When a lock_path is given, the in-process lock is backed by an OS file lock
+on it (flock, or msvcrt on Windows where shared locks are exclusive), so
+several server processes sharing COLLECTIONS_DIR also serialize. Lock files
+must never be unlinked while the key is in use anywhere: a process that
+opened the old file and one that created a new one would both hold an
+"exclusive" lock. Set
+COLLECTION_FILE_LOCKS=0 to skip file locks for single-process deployments.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+COLLECTION_FILE_LOCKS = os.environ.get('COLLECTION_FILE_LOCKS', '1') != '0'
+
+_registry_lock = threading.Lock()
+_locks = {}  # key -> _CollectionLock
+_stats = {
+    mode: {"acquired": 0, "contended": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+    for mode in ("read", "write")
+}
+
+def _lock_file(f, shared):
+    """Lock an open file, returning whether another process held it first"""
+    if fcntl is not None:
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(f.fileno(), operation | fcntl.LOCK_NB)
+            return False
+        except BlockingIOError:
+            fcntl.flock(f.fileno(), operation)
+            return True
+    f.seek(0)
+    try:
+        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        return False
+    except OSError:
+        pass
+    while True:
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            return True
+        except OSError:
+            # LK_LOCK gives up after ten seconds; keep waiting
+            continue
+
+def _unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        return
+    f.seek(0)
+    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+class _CollectionLock:
+    """Writer-preferring RW lock, optionally backed by a file lock"""
+
+    def __init__(self, lock_path):
+        self.lock_path = lock_path if COLLECTION_FILE_LOCKS else None
+        self.cond = threading.Condition()
+        self.readers = {}  # thread ident -> depth
+        self.writer = None
+        self.write_depth = 0
+        self.waiting_writers = 0
+        self.refs = 0
+        self.file = None
+
+    def _lock_file(self, shared):
+        # Called with cond held, so other threads of this process wait for
+        # the file lock on the condition rather than on the file
+        if self.lock_path is None:
+            return False
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        self.file = open(self.lock_path, 'a+b')
+        try:
+            return _lock_file(self.file, shared)
+        except BaseException:
+            self.file.close()
+            self.file = None
+            raise
+
+    def _unlock_file(self):
+        if self.file is not None:
+            try:
+                _unlock_file(self.file)
+            finally:
+                self.file.close()
+                self.file = None
+
+    def acquire_read(self):
+        """Returns whether the caller had to wait"""
+        me = threading.get_ident()
+        with self.cond:
+            if self.writer == me or me in self.readers:
+                if self.writer == me:
+                    self.write_depth += 1
+                else:
+                    self.readers[me] += 1
+                return False
+            waited = self.writer is not None or self.waiting_writers > 0
+            while self.writer is not None or self.waiting_writers:
+                self.cond.wait()
+            if not self.readers:
+                waited = self._lock_file(shared=True) or waited
+            self.readers[me] = 1
+            return waited
+
+    def acquire_write(self):
+        """Returns whether the caller had to wait"""
+        me = threading.get_ident()
+        with self.cond:
+            if self.writer == me:
+                self.write_depth += 1
+                return False
+            if me in self.readers:
+                raise RuntimeError("Cannot take a collection write lock while holding its read lock")
+            waited = self.writer is not None or bool(self.readers)
+            self.waiting_writers += 1
+            try:
+                while self.writer is not None or self.readers:
+                    self.cond.wait()
+                waited = self._lock_file(shared=False) or waited
+            finally:
+                self.waiting_writers -= 1
+            self.writer = me
+            self.write_depth = 1
+            return waited
+
+    def release(self):
+        me = threading.get_ident()
+        with self.cond:
+            if self.writer == me:
+                self.write_depth -= 1
+                if self.write_depth:
+                    return
+                self.writer = None
+            else:
+                self.readers[me] -= 1
+                if self.readers[me]:
+                    return
+                del self.readers[me]
+                if self.readers:
+                    return
+            self._unlock_file()
+            self.cond.notify_all()
+
+def _checkout(key, lock_path):
+    with _registry_lock:
+        lock = _locks.get(key)
+        if lock is None:
+            lock = _locks[key] = _CollectionLock(lock_path)
+        lock.refs += 1
+        return lock
+
+def _checkin(key, lock):
+    with _registry_lock:
+        lock.refs -= 1
+        if lock.refs == 0:
+            del _locks[key]
+
+def _record_wait(mode, waited, seconds):
+    with _registry_lock:
+        stats = _stats[mode]
+        stats["acquired"] += 1
+        if waited:
+            stats["contended"] += 1
+            stats["wait_seconds"] += seconds
+            stats["max_wait_seconds"] = max(stats["max_wait_seconds"], seconds)
+
+@contextmanager
+def _locked(mode, key, lock_path):
+    lock = _checkout(key, lock_path)
+    try:
+        started = time.perf_counter()
+        waited = lock.acquire_read() if mode == "read" else lock.acquire_write()
+        _record_wait(mode, waited, time.perf_counter() - started)
+        try:
+            yield
+        finally:
+            lock.release()
+    finally:
+        _checkin(key, lock)
+
+def read_locked(key, lock_path=None):
+    """Context manager holding key's lock shared"""
+    return _locked("read", key, lock_path)
+
+def write_locked(key, lock_path=None):
+    """Context manager holding key's lock exclusively"""
+    return _locked("write", key, lock_path)
+
+def get_lock_stats():
+    """Acquisition counts and wait times for read and write locks"""
+    with _registry_lock:
+        return {
+            **{
+                mode: {
+                    **stats,
+                    "wait_seconds": round(stats["wait_seconds"], 6),
+                    "max_wait_seconds": round(stats["max_wait_seconds"], 6),
+                    "mean_wait_seconds": round(stats["wait_seconds"] / stats["contended"], 6) if stats["contended"] else 0.0,
+                }
+                for mode, stats in _stats.items()
+            },
+            "held": sum(1 for lock in _locks.values() if lock.writer is not None or lock.readers),
+            "file_locks": COLLECTION_FILE_LOCKS,
+        }
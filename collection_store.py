@@ -0,0 +1,397 @@
+"""
+SQLite store for collection and memory metadata.
+
+Collections and memories are rows in two indexed tables instead of one
+metadata.json per collection, so adding or deleting a memory writes one row
+and a memory is looked up by its ID without reading the rest of the
+collection. Documents, text files, indexes and embedding stores stay on disk
+where they were.
+
+Memory fields with their own column are listed in MEMORY_COLUMNS; anything
+else (chunk offsets, diarization data, ...) is kept as JSON in the row's data
+column and merged back when the memory is read, so callers see the same
+dicts metadata.json held. Every write to a collection bumps its generation,
+which services uses to validate cached metadata, across processes too.
+
+Each collection row also carries a summary (memory_count, document_bytes,
+updated_at) that is updated in the same transaction as every memory write,
+so listing a user's collections reads one small row per collection. A
+per-user version, bumped with any of the user's collections, validates the
+cached listing.
+
+Existing metadata.json files are imported once by migrate_metadata_files and
+renamed to metadata.json.migrated; ensure_migrated runs this and any other
+one-time data migrations the first time a process opens the store.
+"""
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+MEMORY_COLUMNS = ["id", "title", "description", "type", "filename", "original_filename", "created_at"]
+COLLECTION_COLUMNS = ["id", "name", "description", "created_at", "index_version"]
+SUMMARY_COLUMNS = ["memory_count", "document_bytes", "updated_at"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS collections (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    description TEXT,
+    created_at TEXT,
+    index_version INTEGER,
+    generation INTEGER NOT NULL DEFAULT 0,
+    memory_count INTEGER NOT NULL DEFAULT 0,
+    document_bytes INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS collections_user ON collections (user_id, created_at);
+CREATE TABLE IF NOT EXISTS memories (
+    id TEXT PRIMARY KEY,
+    collection_id TEXT NOT NULL REFERENCES collections (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    title TEXT,
+    description TEXT,
+    type TEXT,
+    filename TEXT,
+    original_filename TEXT,
+    created_at TEXT,
+    size_bytes INTEGER,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS memories_collection ON memories (collection_id, position);
+CREATE TABLE IF NOT EXISTS user_versions (
+    user_id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+# Columns added after the first release of the schema: (table, column, definition)
+_ADDED_COLUMNS = [
+    ("collections", "memory_count", "INTEGER NOT NULL DEFAULT 0"),
+    ("collections", "document_bytes", "INTEGER NOT NULL DEFAULT 0"),
+    ("collections", "updated_at", "TEXT"),
+    ("memories", "size_bytes", "INTEGER"),
+]
+
+_local = threading.local()
+_migrated = set()
+_migrate_lock = threading.Lock()
+
+def connect(db_path):
+    """Get this thread's connection to the store at db_path, creating the schema"""
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(db_path)
+    if conn is None:
+        conn = sqlite3.connect(db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.executescript(_SCHEMA)
+        _add_missing_columns(conn)
+        connections[db_path] = conn
+    return conn
+
+def _add_missing_columns(conn):
+    """Bring a store created by an older version up to the current schema"""
+    added = False
+    with conn:
+        for table, column, definition in _ADDED_COLUMNS:
+            columns = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+            if column not in columns:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+                added = True
+    if added:
+        refresh_summaries(conn)
+
+def _now():
+    return datetime.now().isoformat()
+
+def _collection_from_row(row, user_id):
+    collection = {
+        "id": row["id"],
+        "user_id": user_id,
+        "name": row["name"],
+        "description": row["description"],
+        "created_at": row["created_at"],
+    }
+    if row["index_version"] is not None:
+        collection["index_version"] = row["index_version"]
+    if row["extra"]:
+        collection.update(json.loads(row["extra"]))
+    for column in SUMMARY_COLUMNS:
+        collection[column] = row[column]
+    return collection
+
+def _memory_from_row(row):
+    memory = {column: row[column] for column in MEMORY_COLUMNS}
+    if row["data"]:
+        memory.update(json.loads(row["data"]))
+    return memory
+
+def _memory_values(memory):
+    data = {key: value for key, value in memory.items() if key not in MEMORY_COLUMNS}
+    return [memory.get(column) for column in MEMORY_COLUMNS] + [json.dumps(data) if data else None]
+
+def _bump_user(conn, user_id):
+    conn.execute(
+        "INSERT INTO user_versions (user_id, version) VALUES (?, 1) "
+        "ON CONFLICT (user_id) DO UPDATE SET version = version + 1",
+        (str(user_id),)
+    )
+
+def _bump(conn, collection_id):
+    conn.execute("UPDATE collections SET generation = generation + 1 WHERE id = ?", (collection_id,))
+    row = conn.execute("SELECT user_id FROM collections WHERE id = ?", (collection_id,)).fetchone()
+    if row is not None:
+        _bump_user(conn, row["user_id"])
+
+def insert_collection(conn, user_id, collection):
+    """Add a collection (and any memories it already has) in one transaction"""
+    extra = {key: value for key, value in collection.items()
+             if key not in COLLECTION_COLUMNS + SUMMARY_COLUMNS and key not in ("user_id", "memories")}
+    memories = collection.get("memories", [])
+    updated_at = max([collection.get("created_at") or ""] + [m.get("created_at") or "" for m in memories]) or None
+    with conn:
+        conn.execute(
+            "INSERT INTO collections (id, user_id, name, description, created_at, index_version, "
+            "memory_count, updated_at, extra) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (collection["id"], str(user_id), collection.get("name") or "", collection.get("description"),
+             collection.get("created_at"), collection.get("index_version"), len(memories), updated_at,
+             json.dumps(extra) if extra else None)
+        )
+        conn.executemany(
+            "INSERT INTO memories (collection_id, position, " + ", ".join(MEMORY_COLUMNS) + ", data) "
+            "VALUES (?, ?, " + ", ".join("?" * len(MEMORY_COLUMNS)) + ", ?)",
+            [[collection["id"], position] + _memory_values(memory)
+             for position, memory in enumerate(memories)]
+        )
+        _bump_user(conn, user_id)
+
+def get_collection(conn, user_id, collection_id, with_memories=True):
+    """Get a collection as a dict, or None if the user has no such collection"""
+    row = conn.execute(
+        "SELECT * FROM collections WHERE id = ? AND user_id = ?", (collection_id, str(user_id))
+    ).fetchone()
+    if row is None:
+        return None
+    collection = _collection_from_row(row, user_id)
+    if with_memories:
+        collection["memories"] = list_memories(conn, collection_id)
+    return collection
+
+def list_collection_summaries(conn, user_id):
+    """A user's collections without their memories, oldest first"""
+    rows = conn.execute(
+        "SELECT * FROM collections WHERE user_id = ? ORDER BY created_at, id", (str(user_id),)
+    ).fetchall()
+    return [_collection_from_row(row, user_id) for row in rows]
+
+def get_user_version(conn, user_id):
+    """Write counter covering all of a user's collections"""
+    row = conn.execute("SELECT version FROM user_versions WHERE user_id = ?", (str(user_id),)).fetchone()
+    return 0 if row is None else row["version"]
+
+def list_collection_ids(conn, user_id):
+    """IDs of a user's collections, oldest first"""
+    rows = conn.execute(
+        "SELECT id FROM collections WHERE user_id = ? ORDER BY created_at, id", (str(user_id),)
+    ).fetchall()
+    return [row["id"] for row in rows]
+
+def get_generation(conn, user_id, collection_id):
+    """Write counter of a collection, or None if the user has no such collection"""
+    row = conn.execute(
+        "SELECT generation FROM collections WHERE id = ? AND user_id = ?", (collection_id, str(user_id))
+    ).fetchone()
+    return None if row is None else row["generation"]
+
+def get_collection_bytes(conn, collection_id):
+    """Approximate size of a collection's stored metadata"""
+    row = conn.execute(
+        "SELECT COALESCE(SUM(LENGTH(data)), 0) + 200 * COUNT(*) AS size FROM memories WHERE collection_id = ?",
+        (collection_id,)
+    ).fetchone()
+    return row["size"] + 200
+
+def set_collection_fields(conn, collection_id, fields):
+    """Set extra (non-column) fields of a collection"""
+    with conn:
+        row = conn.execute("SELECT extra FROM collections WHERE id = ?", (collection_id,)).fetchone()
+        if row is None:
+            return
+        extra = json.loads(row["extra"]) if row["extra"] else {}
+        extra.update(fields)
+        conn.execute("UPDATE collections SET extra = ? WHERE id = ?", (json.dumps(extra), collection_id))
+        _bump(conn, collection_id)
+
+def set_index_version(conn, collection_id, index_version):
+    with conn:
+        conn.execute("UPDATE collections SET index_version = ? WHERE id = ?", (index_version, collection_id))
+        _bump(conn, collection_id)
+
+def delete_collection(conn, user_id, collection_id):
+    """Delete a collection and its memories, returning whether it existed"""
+    with conn:
+        cursor = conn.execute(
+            "DELETE FROM collections WHERE id = ? AND user_id = ?", (collection_id, str(user_id))
+        )
+        _bump_user(conn, user_id)
+    return cursor.rowcount > 0
+
+def list_memories(conn, collection_id):
+    """All memories of a collection in the order they were added"""
+    rows = conn.execute(
+        "SELECT * FROM memories WHERE collection_id = ? ORDER BY position", (collection_id,)
+    ).fetchall()
+    return [_memory_from_row(row) for row in rows]
+
+def list_memory_ids(conn, collection_id):
+    """IDs of a collection's memories, without loading their metadata"""
+    rows = conn.execute("SELECT id FROM memories WHERE collection_id = ?", (collection_id,)).fetchall()
+    return [row["id"] for row in rows]
+
+def get_memory(conn, collection_id, memory_id):
+    """Look up one memory by ID, or None"""
+    row = conn.execute(
+        "SELECT * FROM memories WHERE id = ? AND collection_id = ?", (memory_id, collection_id)
+    ).fetchone()
+    return None if row is None else _memory_from_row(row)
+
+def add_memory(conn, collection_id, memory, size_bytes=0):
+    """Append a memory to a collection, counting size_bytes of stored files towards it"""
+    add_memories(conn, collection_id, [(memory, size_bytes)])
+
+def add_memories(conn, collection_id, memories):
+    """Append (memory, size_bytes) pairs to a collection in one transaction"""
+    with conn:
+        for memory, size_bytes in memories:
+            conn.execute(
+                "INSERT INTO memories (collection_id, position, size_bytes, " + ", ".join(MEMORY_COLUMNS) + ", data) "
+                "VALUES (?, (SELECT COALESCE(MAX(position), -1) + 1 FROM memories WHERE collection_id = ?), ?, "
+                + ", ".join("?" * len(MEMORY_COLUMNS)) + ", ?)",
+                [collection_id, collection_id, size_bytes] + _memory_values(memory)
+            )
+        conn.execute(
+            "UPDATE collections SET memory_count = memory_count + ?, document_bytes = document_bytes + ?, "
+            "updated_at = ? WHERE id = ?",
+            (len(memories), sum(size_bytes for _, size_bytes in memories), _now(), collection_id)
+        )
+        _bump(conn, collection_id)
+
+def update_memory(conn, collection_id, memory):
+    """Replace the stored fields of an existing memory"""
+    with conn:
+        conn.execute(
+            "UPDATE memories SET " + ", ".join(f"{column} = ?" for column in MEMORY_COLUMNS) + ", data = ? "
+            "WHERE id = ? AND collection_id = ?",
+            _memory_values(memory) + [memory["id"], collection_id]
+        )
+        conn.execute("UPDATE collections SET updated_at = ? WHERE id = ?", (_now(), collection_id))
+        _bump(conn, collection_id)
+
+def find_memories_with_field(conn, key):
+    """Yield (user_id, collection_id, memory) for every memory whose data has key"""
+    rows = conn.execute(
+        "SELECT memories.*, collections.user_id AS owner FROM memories "
+        "JOIN collections ON collections.id = memories.collection_id WHERE memories.data LIKE ?",
+        (f'%"{key}"%',)
+    ).fetchall()
+    for row in rows:
+        memory = _memory_from_row(row)
+        if key in memory:
+            yield row["owner"], row["collection_id"], memory
+
+def delete_memory(conn, collection_id, memory_id):
+    """Remove a memory, returning whether it existed"""
+    with conn:
+        row = conn.execute(
+            "SELECT size_bytes FROM memories WHERE id = ? AND collection_id = ?", (memory_id, collection_id)
+        ).fetchone()
+        if row is None:
+            return False
+        conn.execute("DELETE FROM memories WHERE id = ? AND collection_id = ?", (memory_id, collection_id))
+        conn.execute(
+            "UPDATE collections SET memory_count = memory_count - 1, document_bytes = document_bytes - ?, "
+            "updated_at = ? WHERE id = ?",
+            (row["size_bytes"] or 0, _now(), collection_id)
+        )
+        _bump(conn, collection_id)
+    return True
+
+def find_memories_without_size(conn):
+    """Yield (user_id, collection_id, memory) for memories whose file size is unknown"""
+    rows = conn.execute(
+        "SELECT memories.*, collections.user_id AS owner FROM memories "
+        "JOIN collections ON collections.id = memories.collection_id WHERE memories.size_bytes IS NULL"
+    ).fetchall()
+    for row in rows:
+        yield row["owner"], row["collection_id"], _memory_from_row(row)
+
+def set_memory_sizes(conn, sizes):
+    """Record file sizes for many memories, given as (memory_id, size_bytes) pairs"""
+    with conn:
+        conn.executemany("UPDATE memories SET size_bytes = ? WHERE id = ?", [(size, mid) for mid, size in sizes])
+
+def refresh_summaries(conn):
+    """Recompute every collection's counts and sizes from its memories"""
+    with conn:
+        conn.execute(
+            "UPDATE collections SET "
+            "memory_count = (SELECT COUNT(*) FROM memories WHERE collection_id = collections.id), "
+            "document_bytes = (SELECT COALESCE(SUM(size_bytes), 0) FROM memories WHERE collection_id = collections.id), "
+            "updated_at = COALESCE(updated_at, (SELECT MAX(created_at) FROM memories "
+            "WHERE collection_id = collections.id), created_at)"
+        )
+        conn.execute(
+            "INSERT INTO user_versions (user_id, version) SELECT DISTINCT user_id, 1 FROM collections WHERE true "
+            "ON CONFLICT (user_id) DO UPDATE SET version = version + 1"
+        )
+
+def migrate_metadata_files(conn, collections_dir):
+    """Import every collections_dir/user_<id>/<collection>/metadata.json not yet in the store.
+
+    Each file is imported in its own transaction and then renamed, so an
+    interrupted migration picks up where it stopped. Returns the number of
+    collections imported.
+    """
+    imported = 0
+    if not os.path.isdir(collections_dir):
+        return imported
+    for user_dir in os.listdir(collections_dir):
+        user_path = os.path.join(collections_dir, user_dir)
+        if not user_dir.startswith('user_') or not os.path.isdir(user_path):
+            continue
+        user_id = user_dir[len('user_'):]
+        for collection_id in os.listdir(user_path):
+            metadata_path = os.path.join(user_path, collection_id, 'metadata.json')
+            if not os.path.isfile(metadata_path):
+                continue
+            try:
+                exists = conn.execute("SELECT 1 FROM collections WHERE id = ?", (collection_id,)).fetchone()
+                if not exists:
+                    with open(metadata_path, 'r') as f:
+                        metadata = json.load(f)
+                    metadata["id"] = collection_id
+                    insert_collection(conn, user_id, metadata)
+                    imported += 1
+                os.replace(metadata_path, metadata_path + '.migrated')
+            except Exception as e:
+                print(f"Could not migrate metadata for collection {collection_id}: {str(e)}")
+    if imported:
+        print(f"Migrated {imported} collections from metadata.json into the collection store")
+    return imported
+
+def ensure_migrated(conn, db_path, migrations):
+    """Run each migration(conn), in order, once per store and process"""
+    if db_path in _migrated:
+        return
+    with _migrate_lock:
+        if db_path not in _migrated:
+            for migration in migrations:
+                migration(conn)
+            _migrated.add(db_path)
@@ -0,0 +1,110 @@
+"""
+Group commit for memory adds to the same collection.
+
+Committing a memory rewrites the collection's FAISS index and commits to the
+metadata store, so adding memories one at a time costs a full index write
+each. Callers instead submit their memory here and wait: the first caller
+for a collection becomes the batch leader, waits GROUP_COMMIT_WINDOW_MS for
+others to join (or until GROUP_COMMIT_MAX_BATCH have), then takes the
+collection's write lock and commits up to GROUP_COMMIT_MAX_BATCH queued
+items in one go. The queue is only taken once the lock is held, so adds that
+arrive while another batch is being written join the next batch instead of
+waiting for their own turn. Items past the cap stay queued, and the first of
+them is woken to lead the next batch.
+"""
+import os
+import threading
+
+GROUP_COMMIT_WINDOW_SECONDS = float(os.environ.get('GROUP_COMMIT_WINDOW_MS', 20)) / 1000
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get('GROUP_COMMIT_MAX_BATCH', 64))
+
+_lock = threading.Lock()
+_queues = {}  # key -> {"items": [...], "full": Event}
+_stats = {
+    "batches": 0,
+    "items": 0,
+    "max_batch": 0,
+}
+
+def submit(key, item, commit_batch, lock):
+    """Queue item for key's next group commit and wait for its result.
+
+    commit_batch(items) is called by whichever caller leads the batch, with
+    lock() held, and must return one result per item. Returns this item's
+    result; if commit_batch raises, or taking the lock does, every caller in
+    the batch gets the exception.
+    """
+    pending = {"item": item, "done": threading.Event(), "lead": False, "result": None, "error": None}
+    with _lock:
+        queue = _queues.get(key)
+        leader = queue is None
+        if leader:
+            queue = _queues[key] = {"items": [], "full": threading.Event()}
+        queue["items"].append(pending)
+        if len(queue["items"]) >= GROUP_COMMIT_MAX_BATCH:
+            queue["full"].set()
+
+    if not leader:
+        pending["done"].wait()
+        # Woken either with a result or to lead what the previous batch left
+        leader = promoted = pending["lead"]
+    else:
+        promoted = False
+    if leader:
+        batch = None
+        try:
+            # Items left from a full batch have already waited their window
+            if not promoted:
+                queue["full"].wait(GROUP_COMMIT_WINDOW_SECONDS)
+            with lock():
+                batch = _take_batch(key)
+                with _lock:
+                    _stats["batches"] += 1
+                    _stats["items"] += len(batch)
+                    _stats["max_batch"] = max(_stats["max_batch"], len(batch))
+                results = commit_batch([p["item"] for p in batch])
+                for p, result in zip(batch, results):
+                    p["result"] = result
+        except BaseException as e:
+            # Also reached when the lock cannot be taken: the queue still has
+            # to be closed, or its callers and every later add would wait
+            # on it forever
+            if batch is None:
+                batch = _take_batch(key)
+            for p in batch:
+                p["error"] = e
+        finally:
+            for p in batch or ():
+                p["done"].set()
+
+    if pending["error"] is not None:
+        raise pending["error"]
+    return pending["result"]
+
+def _take_batch(key):
+    """Take up to GROUP_COMMIT_MAX_BATCH of key's queued items.
+
+    If items are left, the first of them is woken to lead the next batch;
+    otherwise the queue is removed, so later adds start a new one.
+    """
+    with _lock:
+        items = _queues[key]["items"]
+        batch = items[:GROUP_COMMIT_MAX_BATCH]
+        del items[:GROUP_COMMIT_MAX_BATCH]
+        if items:
+            items[0]["lead"] = True
+            items[0]["done"].set()
+        else:
+            del _queues[key]
+        return batch
+
+def get_writer_stats():
+    """Number of group commits and how many items they carried"""
+    with _lock:
+        return {
+            **_stats,
+            "mean_batch": round(_stats["items"] / _stats["batches"], 2) if _stats["batches"] else 0.0,
+            "pending": sum(len(queue["items"]) for queue in _queues.values()),
+            "window_ms": GROUP_COMMIT_WINDOW_SECONDS * 1000,
+            "max_batch_size": GROUP_COMMIT_MAX_BATCH,
+        }
@@ -1,6 +1,7 @@
 from flask import Blueprint, request, jsonify
 from flask_login import login_required, current_user
-from services import get_all_collections, get_collection, create_collection, delete_collection
+from services import get_all_collections, get_collection, create_collection, delete_collection, set_collection_index_policy
+from index_policy import INDEX_POLICIES
 
 collections_bp = Blueprint('collections', __name__, url_prefix='/api/collections')
 
@@ -110,11 +111,15 @@ def create_new_collection():
     data = request.json
     name = data.get('name', '')
     description = data.get('description', '')
+    policy = data.get('index_policy', 'auto')
     
     if not name:
         return jsonify({"success": False, "error": "Collection name is required"}), 400
     
-    collection_id, metadata = create_collection(current_user.id, name, description)
+    if policy not in INDEX_POLICIES:
+        return jsonify({"success": False, "error": f"Index policy must be one of: {', '.join(INDEX_POLICIES)}"}), 400
+    
+    collection_id, metadata = create_collection(current_user.id, name, description, policy)
     
     return jsonify({
         "success": True,
@@ -133,6 +138,29 @@ def get_collection_details(collection_id):
         "collection": collection
     })
 
+@collections_bp.route('/<collection_id>', methods=['PATCH'])
+@login_required
+def update_collection_settings(collection_id):
+    data = request.json or {}
+    if 'index_policy' not in data:
+        return jsonify({"success": False, "error": "Nothing to update"}), 400
+    
+    if data['index_policy'] not in INDEX_POLICIES:
+        return jsonify({"success": False, "error": f"Index policy must be one of: {', '.join(INDEX_POLICIES)}"}), 400
+    
+    # Changing the policy may rebuild the index, which can take a while for
+    # large collections
+    index_type, error = set_collection_index_policy(current_user.id, collection_id, data['index_policy'])
+    if error:
+        status = 404 if error == "Collection not found" else 500
+        return jsonify({"success": False, "error": error}), status
+    
+    return jsonify({
+        "success": True,
+        "index_policy": data['index_policy'],
+        "index_type": index_type
+    })
+
 @collections_bp.route('/<collection_id>', methods=['DELETE'])
 @login_required
 def delete_collection_route(collection_id):
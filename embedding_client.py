@@ -0,0 +1,166 @@
+"""
+Client layer for the Ollama embedding model.
+
+Texts are sent to Ollama's /api/embed endpoint in batches (EMBED_BATCH_SIZE
+inputs per request). A process-wide semaphore caps the number of requests in
+flight (EMBED_MAX_CONCURRENCY), so bulk ingestion and rebuilds apply
+backpressure to each other instead of flooding the embedding server.
+
+Every vector returned by this module is L2-normalised: /api/embed already
+returns unit-length vectors, and the single-prompt fallback for older ollama
+clients is normalised to match.
+
+Query embeddings go through embed_query, which keeps a bounded LRU cache with
+a TTL keyed by (model, normalised query text). Setting QUERY_EMBED_CACHE_DB to
+a file path also persists entries to SQLite so they survive restarts.
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import ollama
+
+EMBEDDING_MODEL = "nomic-embed-text"
+EMBED_BATCH_SIZE = int(os.environ.get('EMBED_BATCH_SIZE', 32))
+EMBED_MAX_CONCURRENCY = int(os.environ.get('EMBED_MAX_CONCURRENCY', 2))
+
+QUERY_EMBED_CACHE_SIZE = int(os.environ.get('QUERY_EMBED_CACHE_SIZE', 2048))
+QUERY_EMBED_CACHE_TTL = float(os.environ.get('QUERY_EMBED_CACHE_TTL', 24 * 3600))
+QUERY_EMBED_CACHE_DB = os.environ.get('QUERY_EMBED_CACHE_DB')
+
+_request_slots = threading.BoundedSemaphore(EMBED_MAX_CONCURRENCY)
+_executor = ThreadPoolExecutor(max_workers=EMBED_MAX_CONCURRENCY, thread_name_prefix='embed')
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def _embed_batch(texts, model):
+    """Embed one batch with a single request, waiting for a free request slot"""
+    with _request_slots:
+        if hasattr(ollama, 'embed'):
+            response = ollama.embed(model=model, input=texts)
+            vectors = response["embeddings"]
+        else:
+            # Older ollama clients only expose the single-prompt endpoint
+            vectors = [ollama.embeddings(model=model, prompt=text)["embedding"] for text in texts]
+    return _normalize(np.array(vectors, dtype='float32'))
+
+def embed_texts(texts, model=EMBEDDING_MODEL, batch_size=None):
+    """Embed a list of texts, returning a (len(texts), dimension) float32 array"""
+    texts = list(texts)
+    batch_size = batch_size or EMBED_BATCH_SIZE
+    if not texts:
+        return np.empty((0, 0), dtype='float32')
+
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    if len(batches) == 1:
+        return _embed_batch(batches[0], model)
+
+    futures = [_executor.submit(_embed_batch, batch, model) for batch in batches]
+    return np.concatenate([future.result() for future in futures])
+
+def embed_text(text, model=EMBEDDING_MODEL):
+    """Embed a single text, returning a 1-D float32 vector"""
+    return embed_texts([text], model)[0]
+
+# Query embedding cache
+_query_cache_lock = threading.Lock()
+_query_cache = OrderedDict()  # (model, text) -> (expires_at, vector)
+_query_cache_stats = {"hits": 0, "misses": 0}
+_query_cache_db = threading.local()
+
+def normalize_query_text(text):
+    """Canonical form used as the cache key: trimmed, single spaces.
+
+    Case is kept, since the embedding of a name or identifier depends on it.
+    """
+    return re.sub(r'\s+', ' ', text).strip()
+
+def _get_query_cache_db():
+    if not QUERY_EMBED_CACHE_DB:
+        return None
+    conn = getattr(_query_cache_db, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(QUERY_EMBED_CACHE_DB)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS query_embeddings ("
+            "model TEXT NOT NULL, query TEXT NOT NULL, expires_at REAL NOT NULL, "
+            "vector BLOB NOT NULL, PRIMARY KEY (model, query))"
+        )
+        conn.commit()
+        _query_cache_db.conn = conn
+    return conn
+
+def _remember_query(key, expires_at, vector):
+    with _query_cache_lock:
+        _query_cache[key] = (expires_at, vector)
+        _query_cache.move_to_end(key)
+        while len(_query_cache) > QUERY_EMBED_CACHE_SIZE:
+            _query_cache.popitem(last=False)
+
+def embed_query(text, model=EMBEDDING_MODEL):
+    """Embed a search query, reusing a cached vector for repeated questions.
+
+    The query is embedded as written; its normalised form is only the cache
+    key. The returned array is shared with the cache and must not be modified.
+    """
+    key = (model, normalize_query_text(text))
+    now = time.time()
+
+    with _query_cache_lock:
+        entry = _query_cache.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                _query_cache.move_to_end(key)
+                _query_cache_stats["hits"] += 1
+                return entry[1]
+            del _query_cache[key]
+
+    db = _get_query_cache_db()
+    if db is not None:
+        row = db.execute(
+            "SELECT expires_at, vector FROM query_embeddings WHERE model = ? AND query = ?", key
+        ).fetchone()
+        if row is not None and row[0] > now:
+            vector = np.frombuffer(row[1], dtype='float32')
+            _remember_query(key, row[0], vector)
+            with _query_cache_lock:
+                _query_cache_stats["hits"] += 1
+            return vector
+
+    with _query_cache_lock:
+        _query_cache_stats["misses"] += 1
+
+    vector = embed_text(text, model)
+    vector.setflags(write=False)
+    expires_at = now + QUERY_EMBED_CACHE_TTL
+    _remember_query(key, expires_at, vector)
+
+    if db is not None:
+        db.execute(
+            "INSERT OR REPLACE INTO query_embeddings (model, query, expires_at, vector) VALUES (?, ?, ?, ?)",
+            (key[0], key[1], expires_at, vector.tobytes())
+        )
+        db.execute("DELETE FROM query_embeddings WHERE expires_at <= ?", (now,))
+        db.commit()
+
+    return vector
+
+def get_query_cache_stats():
+    """Get hit/miss counters for the query embedding cache"""
+    with _query_cache_lock:
+        lookups = _query_cache_stats["hits"] + _query_cache_stats["misses"]
+        return {
+            **_query_cache_stats,
+            "hit_rate": _query_cache_stats["hits"] / lookups if lookups else 0.0,
+            "entries": len(_query_cache),
+            "max_entries": QUERY_EMBED_CACHE_SIZE,
+            "ttl_seconds": QUERY_EMBED_CACHE_TTL,
+            "persistent": bool(QUERY_EMBED_CACHE_DB),
+        }
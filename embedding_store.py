@@ -0,0 +1,189 @@
+"""
+Per-collection on-disk store of raw embedding vectors.
+
+Vectors live in ``embeddings.f32`` as a flat float32 matrix (one row per
+vector) that is memory-mapped on read. ``embeddings.rows`` is the sidecar that
+records, for each row, the FAISS vector ID and the memory it belongs to.
+Both files are append-only; rows of deleted memories stay on disk until
+compact_embedding_store rewrites the store, which deletes do once dead rows
+make up a large enough share of it (and every index rebuild does anyway). A
+rewrite replaces both files
+under a marker file, so recover_embedding_store can finish (or discard) a
+rewrite that was interrupted halfway.
+"""
+import os
+import numpy as np
+from collection_journal import fsync_dir, remove_file
+
+EMBEDDINGS_FILENAME = 'embeddings.f32'
+ROWS_FILENAME = 'embeddings.rows'
+REPLACE_MARKER_FILENAME = 'embeddings.replacing'
+VECTOR_DTYPE = np.dtype('<f4')
+
+def get_embeddings_path(collection_path):
+    """Get the float32 matrix path for a collection"""
+    return os.path.join(collection_path, EMBEDDINGS_FILENAME)
+
+def get_rows_path(collection_path):
+    """Get the row -> memory sidecar path for a collection"""
+    return os.path.join(collection_path, ROWS_FILENAME)
+
+def read_embedding_rows(collection_path):
+    """Read the sidecar as (vector_ids, memory_ids), ignoring a torn last line"""
+    vector_ids = []
+    memory_ids = []
+    rows_path = get_rows_path(collection_path)
+    if not os.path.exists(rows_path):
+        return np.empty(0, dtype='int64'), memory_ids
+
+    with open(rows_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            vector_id, memory_id = line.rstrip('\n').split('\t')
+            vector_ids.append(int(vector_id))
+            memory_ids.append(memory_id)
+
+    return np.array(vector_ids, dtype='int64'), memory_ids
+
+def _repair_store(collection_path, dimension):
+    """Trim a partially written append so both files agree on the row count"""
+    rows_path = get_rows_path(collection_path)
+    embeddings_path = get_embeddings_path(collection_path)
+    row_bytes = dimension * VECTOR_DTYPE.itemsize
+
+    data = b''
+    if os.path.exists(rows_path):
+        with open(rows_path, 'rb') as f:
+            data = f.read()
+    line_ends = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n')) + 1
+
+    embeddings_size = os.path.getsize(embeddings_path) if os.path.exists(embeddings_path) else 0
+    count = min(len(line_ends), embeddings_size // row_bytes)
+
+    rows_size = int(line_ends[count - 1]) if count else 0
+    if rows_size != len(data):
+        with open(rows_path, 'r+b') as f:
+            f.truncate(rows_size)
+    if embeddings_size != count * row_bytes:
+        with open(embeddings_path, 'r+b') as f:
+            f.truncate(count * row_bytes)
+
+    return count
+
+def append_rows(collection_path, vector_ids, memory_ids, vectors, dimension):
+    """Append vectors of any number of memories, one memory ID per row"""
+    vectors = np.ascontiguousarray(vectors, dtype=VECTOR_DTYPE).reshape(len(vector_ids), dimension)
+    _repair_store(collection_path, dimension)
+
+    # Vectors go first: a crash between the two writes leaves trailing
+    # vectors without rows, which readers ignore and the next append trims
+    with open(get_embeddings_path(collection_path), 'ab') as f:
+        f.write(vectors.tobytes())
+        os.fsync(f.fileno())
+    with open(get_rows_path(collection_path), 'a', encoding='utf-8') as f:
+        for vector_id, memory_id in zip(vector_ids, memory_ids):
+            f.write(f"{int(vector_id)}\t{memory_id}\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def count_stored_vectors(collection_path, dimension):
+    """Number of vectors in the store, live or not, without reading it"""
+    embeddings_path = get_embeddings_path(collection_path)
+    if not os.path.exists(embeddings_path):
+        return 0
+    return os.path.getsize(embeddings_path) // (dimension * VECTOR_DTYPE.itemsize)
+
+def load_embeddings(collection_path, dimension):
+    """Memory-map the stored vectors.
+
+    Returns (matrix, vector_ids, memory_ids) where matrix is a read-only
+    (rows, dimension) float32 memmap aligned with the two ID lists.
+    """
+    vector_ids, memory_ids = read_embedding_rows(collection_path)
+    embeddings_path = get_embeddings_path(collection_path)
+    row_bytes = dimension * VECTOR_DTYPE.itemsize
+
+    vector_count = os.path.getsize(embeddings_path) // row_bytes if os.path.exists(embeddings_path) else 0
+    count = min(len(vector_ids), vector_count)
+    if count == 0:
+        return np.empty((0, dimension), dtype=VECTOR_DTYPE), vector_ids[:0], []
+
+    matrix = np.memmap(embeddings_path, dtype=VECTOR_DTYPE, mode='r', shape=(count, dimension))
+    return matrix, vector_ids[:count], memory_ids[:count]
+
+def write_embedding_store(collection_path, vector_ids, memory_ids, vectors, dimension):
+    """Replace the whole store, e.g. after a rebuild or compaction"""
+    vectors = np.ascontiguousarray(vectors, dtype=VECTOR_DTYPE).reshape(len(vector_ids), dimension)
+    embeddings_path = get_embeddings_path(collection_path)
+    rows_path = get_rows_path(collection_path)
+    marker_path = os.path.join(collection_path, REPLACE_MARKER_FILENAME)
+
+    with open(embeddings_path + '.tmp', 'wb') as f:
+        f.write(vectors.tobytes())
+        os.fsync(f.fileno())
+    with open(rows_path + '.tmp', 'w', encoding='utf-8') as f:
+        for vector_id, memory_id in zip(vector_ids, memory_ids):
+            f.write(f"{int(vector_id)}\t{memory_id}\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+    # Once the marker exists both temp files are complete, and recovery
+    # finishes the renames instead of discarding them
+    with open(marker_path, 'wb') as f:
+        os.fsync(f.fileno())
+    fsync_dir(collection_path)
+    os.replace(embeddings_path + '.tmp', embeddings_path)
+    os.replace(rows_path + '.tmp', rows_path)
+    fsync_dir(collection_path)
+    remove_file(marker_path)
+
+def recover_embedding_store(collection_path):
+    """Finish or discard a store rewrite interrupted by a crash.
+
+    Returns True if anything had to be cleaned up.
+    """
+    embeddings_path = get_embeddings_path(collection_path)
+    rows_path = get_rows_path(collection_path)
+    marker_path = os.path.join(collection_path, REPLACE_MARKER_FILENAME)
+    pending = [path for path in (embeddings_path, rows_path) if os.path.exists(path + '.tmp')]
+
+    if os.path.exists(marker_path):
+        for path in pending:
+            os.replace(path + '.tmp', path)
+        fsync_dir(collection_path)
+        remove_file(marker_path)
+        return True
+
+    for path in pending:
+        remove_file(path + '.tmp')
+    return bool(pending)
+
+def compact_embedding_store(collection_path, dimension, live_memory_ids):
+    """Drop rows of memories that are no longer in the collection.
+
+    When a memory was appended more than once, only its latest rows are kept.
+    Returns the number of rows removed.
+    """
+    matrix, vector_ids, memory_ids = load_embeddings(collection_path, dimension)
+    live_memory_ids = set(live_memory_ids)
+
+    latest_row = {}
+    for row, vector_id in enumerate(vector_ids):
+        latest_row[int(vector_id)] = row
+
+    keep = [row for row in sorted(latest_row.values()) if memory_ids[row] in live_memory_ids]
+    removed = len(vector_ids) - len(keep)
+    if removed == 0:
+        return 0
+
+    vectors = np.array(matrix[keep]) if keep else np.empty((0, dimension), dtype=VECTOR_DTYPE)
+    del matrix
+    write_embedding_store(
+        collection_path,
+        vector_ids[keep],
+        [memory_ids[row] for row in keep],
+        vectors,
+        dimension
+    )
+    return removed
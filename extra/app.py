@@ -1,14 +1,17 @@
 import os
+import sys
 import tempfile
 from datetime import datetime
 
-import whisper
 from flask import Flask, jsonify, request, send_from_directory
 
+# Share the main app's model registry so the model is loaded on first use
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model_registry import use_whisper_model
+
 app = Flask(__name__, static_folder='static')
 
-# Initialize Whisper model
-model = whisper.load_model("tiny.en")
+WHISPER_MODEL_SIZE = os.environ.get('WHISPER_MODEL_SIZE', 'tiny.en')
 
 # Ensure upload directory exists
 UPLOAD_DIR = 'uploads'
@@ -41,7 +44,8 @@ def transcribe_audio():
         # Ensure the file is closed before processing
         try:
             # Transcribe the audio
-            result = model.transcribe(temp_path)
+            with use_whisper_model(WHISPER_MODEL_SIZE) as model:
+                result = model.transcribe(temp_path)
             text = result["text"]
 
             return jsonify({
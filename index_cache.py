@@ -0,0 +1,121 @@
+"""
+In-process LRU cache for loaded collection indexes and parsed metadata.
+
+Entries are keyed by (kind, user_id, collection_id) and validated on every
+lookup against the backing file's mtime/size (or a version the caller reads
+from its store) plus a per-collection write generation that services bumps
+after each write. The cache is bounded by an
+approximate byte budget (INDEX_CACHE_MAX_BYTES, default 256 MB).
+
+Cached values are shared between requests and must not be mutated.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+INDEX_CACHE_MAX_BYTES = int(os.environ.get('INDEX_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+_lock = threading.Lock()
+_entries = OrderedDict()  # key -> (token, value, size)
+_generations = {}  # (user_id, collection_id) -> int
+_total_bytes = 0
+_stats = {
+    "hits": 0,
+    "misses": 0,
+    "evictions": 0,
+    "invalidations": 0,
+}
+
+def _collection_key(user_id, collection_id):
+    return (str(user_id), collection_id)
+
+def bump_generation(user_id, collection_id):
+    """Mark a collection as written so cached entries for it are reloaded"""
+    key = _collection_key(user_id, collection_id)
+    with _lock:
+        _generations[key] = _generations.get(key, 0) + 1
+
+def _file_token(user_id, collection_id, path, version=None):
+    if path is None:
+        if version is None:
+            return None
+        stamp = (version,)
+    else:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        stamp = (st.st_mtime_ns, st.st_size)
+    generation = _generations.get(_collection_key(user_id, collection_id), 0)
+    return (generation,) + stamp
+
+def _drop(key):
+    global _total_bytes
+    entry = _entries.pop(key, None)
+    if entry is not None:
+        _total_bytes -= entry[2]
+
+def get_cached(kind, user_id, collection_id, path, loader, size_of, version=None):
+    """Return the cached value for a collection file, loading it on a miss.
+
+    loader(path) produces the value and size_of(path, value) its approximate
+    size in bytes. Returns None if the file does not exist. For values that
+    are not backed by a single file, pass path=None and a version that
+    changes on every write; None then means the value does not exist.
+    """
+    global _total_bytes
+    key = (kind,) + _collection_key(user_id, collection_id)
+
+    with _lock:
+        token = _file_token(user_id, collection_id, path, version)
+        if token is None:
+            _drop(key)
+            return None
+
+        entry = _entries.get(key)
+        if entry is not None:
+            if entry[0] == token:
+                _entries.move_to_end(key)
+                _stats["hits"] += 1
+                return entry[1]
+            _drop(key)
+            _stats["invalidations"] += 1
+        _stats["misses"] += 1
+
+    # Load outside the lock so slow reads don't serialize unrelated collections
+    value = loader(path)
+    size = size_of(path, value)
+
+    with _lock:
+        if size > INDEX_CACHE_MAX_BYTES:
+            return value
+        _drop(key)
+        _entries[key] = (token, value, size)
+        _total_bytes += size
+        while _total_bytes > INDEX_CACHE_MAX_BYTES and _entries:
+            oldest = next(iter(_entries))
+            _drop(oldest)
+            _stats["evictions"] += 1
+
+    return value
+
+def invalidate_collection(user_id, collection_id):
+    """Drop every cached entry for a collection"""
+    collection_key = _collection_key(user_id, collection_id)
+    with _lock:
+        for key in [k for k in _entries if k[1:] == collection_key]:
+            _drop(key)
+            _stats["invalidations"] += 1
+        _generations[collection_key] = _generations.get(collection_key, 0) + 1
+
+def get_cache_stats():
+    """Get hit/miss counters and current usage"""
+    with _lock:
+        lookups = _stats["hits"] + _stats["misses"]
+        return {
+            **_stats,
+            "hit_rate": _stats["hits"] / lookups if lookups else 0.0,
+            "entries": len(_entries),
+            "bytes": _total_bytes,
+            "max_bytes": INDEX_CACHE_MAX_BYTES,
+        }
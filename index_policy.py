@@ -0,0 +1,228 @@
+"""
+Which kind of FAISS index a collection uses.
+
+Small collections keep an exact flat index. Search over it is linear in the
+number of vectors, so once a collection passes INDEX_HNSW_MIN_VECTORS its
+index is rebuilt as HNSW (a graph over the full vectors), and past
+INDEX_IVFPQ_MIN_VECTORS as IVF-PQ (clustered, product-quantized codes about
+32x smaller than the vectors). Both are built and trained from the vectors in
+the collection's embedding store, so switching never calls the embedding
+model. A collection's "index_policy" may pin a type instead of "auto".
+
+Deletes never retrain or rebuild on the spot:
+
+- flat is wrapped in IndexIDMap2 and drops vectors with remove_ids.
+- IVF-PQ keeps the vector IDs in its inverted lists, so remove_ids works
+  natively. Its PQ distances are approximate, so IndexSearcher re-ranks the
+  best k * INDEX_RERANK_FACTOR candidates exactly against the vectors in the
+  embedding store.
+- HNSW (wrapped in IndexIDMap2) cannot remove vectors. Deleted vector IDs
+  are kept as tombstones beside the index, which IndexSearcher filters out
+  with an IDSelector at search time. The index is only rebuilt once they
+  pass INDEX_DELETED_MAX_FRACTION of it.
+"""
+import math
+import os
+import faiss
+import numpy as np
+
+INDEX_POLICIES = ("auto", "flat", "hnsw", "ivfpq")
+
+INDEX_HNSW_MIN_VECTORS = int(os.environ.get('INDEX_HNSW_MIN_VECTORS', 50000))
+INDEX_IVFPQ_MIN_VECTORS = int(os.environ.get('INDEX_IVFPQ_MIN_VECTORS', 1000000))
+
+# HNSW graph degree and build/search beam widths
+INDEX_HNSW_M = int(os.environ.get('INDEX_HNSW_M', 32))
+INDEX_HNSW_EF_CONSTRUCTION = int(os.environ.get('INDEX_HNSW_EF_CONSTRUCTION', 80))
+INDEX_HNSW_EF_SEARCH = int(os.environ.get('INDEX_HNSW_EF_SEARCH', 64))
+
+# IVF-PQ: bytes per vector (must divide the dimension), lists probed per
+# search, and the most vectors k-means is trained on
+INDEX_PQ_SUBQUANTIZERS = int(os.environ.get('INDEX_PQ_SUBQUANTIZERS', 96))
+INDEX_IVF_NPROBE = int(os.environ.get('INDEX_IVF_NPROBE', 32))
+INDEX_TRAIN_MAX_VECTORS = int(os.environ.get('INDEX_TRAIN_MAX_VECTORS', 200000))
+# IVF-PQ candidates re-ranked with exact distances, per result asked for
+INDEX_RERANK_FACTOR = int(os.environ.get('INDEX_RERANK_FACTOR', 10))
+
+# Share of an HNSW index that may be tombstones before it is rebuilt
+INDEX_DELETED_MAX_FRACTION = float(os.environ.get('INDEX_DELETED_MAX_FRACTION', 0.2))
+
+# Product quantizer training needs 39 points per centroid for its 256
+# centroids; a pinned "ivfpq" collection stays flat until it has them
+IVFPQ_MIN_TRAIN_VECTORS = 10000
+
+def choose_index_type(vector_count, policy=None):
+    """Pick the index type for a collection holding vector_count vectors"""
+    policy = policy or "auto"
+    if policy == "flat":
+        return "flat"
+    if policy == "hnsw":
+        return "hnsw"
+    if policy == "ivfpq":
+        return "ivfpq" if vector_count >= IVFPQ_MIN_TRAIN_VECTORS else "flat"
+    if vector_count >= max(INDEX_IVFPQ_MIN_VECTORS, IVFPQ_MIN_TRAIN_VECTORS):
+        return "ivfpq"
+    if vector_count >= INDEX_HNSW_MIN_VECTORS:
+        return "hnsw"
+    return "flat"
+
+def _inner_index(index):
+    return faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+
+def get_index_type(index):
+    """Name the type of a collection index ("flat", "hnsw" or "ivfpq")"""
+    inner = _inner_index(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(inner, faiss.IndexIVF):
+        return "ivfpq"
+    return "flat"
+
+def supports_remove(index):
+    """Whether remove_ids can drop vectors from index by vector ID.
+
+    False for HNSW, which takes tombstones instead. An IVF index inside an
+    ID map (as the first IVF-PQ indexes were built) accepts remove_ids but
+    loses track of which ID is which, so it is rebuilt instead.
+    """
+    if isinstance(index, faiss.IndexIDMap):
+        return get_index_type(index) == "flat"
+    return isinstance(index, faiss.IndexIVF)
+
+def get_vector_ids(index):
+    """All vector IDs held by a collection index"""
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.vector_to_array(index.id_map)
+    invlists = index.invlists
+    ids = [
+        faiss.rev_swig_ptr(invlists.get_ids(i), invlists.list_size(i)).copy()
+        for i in range(index.nlist) if invlists.list_size(i)
+    ]
+    return np.concatenate(ids) if ids else np.empty(0, dtype='int64')
+
+def configure_search(index):
+    """Apply the configured search-time parameters to a loaded index"""
+    inner = _inner_index(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efSearch = INDEX_HNSW_EF_SEARCH
+    elif isinstance(inner, faiss.IndexIVF):
+        inner.nprobe = INDEX_IVF_NPROBE
+    return index
+
+def _ivf_list_count(vector_count):
+    # About 4 * sqrt(n) lists, with enough training points for each
+    return max(16, min(int(4 * math.sqrt(vector_count)), vector_count // 39))
+
+def build_index(index_type, dimension, vectors=None, vector_ids=None):
+    """Create an index of index_type holding vectors under vector_ids.
+
+    IVF-PQ is trained on (a sample of) vectors, so it needs at least
+    IVFPQ_MIN_TRAIN_VECTORS of them. It holds the vector IDs itself; the
+    other types are wrapped in IndexIDMap2.
+    """
+    if index_type == "hnsw":
+        inner = faiss.IndexHNSWFlat(dimension, INDEX_HNSW_M)
+        inner.hnsw.efConstruction = INDEX_HNSW_EF_CONSTRUCTION
+    elif index_type == "ivfpq":
+        if vectors is None or len(vectors) < IVFPQ_MIN_TRAIN_VECTORS:
+            raise ValueError(f"IVF-PQ needs at least {IVFPQ_MIN_TRAIN_VECTORS} vectors to train on")
+        quantizer = faiss.IndexFlatL2(dimension)
+        inner = faiss.IndexIVFPQ(quantizer, dimension, _ivf_list_count(len(vectors)), INDEX_PQ_SUBQUANTIZERS, 8)
+        sample = vectors
+        if len(vectors) > INDEX_TRAIN_MAX_VECTORS:
+            rows = np.sort(np.random.default_rng(0).choice(len(vectors), INDEX_TRAIN_MAX_VECTORS, replace=False))
+            sample = vectors[rows]
+        inner.train(np.ascontiguousarray(sample, dtype='float32'))
+    else:
+        inner = faiss.IndexFlatL2(dimension)
+
+    index = configure_search(inner if index_type == "ivfpq" else faiss.IndexIDMap2(inner))
+    if vectors is not None and len(vectors):
+        index.add_with_ids(np.ascontiguousarray(vectors, dtype='float32'), vector_ids)
+    return index
+
+def estimate_index_bytes(index):
+    """Approximate memory held by a loaded collection index"""
+    count = index.ntotal
+    index_type = get_index_type(index)
+    fixed = 0
+    if index_type == "ivfpq":
+        inner = _inner_index(index)
+        # Codes and IDs in the inverted lists, plus centroids and codebooks
+        per_vector = inner.code_size + 8
+        fixed = inner.nlist * index.d * 4 + inner.pq.M * 256 * (index.d // inner.pq.M) * 4
+    else:
+        per_vector = index.d * 4
+        if index_type == "hnsw":
+            per_vector += INDEX_HNSW_M * 2 * 4 * 1.1
+    if isinstance(index, faiss.IndexIDMap):
+        # IndexIDMap2 keeps an ID array and a reverse map
+        per_vector += 8 + 24
+    return int(fixed + count * per_vector)
+
+class IndexSearcher:
+    """A loaded collection index with what searching it takes besides.
+
+    deleted_ids are tombstoned vector IDs to leave out of results (HNSW).
+    vectors and vector_ids, row-aligned as load_embeddings returns them, are
+    used to re-rank IVF-PQ candidates with exact distances; the latest row
+    of a repeated ID wins. Shared between requests, so never mutated.
+    """
+
+    def __init__(self, index, deleted_ids=None, vectors=None, vector_ids=None):
+        self.index = index
+        self.index_type = get_index_type(index)
+        self._selector = None
+        self.deleted_count = 0
+        if deleted_ids is not None and len(deleted_ids):
+            deleted_ids = np.unique(np.asarray(deleted_ids, dtype='int64'))
+            self.deleted_count = int(np.count_nonzero(np.isin(deleted_ids, get_vector_ids(index))))
+            # The selectors must outlive the parameters that point at them
+            self._deleted = faiss.IDSelectorBatch(deleted_ids)
+            self._selector = faiss.IDSelectorNot(self._deleted)
+
+        self.vectors = None
+        if self.index_type == "ivfpq" and vectors is not None and len(vector_ids):
+            # Sorted unique IDs and the last row each appears in
+            order = np.argsort(vector_ids, kind='stable')[::-1]
+            unique_ids, first = np.unique(np.asarray(vector_ids)[order], return_index=True)
+            self.vectors = vectors
+            self.sorted_ids = unique_ids
+            self.rows = order[first]
+
+    @property
+    def ntotal(self):
+        """Number of live vectors that a search can return"""
+        return self.index.ntotal - self.deleted_count
+
+    def nbytes(self):
+        extra = 16 * len(self.rows) if self.vectors is not None else 0
+        return estimate_index_bytes(self.index) + 8 * self.deleted_count + extra
+
+    def search(self, queries, k):
+        """Search like faiss Index.search, returning (distances, vector_ids)"""
+        queries = np.ascontiguousarray(queries, dtype='float32')
+        if self.vectors is None:
+            # IndexIDMap swaps its own selector into params during a search,
+            # so concurrent searches each need their own
+            params = None
+            if self._selector is not None:
+                params = faiss.SearchParametersHNSW(sel=self._selector, efSearch=INDEX_HNSW_EF_SEARCH)
+            return self.index.search(queries, k, params=params)
+
+        distances, vector_ids = self.index.search(queries, k * INDEX_RERANK_FACTOR)
+        for q in range(len(queries)):
+            found = vector_ids[q] >= 0
+            positions = np.searchsorted(self.sorted_ids, vector_ids[q][found])
+            positions = np.minimum(positions, len(self.sorted_ids) - 1)
+            stored = self.sorted_ids[positions] == vector_ids[q][found]
+            # Candidates missing from the store keep their approximate distance
+            exact = distances[q][found]
+            rows = self.rows[positions[stored]]
+            candidates = np.asarray(self.vectors[rows], dtype='float32')
+            exact[stored] = ((candidates - queries[q]) ** 2).sum(axis=1)
+            distances[q][found] = exact
+            order = np.argsort(np.where(found, distances[q], np.inf), kind='stable')
+            distances[q] = distances[q][order]
+            vector_ids[q] = vector_ids[q][order]
+        return distances[:, :k], vector_ids[:, :k]
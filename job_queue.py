@@ -0,0 +1,284 @@
+"""
+Background queue for memory ingestion.
+
+Uploads are saved into the collection and recorded as IngestionJob rows. A
+pool of worker threads claims queued jobs and runs services.ingest_memory,
+recording the current stage and progress on the row. Because jobs live in the
+database, work that was queued or running when the process stopped is picked
+up again.
+
+A running job records the worker process that claimed it, and that process
+refreshes the job's heartbeat while it is alive. Only jobs whose heartbeat is
+older than JOB_LEASE_SECONDS are requeued, so a second process sharing the
+database (or a restarting one) never takes over jobs that are still running.
+Progress updates only apply while the job is still leased to this process;
+a worker that stalled past its lease abandons the job at its next update.
+"""
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from sqlalchemy import inspect, or_, text
+from extensions import db
+from models import IngestionJob, IngestionJobSegment
+
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', 2))
+
+# Workers are woken as soon as a job is enqueued in this process; the poll
+# interval only matters for jobs enqueued by another process
+JOB_POLL_INTERVAL = 5.0
+
+# How often running jobs are marked alive, and how long a job may go without
+# that before another worker takes it over
+JOB_HEARTBEAT_INTERVAL = float(os.environ.get('JOB_HEARTBEAT_INTERVAL', 10))
+JOB_LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', 60))
+
+# Identifies the jobs this process is running
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+_job_available = threading.Condition()
+_workers = []
+
+class JobLeaseLost(BaseException):
+    """Raised from a job's progress callback once another worker owns the job.
+
+    A BaseException, so ingestion's own error handling (which falls back to
+    other work on Exception) does not carry on with the job.
+    """
+
+def init_job_queue(app, workers=INGEST_WORKERS):
+    """Requeue interrupted jobs and start the worker pool"""
+    if _workers:
+        return
+
+    with app.app_context():
+        _add_missing_columns()
+        _requeue_expired_jobs()
+
+    heartbeat = threading.Thread(target=_heartbeat_loop, args=(app,), name="ingest-heartbeat", daemon=True)
+    heartbeat.start()
+    _workers.append(heartbeat)
+    for i in range(workers):
+        worker = threading.Thread(target=_worker_loop, args=(app,), name=f"ingest-worker-{i}", daemon=True)
+        worker.start()
+        _workers.append(worker)
+
+def _add_missing_columns():
+    """Add columns introduced after the job table was first created"""
+    table = IngestionJob.__tablename__
+    existing = {column['name'] for column in inspect(db.engine).get_columns(table)}
+    if 'worker_id' not in existing:
+        db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN worker_id VARCHAR(100)"))
+        db.session.commit()
+    if 'heartbeat_at' not in existing:
+        db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN heartbeat_at DATETIME"))
+        db.session.commit()
+
+def _requeue_expired_jobs():
+    """Requeue running jobs whose worker has stopped sending heartbeats"""
+    expired = datetime.utcnow() - timedelta(seconds=JOB_LEASE_SECONDS)
+    requeued = IngestionJob.query.filter(
+        IngestionJob.status == 'running',
+        or_(IngestionJob.heartbeat_at.is_(None), IngestionJob.heartbeat_at < expired)
+    ).update(
+        {"status": "queued", "stage": "requeued", "progress": 0.0, "worker_id": None},
+        synchronize_session=False
+    )
+    db.session.commit()
+    if requeued:
+        print(f"Requeued {requeued} interrupted ingestion jobs")
+    return requeued
+
+def enqueue_ingestion_job(user_id, collection_id, memory_id, saved_filename, original_filename,
+                          memory_type, title, description=""):
+    """Record a saved upload as a queued job and wake a worker"""
+    now = datetime.utcnow()
+    job = IngestionJob(
+        id=str(uuid.uuid4()),
+        user_id=user_id,
+        collection_id=collection_id,
+        memory_id=memory_id,
+        memory_type=memory_type,
+        title=title,
+        description=description,
+        saved_filename=saved_filename,
+        original_filename=original_filename,
+        status='queued',
+        stage='queued',
+        progress=0.0,
+        created_at=now,
+        updated_at=now
+    )
+
+    try:
+        db.session.add(job)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return None, str(e)
+
+    with _job_available:
+        _job_available.notify()
+    return job, None
+
+def get_ingestion_job(job_id, user_id):
+    """Get a job by ID, scoped to its owner"""
+    return IngestionJob.query.filter_by(id=job_id, user_id=user_id).first()
+
+def job_to_dict(job, segments_since=0):
+    """Serialize a job for the status endpoint.
+
+    While an audio job is transcribing, partial_segments holds the segments
+    transcribed so far, starting at index segments_since.
+    """
+    segments = IngestionJobSegment.query.filter_by(job_id=job.id)
+    partial = segments.filter(IngestionJobSegment.position >= segments_since).order_by(IngestionJobSegment.position)
+    return {
+        "id": job.id,
+        "collection_id": job.collection_id,
+        "memory_id": job.memory_id,
+        "type": job.memory_type,
+        "title": job.title,
+        "status": job.status,
+        "stage": job.stage,
+        "progress": job.progress,
+        "memory": json.loads(job.result) if job.result else None,
+        "error": job.error,
+        "partial_segment_count": segments.count(),
+        "partial_segments": [
+            {"start": segment.start, "end": segment.end, "text": segment.text} for segment in partial
+        ],
+        "created_at": job.created_at.isoformat(),
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+        "updated_at": job.updated_at.isoformat()
+    }
+
+def _claim_next_job():
+    """Atomically move the oldest queued job to running in this process"""
+    _requeue_expired_jobs()
+    while True:
+        job = IngestionJob.query.filter_by(status='queued').order_by(IngestionJob.created_at).first()
+        if job is None:
+            return None
+
+        now = datetime.utcnow()
+        claimed = IngestionJob.query.filter_by(id=job.id, status='queued').update(
+            {"status": "running", "stage": "starting", "started_at": now, "updated_at": now,
+             "worker_id": WORKER_ID, "heartbeat_at": now},
+            synchronize_session=False
+        )
+        db.session.commit()
+        if claimed:
+            db.session.refresh(job)
+            return job
+        # Another worker got there first; try the next one
+
+def _run_job(job):
+    from services import ingest_memory, get_collection_documents_path
+
+    # A requeued job transcribes again from the start
+    IngestionJobSegment.query.filter_by(job_id=job.id).delete(synchronize_session=False)
+    db.session.commit()
+    segment_count = 0
+
+    def progress(stage, fraction, segments=None):
+        nonlocal segment_count
+        now = datetime.utcnow()
+        # A worker that stalled past its lease must not refresh the new
+        # owner's heartbeat or overwrite its progress
+        owned = IngestionJob.query.filter_by(id=job.id, worker_id=WORKER_ID).update(
+            {"stage": stage, "progress": fraction, "updated_at": now, "heartbeat_at": now},
+            synchronize_session=False
+        )
+        if not owned:
+            db.session.rollback()
+            raise JobLeaseLost(job.id)
+        # Only the new segments are written, so each update costs the same
+        # however long the transcript has grown
+        for segment in segments or []:
+            db.session.add(IngestionJobSegment(
+                job_id=job.id, position=segment_count,
+                start=segment["start"], end=segment["end"], text=segment["text"]
+            ))
+            segment_count += 1
+        db.session.commit()
+
+    print(f"Running ingestion job {job.id} for memory {job.memory_id}")
+    try:
+        memory, error = ingest_memory(
+            job.user_id,
+            job.collection_id,
+            job.memory_id,
+            job.saved_filename,
+            job.original_filename,
+            job.memory_type,
+            job.title,
+            job.description or "",
+            progress=progress
+        )
+    except JobLeaseLost:
+        print(f"Ingestion job {job.id} lost its lease to another worker, abandoning it here")
+        return
+    except Exception as e:
+        memory, error = None, str(e)
+
+    # If this process stalled past its lease the job was handed to another
+    # worker, which now owns the result
+    db.session.refresh(job)
+    if job.worker_id != WORKER_ID:
+        print(f"Ingestion job {job.id} was taken over by {job.worker_id}, dropping its result here")
+        return
+
+    now = datetime.utcnow()
+    if error:
+        print(f"Ingestion job {job.id} failed: {error}")
+        job.status = 'failed'
+        job.stage = 'failed'
+        job.error = error
+        # The memory never made it into the collection, so drop the upload
+        file_path = os.path.join(get_collection_documents_path(job.user_id, job.collection_id), job.saved_filename)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+    else:
+        job.status = 'completed'
+        job.stage = 'completed'
+        job.progress = 1.0
+        job.result = json.dumps(memory)
+        IngestionJobSegment.query.filter_by(job_id=job.id).delete(synchronize_session=False)
+    job.finished_at = now
+    job.updated_at = now
+    db.session.commit()
+
+def _heartbeat_loop(app):
+    while True:
+        time.sleep(JOB_HEARTBEAT_INTERVAL)
+        try:
+            with app.app_context():
+                IngestionJob.query.filter_by(status='running', worker_id=WORKER_ID).update(
+                    {"heartbeat_at": datetime.utcnow()},
+                    synchronize_session=False
+                )
+                db.session.commit()
+        except Exception as e:
+            print(f"Ingestion heartbeat error: {str(e)}")
+
+def _worker_loop(app):
+    while True:
+        job = None
+        try:
+            with app.app_context():
+                job = _claim_next_job()
+                if job is not None:
+                    _run_job(job)
+        except Exception as e:
+            print(f"Ingestion worker error: {str(e)}")
+            time.sleep(JOB_POLL_INTERVAL)
+            continue
+
+        if job is None:
+            with _job_available:
+                _job_available.wait(JOB_POLL_INTERVAL)
@@ -1,9 +1,35 @@
 from flask import Blueprint, request, jsonify
 from flask_login import login_required, current_user
-from services import get_collection, process_memory, allowed_file, detect_file_type, delete_memory
+from services import get_collection, get_collection_memory, get_memory_segments, save_memory_upload, allowed_file, detect_file_type, delete_memory, ALLOWED_EXTENSIONS
+from job_queue import enqueue_ingestion_job, get_ingestion_job, job_to_dict
 
 memory_bp = Blueprint('memory', __name__, url_prefix='/api/collections')
 
+# Diarization segments returned per page by the segments endpoint
+SEGMENTS_PAGE_SIZE = 200
+SEGMENTS_MAX_PAGE_SIZE = 1000
+
+# Most files accepted by one bulk import request
+BATCH_MAX_FILES = 500
+
+def get_memory_type(file, memory_type=None):
+    """Validate an upload's type, detecting it when not given.
+
+    Returns (memory_type, error).
+    """
+    if not memory_type:
+        memory_type = detect_file_type(file)
+        if not memory_type:
+            return None, "Could not determine file type. Please specify type parameter or use a supported file extension."
+    
+    if memory_type not in ['audio', 'pdf', 'text']:
+        return None, "Invalid memory type"
+    
+    if not allowed_file(file.filename, memory_type):
+        return None, f"Invalid file type. Allowed types for {memory_type}: {', '.join(ALLOWED_EXTENSIONS[memory_type])}"
+    
+    return memory_type, None
+
 @memory_bp.route('/<collection_id>/memories', methods=['POST'])
 @login_required
 def add_memory(collection_id):
@@ -23,32 +49,104 @@ def add_memory(collection_id):
     if file.filename == '':
         return jsonify({"success": False, "error": "No selected file"}), 400
     
-    if not memory_type:
-        memory_type = detect_file_type(file)
-        if not memory_type:
-            return jsonify({
-                "success": False, 
-                "error": "Could not determine file type. Please specify type parameter or use a supported file extension."
-            }), 400
+    memory_type, error = get_memory_type(file, memory_type)
+    if error:
+        return jsonify({"success": False, "error": error}), 400
     
-    if memory_type not in ['audio', 'pdf', 'text']:
-        return jsonify({"success": False, "error": "Invalid memory type"}), 400
+    # Transcription, extraction and embedding run in the background job queue
+    try:
+        memory_id, saved_filename, original_filename = save_memory_upload(current_user.id, collection_id, file)
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
     
-    if not allowed_file(file.filename, memory_type):
-        return jsonify({
-            "success": False, 
-            "error": f"Invalid file type. Allowed types for {memory_type}: {', '.join(ALLOWED_EXTENSIONS[memory_type])}"
-        }), 400
-    
-    memory, error = process_memory(current_user.id, collection_id, file, memory_type, title, description)
+    job, error = enqueue_ingestion_job(
+        current_user.id, collection_id, memory_id, saved_filename, original_filename,
+        memory_type, title, description
+    )
     
     if error:
         return jsonify({"success": False, "error": error}), 500
     
     return jsonify({
         "success": True,
-        "memory": memory,
+        "job": job_to_dict(job),
+        "status_url": f"/api/collections/{collection_id}/jobs/{job.id}",
         "detected_type": memory_type if not request.form.get('type') else None
+    }), 202
+
+@memory_bp.route('/<collection_id>/memories/batch', methods=['POST'])
+@login_required
+def add_memories_batch(collection_id):
+    collection = get_collection(current_user.id, collection_id)
+    if not collection:
+        return jsonify({"success": False, "error": "Collection not found"}), 404
+    
+    files = request.files.getlist('files')
+    if not files:
+        return jsonify({"success": False, "error": "No files provided"}), 400
+    if len(files) > BATCH_MAX_FILES:
+        return jsonify({"success": False, "error": f"At most {BATCH_MAX_FILES} files per request"}), 400
+    
+    # Optional: one type for all files, one title per file
+    requested_type = request.form.get('type')
+    titles = request.form.getlist('titles')
+    description = request.form.get('description', '')
+    
+    # Every file becomes its own ingestion job, and the jobs' adds are group
+    # committed as they finish. Rejected files don't fail the others.
+    jobs = []
+    rejected = []
+    for i, file in enumerate(files):
+        if file.filename == '':
+            rejected.append({"index": i, "filename": "", "error": "No selected file"})
+            continue
+        
+        memory_type, error = get_memory_type(file, requested_type)
+        if error:
+            rejected.append({"index": i, "filename": file.filename, "error": error})
+            continue
+        
+        title = titles[i] if i < len(titles) and titles[i] else file.filename.rsplit('.', 1)[0]
+        try:
+            memory_id, saved_filename, original_filename = save_memory_upload(current_user.id, collection_id, file)
+        except Exception as e:
+            rejected.append({"index": i, "filename": file.filename, "error": str(e)})
+            continue
+        
+        job, error = enqueue_ingestion_job(
+            current_user.id, collection_id, memory_id, saved_filename, original_filename,
+            memory_type, title, description
+        )
+        if error:
+            rejected.append({"index": i, "filename": file.filename, "error": error})
+            continue
+        
+        jobs.append({
+            "index": i,
+            "filename": file.filename,
+            "job": job_to_dict(job),
+            "status_url": f"/api/collections/{collection_id}/jobs/{job.id}"
+        })
+    
+    return jsonify({
+        "success": bool(jobs),
+        "jobs": jobs,
+        "rejected": rejected
+    }), 202 if jobs else 400
+
+@memory_bp.route('/<collection_id>/jobs/<job_id>', methods=['GET'])
+@login_required
+def get_job_status(collection_id, job_id):
+    job = get_ingestion_job(job_id, current_user.id)
+    if not job or job.collection_id != collection_id:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    
+    # Pollers pass the number of partial segments they already have
+    segments_since = request.args.get('segments_since', 0, type=int)
+    
+    return jsonify({
+        "success": True,
+        "job": job_to_dict(job, segments_since)
     })
 
 @memory_bp.route('/<collection_id>/memories/<memory_id>', methods=['GET'])
@@ -58,13 +156,7 @@ def get_memory(collection_id, memory_id):
     if not collection:
         return jsonify({"success": False, "error": "Collection not found"}), 404
     
-    # Find the specific memory in the collection
-    memory = None
-    for mem in collection.get("memories", []):
-        if mem["id"] == memory_id:
-            memory = mem
-            break
-    
+    memory = get_collection_memory(current_user.id, collection_id, memory_id)
     if not memory:
         return jsonify({"success": False, "error": "Memory not found"}), 404
     
@@ -73,6 +165,23 @@ def get_memory(collection_id, memory_id):
         "memory": memory
     })
 
+@memory_bp.route('/<collection_id>/memories/<memory_id>/segments', methods=['GET'])
+@login_required
+def get_segments(collection_id, memory_id):
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = min(max(1, request.args.get('limit', SEGMENTS_PAGE_SIZE, type=int)), SEGMENTS_MAX_PAGE_SIZE)
+    
+    page, error = get_memory_segments(current_user.id, collection_id, memory_id, offset, limit)
+    if error:
+        return jsonify({"success": False, "error": error}), 404
+    
+    return jsonify({
+        "success": True,
+        **page,
+        "limit": limit,
+        "next_offset": page["offset"] + len(page["segments"]) if page["offset"] + len(page["segments"]) < page["total"] else None
+    })
+
 @memory_bp.route('/<collection_id>/memories/<memory_id>', methods=['DELETE'])
 @login_required
 def delete_memory_route(collection_id, memory_id):
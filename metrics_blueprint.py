@@ -0,0 +1,21 @@
+from flask import Blueprint, jsonify
+from flask_login import login_required
+from index_cache import get_cache_stats
+from embedding_client import get_query_cache_stats
+from model_registry import get_model_stats
+from collection_locks import get_lock_stats
+from collection_writer import get_writer_stats
+
+metrics_bp = Blueprint('metrics', __name__, url_prefix='/api')
+
+@metrics_bp.route('/metrics', methods=['GET'])
+@login_required
+def get_metrics():
+    return jsonify({
+        "success": True,
+        "index_cache": get_cache_stats(),
+        "query_embedding_cache": get_query_cache_stats(),
+        "models": get_model_stats(),
+        "collection_locks": get_lock_stats(),
+        "collection_writer": get_writer_stats()
+    })
@@ -8,10 +8,10 @@ import re
 import threading
 import time
 import traceback
-import whisper  # Import the whisper library directly
 
 # Import the database functions
 from db_schema import get_model_status, set_model_status
+import model_registry
 
 model_download_bp = Blueprint('model_download', __name__)
 
@@ -32,10 +32,8 @@ current_progress = {
 }
 
 def get_model_path():
-    """Get the path to the model directory"""
-    # Use os.path.expanduser to get the user's home directory in a cross-platform way
-    home_dir = os.path.expanduser('~')
-    return os.path.join(home_dir, '.cache', 'whisper')
+    """Get the path to the model directory (shared with the model registry)"""
+    return model_registry.WHISPER_MODEL_DIR
 
 def check_model_files_exist():
     """
@@ -44,9 +42,7 @@ def check_model_files_exist():
     """
     try:
         # Define the expected file path
-        # Use os.path.expanduser to get the user's home directory in a cross-platform way
-        home_dir = os.path.expanduser('~')
-        whisper_cache_dir = os.path.join(home_dir, '.cache', 'whisper')
+        whisper_cache_dir = get_model_path()
         model_file_path = os.path.join(whisper_cache_dir, 'large-v3-turbo.pt')  # base model file
         
         # Check for other possible paths where the file might be
@@ -134,8 +130,7 @@ def monitor_download_progress():
     global current_progress
     
     # Expected model file path
-    home_dir = os.path.expanduser('~')
-    whisper_cache_dir = os.path.join(home_dir, '.cache', 'whisper')
+    whisper_cache_dir = get_model_path()
     model_file_path = os.path.join(whisper_cache_dir, 'large-v3-turbo.pt')
     temp_file_path = os.path.join(whisper_cache_dir, 'large-v3-turbo.pt.tmp')
     part_file_path = os.path.join(whisper_cache_dir, 'large-v3-turbo.pt.part')
@@ -251,7 +246,10 @@ def run_whisper_download():
         # Load the model, which will download it if not present
         # This will automatically download to the cache directory
 
-        model = whisper.load_model("turbo", download_root=get_model_path())     
+        # Loading through the registry downloads into the directory the
+        # pipeline loads from, and leaves the model warm for the first job
+        with model_registry.use_whisper_model("turbo"):
+            pass
 
         # If we get here, download was successful
         current_progress["status"] = "Completed"
@@ -441,4 +439,4 @@ def get_download_progress():
         'progress': 0.0,
         'percentage': 0,
         'details': 'Model needs to be downloaded'
-    })
\ No newline at end of file
+    })
\ No newline at end of file
@@ -0,0 +1,233 @@
+"""
+Lazily loaded speech models shared by the memory and upload pipelines.
+
+Nothing heavy is imported when this module is loaded: whisper and resemblyzer
+are imported the first time a model that needs them is requested.
+Models are keyed by (kind, name, device) and loaded at most once per process,
+so every caller that asks for the same Whisper size shares one copy of the
+weights (concurrent callers wait for the first load instead of loading their
+own).
+
+Callers hold a model for the duration of a job with the use_* context
+managers. A model nobody holds is unloaded after MODEL_IDLE_SECONDS, or
+earlier when loading another model would push the estimated weight memory
+past MODEL_MEMORY_BUDGET_BYTES.
+"""
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Unload models that have not been used for this long (0 disables)
+MODEL_IDLE_SECONDS = float(os.environ.get('MODEL_IDLE_SECONDS', 600))
+# Soft cap on the estimated size of loaded weights (0 means no cap)
+MODEL_MEMORY_BUDGET_BYTES = int(os.environ.get('MODEL_MEMORY_BUDGET_BYTES', 4 * 1024 * 1024 * 1024))
+# Where Whisper weights are downloaded and loaded from; model_download uses
+# the same directory, so a downloaded model is picked up by the pipeline
+WHISPER_MODEL_DIR = os.environ.get('WHISPER_MODEL_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'whisper'))
+WHISPER_DEVICE = os.environ.get('WHISPER_DEVICE')
+
+# Names whisper accepts for the same checkpoint
+WHISPER_ALIASES = {
+    "large-v3-turbo": "turbo",
+    "large": "large-v3",
+}
+
+# Modules whose import alone costs seconds; reported at startup so a
+# regression that pulls them in eagerly is visible in the log
+HEAVY_MODULES = ['torch', 'torchaudio', 'whisper', 'librosa', 'sklearn', 'resemblyzer', 'webrtcvad']
+
+_lock = threading.Lock()
+_key_locks = {}
+_entries = {}  # key -> {"model", "refs", "bytes", "last_used", "load_seconds"}
+_known_bytes = {}  # key -> size measured the last time it was loaded
+_stats = {
+    "loads": 0,
+    "evictions": 0,
+}
+_sweeper = None
+
+def _model_bytes(model):
+    """Estimate the memory held by a model's weights"""
+    try:
+        return sum(p.numel() * p.element_size() for p in model.parameters())
+    except AttributeError:
+        return 0
+
+def _unload(key):
+    """Drop an entry; must be called with _lock held"""
+    entry = _entries.pop(key)
+    _stats["evictions"] += 1
+    print(f"Unloaded {key[0]} model ({key[1]}, {key[2]}), freeing ~{entry['bytes'] / 1e6:.0f} MB")
+    if key[2].startswith('cuda') and 'torch' in sys.modules:
+        sys.modules['torch'].cuda.empty_cache()
+
+def _evict_for(incoming_bytes):
+    """Unload idle models, least recently used first, until the budget fits"""
+    if not MODEL_MEMORY_BUDGET_BYTES:
+        return
+    with _lock:
+        total = sum(entry["bytes"] for entry in _entries.values())
+        idle = sorted((entry["last_used"], key) for key, entry in _entries.items() if entry["refs"] == 0)
+        for _, key in idle:
+            if total + incoming_bytes <= MODEL_MEMORY_BUDGET_BYTES:
+                break
+            total -= _entries[key]["bytes"]
+            _unload(key)
+
+def evict_idle_models(max_idle=None):
+    """Unload every model nobody holds that has been idle for max_idle seconds"""
+    max_idle = MODEL_IDLE_SECONDS if max_idle is None else max_idle
+    now = time.time()
+    evicted = 0
+    with _lock:
+        for key in [k for k, e in _entries.items() if e["refs"] == 0 and now - e["last_used"] >= max_idle]:
+            _unload(key)
+            evicted += 1
+    return evicted
+
+def _sweep_loop():
+    while True:
+        time.sleep(max(1.0, min(60.0, MODEL_IDLE_SECONDS / 2)))
+        try:
+            evict_idle_models()
+        except Exception as e:
+            print(f"Error evicting idle models: {str(e)}")
+
+def _start_sweeper():
+    global _sweeper
+    if _sweeper is None and MODEL_IDLE_SECONDS > 0:
+        _sweeper = threading.Thread(target=_sweep_loop, name='model-evictor', daemon=True)
+        _sweeper.start()
+
+def _acquire(key, loader, hold):
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None:
+            entry["refs"] += hold
+            entry["last_used"] = time.time()
+            return entry["model"]
+        key_lock = _key_locks.setdefault(key, threading.Lock())
+
+    with key_lock:
+        with _lock:
+            entry = _entries.get(key)
+            if entry is not None:
+                entry["refs"] += hold
+                entry["last_used"] = time.time()
+                return entry["model"]
+
+        # Make room before loading when this model has been loaded before
+        _evict_for(_known_bytes.get(key, 0))
+
+        print(f"Loading {key[0]} model ({key[1]}, {key[2]})...")
+        started = time.perf_counter()
+        model = loader()
+        load_seconds = time.perf_counter() - started
+        size = _model_bytes(model)
+        print(f"Loaded {key[0]} model ({key[1]}, {key[2]}) in {load_seconds:.2f}s, ~{size / 1e6:.0f} MB")
+
+        _evict_for(size)
+        with _lock:
+            _entries[key] = {
+                "model": model,
+                "refs": hold,
+                "bytes": size,
+                "last_used": time.time(),
+                "load_seconds": load_seconds,
+            }
+            _known_bytes[key] = size
+            _stats["loads"] += 1
+        _start_sweeper()
+    return model
+
+def _release(key):
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None:
+            entry["refs"] -= 1
+            entry["last_used"] = time.time()
+
+@contextmanager
+def _use(key, loader):
+    model = _acquire(key, loader, 1)
+    try:
+        yield model
+    finally:
+        _release(key)
+
+def _resolve_device(device):
+    device = device or WHISPER_DEVICE
+    if device:
+        return device
+    import torch
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+def _whisper_key(size, device):
+    size = WHISPER_ALIASES.get(size, size)
+    return ("whisper", size, _resolve_device(device))
+
+def _whisper_loader(key):
+    def load():
+        import whisper
+        return whisper.load_model(key[1], device=key[2], download_root=WHISPER_MODEL_DIR)
+    return load
+
+def use_whisper_model(size="base", device=None):
+    """Context manager holding the shared Whisper model of the given size"""
+    key = _whisper_key(size, device)
+    return _use(key, _whisper_loader(key))
+
+def get_whisper_model(size="base", device=None):
+    """Get the shared Whisper model without holding it.
+
+    Prefer use_whisper_model for long-running work so the model is not
+    unloaded while it is still in use.
+    """
+    key = _whisper_key(size, device)
+    return _acquire(key, _whisper_loader(key), 0)
+
+def _load_voice_encoder():
+    from resemblyzer import VoiceEncoder
+    return VoiceEncoder()
+
+def use_voice_encoder():
+    """Context manager holding the shared resemblyzer speaker encoder"""
+    return _use(("voice_encoder", "default", "auto"), _load_voice_encoder)
+
+def get_voice_encoder():
+    """Get the shared resemblyzer speaker encoder without holding it"""
+    return _acquire(("voice_encoder", "default", "auto"), _load_voice_encoder, 0)
+
+def get_model_stats():
+    """List the loaded models with their holders, size and load time"""
+    with _lock:
+        now = time.time()
+        loaded = [
+            {
+                "kind": key[0],
+                "name": str(key[1]),
+                "device": key[2],
+                "refs": entry["refs"],
+                "bytes": entry["bytes"],
+                "idle_seconds": round(now - entry["last_used"], 1),
+                "load_seconds": round(entry["load_seconds"], 3),
+            }
+            for key, entry in _entries.items()
+        ]
+        return {
+            **_stats,
+            "loaded": loaded,
+            "bytes": sum(entry["bytes"] for entry in _entries.values()),
+            "max_bytes": MODEL_MEMORY_BUDGET_BYTES,
+            "idle_seconds": MODEL_IDLE_SECONDS,
+            "heavy_modules_imported": [name for name in HEAVY_MODULES if name in sys.modules],
+        }
+
+def report_startup(started_at):
+    """Print how long startup took and whether any heavy module was imported"""
+    elapsed = time.perf_counter() - started_at
+    imported = [name for name in HEAVY_MODULES if name in sys.modules]
+    print(f"Startup completed in {elapsed:.2f}s; heavy modules imported: {', '.join(imported) or 'none'}")
+    return elapsed
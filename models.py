@@ -52,6 +52,38 @@ class DiaryEntry(db.Model):
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
+class IngestionJob(db.Model):
+    id = db.Column(db.String(36), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    collection_id = db.Column(db.String(36), nullable=False)
+    memory_id = db.Column(db.String(36), nullable=False)
+    memory_type = db.Column(db.String(20), nullable=False)
+    title = db.Column(db.String(200), nullable=False)
+    description = db.Column(db.Text)
+    saved_filename = db.Column(db.String(255), nullable=False)
+    original_filename = db.Column(db.String(255))
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)  # queued, running, completed, failed
+    stage = db.Column(db.String(50))
+    progress = db.Column(db.Float, nullable=False, default=0.0)
+    result = db.Column(db.Text)  # JSON memory metadata once completed
+    error = db.Column(db.Text)
+    worker_id = db.Column(db.String(100))  # process running the job
+    heartbeat_at = db.Column(db.DateTime)  # refreshed by that process while it is alive
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class IngestionJobSegment(db.Model):
+    # Partial transcript of a running audio job, appended as chunks finish
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.String(36), db.ForeignKey('ingestion_job.id'), nullable=False)
+    position = db.Column(db.Integer, nullable=False)  # order within the job's transcript
+    start = db.Column(db.Float, nullable=False)
+    end = db.Column(db.Float, nullable=False)
+    text = db.Column(db.Text, nullable=False)
+    __table_args__ = (db.Index('ix_ingestion_job_segment_job_position', 'job_id', 'position'),)
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
\ No newline at end of file
@@ -0,0 +1,78 @@
+"""
+Columnar storage for the diarization segments of an audio memory.
+
+Segments live next to the memory's text as <memory_id>.segments.npz instead
+of inside its metadata, so listing collections never reads them. The file
+holds one array per field:
+
+    start, end       float64 seconds
+    speaker          int32 index into speakers
+    speakers         the distinct speaker labels, in order of appearance
+    text             UTF-8 bytes of every segment's text, concatenated
+    text_offsets     int64 byte offsets into text, one more than segments
+
+so a page of segments is a slice of each column.
+"""
+import numpy as np
+from collection_journal import replace_file
+
+def write_segments(path, segments):
+    """Write segment dicts (start, end, speaker, text) to path.
+
+    Returns the list of distinct speakers. The file is written to a temp
+    name, fsynced and renamed, so readers never see a partial file.
+    """
+    speakers = []
+    speaker_index = {}
+    speaker_ids = []
+    texts = []
+    for segment in segments:
+        speaker = segment.get("speaker") or ""
+        if speaker not in speaker_index:
+            speaker_index[speaker] = len(speakers)
+            speakers.append(speaker)
+        speaker_ids.append(speaker_index[speaker])
+        texts.append(segment.get("text", "").encode('utf-8'))
+
+    text_offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum([len(text) for text in texts], out=text_offsets[1:])
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(
+            f,
+            start=np.array([segment["start"] for segment in segments], dtype=np.float64),
+            end=np.array([segment["end"] for segment in segments], dtype=np.float64),
+            speaker=np.array(speaker_ids, dtype=np.int32),
+            speakers=np.array(speakers, dtype=np.str_),
+            text=np.frombuffer(b"".join(texts), dtype=np.uint8),
+            text_offsets=text_offsets
+        )
+    replace_file(tmp_path, path)
+    return speakers
+
+def read_segments(path, offset=0, limit=None):
+    """Read a page of segments, returning (segments, total)"""
+    with np.load(path, allow_pickle=False) as data:
+        total = len(data["start"])
+        offset = max(0, min(offset, total))
+        stop = total if limit is None else min(total, offset + max(0, limit))
+
+        starts = data["start"][offset:stop]
+        ends = data["end"][offset:stop]
+        speaker_ids = data["speaker"][offset:stop]
+        speakers = data["speakers"]
+        text_offsets = data["text_offsets"][offset:stop + 1]
+        text = data["text"][text_offsets[0]:text_offsets[-1]].tobytes() if stop > offset else b""
+
+    base = int(text_offsets[0]) if stop > offset else 0
+    segments = [
+        {
+            "start": float(starts[i]),
+            "end": float(ends[i]),
+            "speaker": str(speakers[speaker_ids[i]]),
+            "text": text[int(text_offsets[i]) - base:int(text_offsets[i + 1]) - base].decode('utf-8'),
+        }
+        for i in range(stop - offset)
+    ]
+    return segments, total
@@ -1,30 +1,60 @@
 import ollama
 import os
 import uuid
-import json
 import shutil
 import mimetypes
 import tempfile
 from datetime import datetime
 import numpy as np
 import faiss
-import whisper
 import fitz
 from werkzeug.utils import secure_filename
-
-# Initialize components
-whisper_model = whisper.load_model("tiny")
+from embedding_store import (append_rows, load_embeddings, write_embedding_store, recover_embedding_store,
+                             count_stored_vectors, compact_embedding_store)
+from index_cache import get_cached, bump_generation, invalidate_collection
+from chunking import chunk_text, get_chunk_text
+from embedding_client import embed_texts, embed_query
+from model_registry import use_whisper_model
+import collection_store
+import collection_journal
+import collection_locks
+import collection_writer
+import index_policy
+from segment_store import write_segments, read_segments
 
 # Constants
+# Whisper model used when diarization fails. Defaults to the diarization
+# model size so both paths share the same weights in the model registry
+TRANSCRIPTION_MODEL_SIZE = os.environ.get('WHISPER_MODEL_SIZE', 'base')
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 COLLECTIONS_DIR = os.path.join(BASE_DIR, 'collections')
 os.makedirs(COLLECTIONS_DIR, exist_ok=True)
+# Collection and memory metadata; defaults to collections.db in COLLECTIONS_DIR
+COLLECTION_DB = os.environ.get('COLLECTION_DB')
 TEMP_DIR = os.path.join(BASE_DIR, 'temp')
 os.makedirs(TEMP_DIR, exist_ok=True)
 
 # Embedding dimension for vector database
 EMBEDDING_DIMENSION = 768
 
+# Layout of a collection's FAISS index, recorded as "index_version" in its metadata
+#   1 - IndexFlatL2 whose row order matches collection["memories"]
+#   2 - IndexIDMap2 (or an IVF-PQ index holding its own IDs) keyed by get_memory_vector_id
+#   3 - as 2, with unit-length vectors from embedding_client
+INDEX_VERSION = 3
+
+# FAISS vector IDs are derived from the memory UUID. The low bits are left
+# free so a memory can own a contiguous block of vectors.
+VECTOR_ID_SLOT_BITS = 16
+
+# Share of a collection's embedding store that may be rows of deleted
+# memories before a delete compacts it
+EMBEDDING_COMPACT_FRACTION = float(os.environ.get('EMBEDDING_COMPACT_FRACTION', 0.25))
+
+# Journal entry ID of an in-progress index rebuild; deletes use the memory's
+# ID and group commits a random one
+REBUILD_JOURNAL_ID = 'rebuild'
+
 # Allowed file extensions
 ALLOWED_EXTENSIONS = {
     'audio': {'wav', 'mp3', 'ogg', 'm4a'},
@@ -80,21 +110,266 @@ def get_collection_path(user_id, collection_id):
     """Get the path for a specific collection"""
     return os.path.join(get_user_collections_dir(user_id), collection_id)
 
-def get_collection_metadata_path(user_id, collection_id):
-    """Get the metadata file path for a specific collection"""
-    return os.path.join(get_collection_path(user_id, collection_id), 'metadata.json')
+def get_collection_db():
+    """Get this thread's connection to the collection metadata store.
+
+    The first call in a process imports any legacy metadata.json files.
+    """
+    db_path = COLLECTION_DB or os.path.join(COLLECTIONS_DIR, 'collections.db')
+    conn = collection_store.connect(db_path)
+    collection_store.ensure_migrated(conn, db_path, [
+        lambda conn: collection_store.migrate_metadata_files(conn, COLLECTIONS_DIR),
+        move_inline_diarization_segments,
+        backfill_memory_sizes,
+    ])
+    return conn
+
+def get_collection_lock_path(user_id, collection_id):
+    """Get the file that locks a collection across processes.
+
+    Lock files live outside the collection and are never removed, not even
+    with it: another process may hold the lock or be about to open the file,
+    and a new file at the same path would be a different lock. They are
+    empty, so a deleted collection only leaves a zero-byte file behind.
+    """
+    return os.path.join(COLLECTIONS_DIR, '.locks', f'user_{user_id}', f'{collection_id}.lock')
+
+def collection_read_lock(user_id, collection_id):
+    """Hold a collection's lock shared while reading several of its files"""
+    return collection_locks.read_locked(
+        (str(user_id), collection_id), get_collection_lock_path(user_id, collection_id)
+    )
+
+def collection_write_lock(user_id, collection_id):
+    """Hold a collection's lock exclusively while changing it"""
+    return collection_locks.write_locked(
+        (str(user_id), collection_id), get_collection_lock_path(user_id, collection_id)
+    )
 
 def get_collection_index_path(user_id, collection_id):
     """Get the FAISS index path for a specific collection"""
     return os.path.join(get_collection_path(user_id, collection_id), 'index')
 
+def get_collection_deleted_ids_path(user_id, collection_id):
+    """Get the file of vector IDs tombstoned in a collection's HNSW index"""
+    return os.path.join(get_collection_path(user_id, collection_id), 'index.deleted')
+
 def get_collection_documents_path(user_id, collection_id):
     """Get the documents directory for a specific collection"""
     return os.path.join(get_collection_path(user_id, collection_id), 'documents')
 
+def get_memory_text_path(user_id, collection_id, memory_id):
+    """Get the extracted text file of a memory"""
+    return os.path.join(get_collection_documents_path(user_id, collection_id), f"{memory_id}.txt")
+
+def get_memory_segments_path(user_id, collection_id, memory_id):
+    """Get the diarization segments file of an audio memory"""
+    return os.path.join(get_collection_documents_path(user_id, collection_id), f"{memory_id}.segments.npz")
+
+def store_diarization_segments(user_id, collection_id, memory, segments):
+    """Write a memory's segments to its segments file and record a summary on the memory"""
+    speakers = write_segments(get_memory_segments_path(user_id, collection_id, memory["id"]), segments)
+    memory["has_diarization"] = True
+    memory["segment_count"] = len(segments)
+    memory["speakers"] = speakers
+
+def move_inline_diarization_segments(conn):
+    """Move segments still embedded in memory metadata into segments files"""
+    moved = 0
+    for user_id, collection_id, memory in list(collection_store.find_memories_with_field(conn, "diarization_segments")):
+        try:
+            segments = memory.pop("diarization_segments") or []
+            if os.path.isdir(get_collection_documents_path(user_id, collection_id)):
+                store_diarization_segments(user_id, collection_id, memory, segments)
+            collection_store.update_memory(conn, collection_id, memory)
+            moved += 1
+        except Exception as e:
+            print(f"Could not move diarization segments of memory {memory['id']}: {str(e)}")
+    if moved:
+        print(f"Moved diarization segments of {moved} memories out of the collection metadata")
+
+def get_memory_bytes(user_id, collection_id, memory):
+    """Total size of the files stored for a memory"""
+    memory_dir = get_collection_documents_path(user_id, collection_id)
+    paths = [
+        os.path.join(memory_dir, memory.get("filename") or ""),
+        os.path.join(memory_dir, f"{memory['id']}.txt"),
+        get_memory_segments_path(user_id, collection_id, memory["id"]),
+    ]
+    return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+def backfill_memory_sizes(conn):
+    """Measure memories stored before collection summaries tracked sizes"""
+    sizes = [
+        (memory["id"], get_memory_bytes(user_id, collection_id, memory))
+        for user_id, collection_id, memory in collection_store.find_memories_without_size(conn)
+    ]
+    if sizes:
+        collection_store.set_memory_sizes(conn, sizes)
+        collection_store.refresh_summaries(conn)
+        print(f"Recorded file sizes for {len(sizes)} memories")
+
+def get_memory_segments(user_id, collection_id, memory_id, offset=0, limit=None):
+    """Get a page of an audio memory's diarization segments.
+
+    Returns ({"segments", "total", "offset"}, error).
+    """
+    memory = get_collection_memory(user_id, collection_id, memory_id)
+    if not memory:
+        return None, "Memory not found"
+    
+    segments_path = get_memory_segments_path(user_id, collection_id, memory_id)
+    if not memory.get("has_diarization") or not os.path.exists(segments_path):
+        return {"segments": [], "total": 0, "offset": 0}, None
+    
+    try:
+        segments, total = read_segments(segments_path, offset, limit)
+    except Exception as e:
+        return None, str(e)
+    return {"segments": segments, "total": total, "offset": min(offset, total)}, None
+
+# Vector index functions
+def get_memory_vector_id(memory_id):
+    """Get the stable int64 FAISS ID for a memory UUID"""
+    return (uuid.UUID(memory_id).int >> (65 + VECTOR_ID_SLOT_BITS)) << VECTOR_ID_SLOT_BITS
+
+def get_memory_vector_id_range(memory_id):
+    """Get the half-open range of FAISS IDs owned by a memory"""
+    vector_id = get_memory_vector_id(memory_id)
+    return vector_id, vector_id + (1 << VECTOR_ID_SLOT_BITS)
+
+def get_vector_id_base(vector_id):
+    """Map any vector ID back to the base ID of the memory that owns it"""
+    return (int(vector_id) >> VECTOR_ID_SLOT_BITS) << VECTOR_ID_SLOT_BITS
+
+def get_memory_chunks(memory, memory_text=None):
+    """Get a memory's chunk offsets.
+
+    Memories indexed before chunking have a single vector for the whole text.
+    """
+    chunks = memory.get("chunks")
+    if chunks:
+        return chunks
+    return [[0, len(memory_text) if memory_text is not None else None]]
+
+def new_collection_index(policy=None):
+    """Create an empty ID-mapped FAISS index of the type policy starts with"""
+    return index_policy.build_index(index_policy.choose_index_type(0, policy), EMBEDDING_DIMENSION)
+
+def write_collection_index(user_id, collection_id, index):
+    """Atomically replace a collection's FAISS index file"""
+    collection_journal.write_file_atomic(
+        get_collection_index_path(user_id, collection_id),
+        lambda tmp_path: faiss.write_index(index, tmp_path)
+    )
+
+def read_deleted_vector_ids(user_id, collection_id):
+    """Vector IDs tombstoned in a collection's HNSW index"""
+    path = get_collection_deleted_ids_path(user_id, collection_id)
+    if not os.path.exists(path):
+        return np.empty(0, dtype='int64')
+    return np.fromfile(path, dtype='<i8')
+
+def write_deleted_vector_ids(user_id, collection_id, vector_ids):
+    """Atomically replace a collection's HNSW tombstones"""
+    collection_journal.write_file_atomic(
+        get_collection_deleted_ids_path(user_id, collection_id),
+        lambda tmp_path: np.asarray(vector_ids, dtype='<i8').tofile(tmp_path)
+    )
+
+def get_memory_vector_ids(index, memory_id):
+    """The vector IDs an index holds for a memory"""
+    start_id, end_id = get_memory_vector_id_range(memory_id)
+    ids = index_policy.get_vector_ids(index)
+    return ids[(ids >= start_id) & (ids < end_id)]
+
+def count_memory_vectors(index, memory_id):
+    """Count the vectors an index holds for a memory"""
+    return len(get_memory_vector_ids(index, memory_id))
+
+def load_collection_index(user_id, collection_id, collection=None):
+    """Load a collection's FAISS index, upgrading older layouts first.
+
+    Legacy row-ordered indexes have their vectors moved into the embedding
+    store (as long as the row count still matches the memories), and any index
+    below INDEX_VERSION is rebuilt from the store. Neither step calls the
+    embedding model. When collection is given, its "index_version" is updated
+    in place. The memories are only read when an upgrade is needed, so
+    collection may come without its "memories" list.
+    """
+    index_path = get_collection_index_path(user_id, collection_id)
+    with collection_read_lock(user_id, collection_id):
+        index = index_policy.configure_search(faiss.read_index(index_path))
+        if collection is None:
+            collection = collection_store.get_collection(get_collection_db(), user_id, collection_id, with_memories=False)
+    if not collection:
+        return index
+    
+    # IVF-PQ indexes hold their vector IDs without an ID map
+    is_id_mapped = isinstance(index, (faiss.IndexIDMap, faiss.IndexIVF))
+    version = collection.get("index_version", 2 if is_id_mapped else 1)
+    if version >= INDEX_VERSION:
+        return index
+    
+    with collection_write_lock(user_id, collection_id):
+        # Another thread may have finished the upgrade while this one waited
+        current = collection_store.get_collection(get_collection_db(), user_id, collection_id, with_memories=False)
+        if current and current.get("index_version", 0) >= INDEX_VERSION:
+            collection["index_version"] = current["index_version"]
+            return index_policy.configure_search(faiss.read_index(index_path))
+        index = faiss.read_index(index_path)
+        
+        if "memories" not in collection:
+            collection["memories"] = collection_store.list_memories(get_collection_db(), collection_id)
+        memories = collection["memories"]
+        if not is_id_mapped:
+            if index.ntotal == len(memories):
+                print(f"Moving legacy index vectors for collection {collection_id} into the embedding store")
+                write_embedding_store(
+                    get_collection_path(user_id, collection_id),
+                    np.array([get_memory_vector_id(m["id"]) for m in memories], dtype='int64'),
+                    [m["id"] for m in memories],
+                    index.reconstruct_n(0, index.ntotal) if memories else [],
+                    EMBEDDING_DIMENSION
+                )
+            else:
+                print(f"Legacy index for collection {collection_id} has {index.ntotal} vectors "
+                      f"for {len(memories)} memories, missing vectors will be re-embedded")
+        
+        print(f"Upgrading index for collection {collection_id} from version {version} to {INDEX_VERSION}")
+        rebuild_collection_index(user_id, collection_id, collection)
+        return index_policy.configure_search(faiss.read_index(index_path))
+
+def load_collection_searcher(user_id, collection_id):
+    """Load a collection's index with its HNSW tombstones or IVF-PQ re-rank vectors"""
+    index = load_collection_index(user_id, collection_id)
+    deleted_ids = vectors = vector_ids = None
+    with collection_read_lock(user_id, collection_id):
+        index_type = index_policy.get_index_type(index)
+        if index_type == "hnsw":
+            deleted_ids = read_deleted_vector_ids(user_id, collection_id)
+        elif index_type == "ivfpq":
+            vectors, vector_ids, _ = load_embeddings(get_collection_path(user_id, collection_id), EMBEDDING_DIMENSION)
+    return index_policy.IndexSearcher(index, deleted_ids, vectors, vector_ids)
+
+def get_collection_searcher(user_id, collection_id):
+    """Get a searcher over a collection's FAISS index from the in-process cache.
+
+    The returned searcher is shared between requests and must only be searched.
+    """
+    return get_cached(
+        'index', user_id, collection_id,
+        get_collection_index_path(user_id, collection_id),
+        lambda path: load_collection_searcher(user_id, collection_id),
+        lambda path, searcher: searcher.nbytes()
+    )
+
 # Collection Management Functions
-def create_collection(user_id, name, description=""):
-    """Create a new collection with unique ID"""
+def create_collection(user_id, name, description="", policy="auto"):
+    """Create a new collection with unique ID.
+
+    policy is the collection's index policy, one of index_policy.INDEX_POLICIES.
+    """
     collection_id = str(uuid.uuid4())
     
     # Ensure user directory exists
@@ -107,55 +382,99 @@ def create_collection(user_id, name, description=""):
     os.makedirs(collection_path, exist_ok=True)
     os.makedirs(get_collection_documents_path(user_id, collection_id), exist_ok=True)
     
-    # Create metadata file
     metadata = {
         "id": collection_id,
         "user_id": user_id,
         "name": name,
         "description": description,
         "created_at": datetime.now().isoformat(),
+        "index_version": INDEX_VERSION,
+        "index_policy": policy,
         "memories": []
     }
     
-    with open(get_collection_metadata_path(user_id, collection_id), 'w') as f:
-        json.dump(metadata, f)
+    # Initialize empty FAISS index before the collection becomes visible
+    write_collection_index(user_id, collection_id, new_collection_index(policy))
     
-    # Initialize empty FAISS index
-    index = faiss.IndexFlatL2(EMBEDDING_DIMENSION)
-    faiss.write_index(index, get_collection_index_path(user_id, collection_id))
+    collection_store.insert_collection(get_collection_db(), user_id, metadata)
     
     return collection_id, metadata
 
 def get_all_collections(user_id):
-    """Get list of all collections for a specific user"""
-    collections = []
-    user_collections_dir = get_user_collections_dir(user_id)
-    
-    if not os.path.exists(user_collections_dir):
-        return collections
-    
-    for collection_id in os.listdir(user_collections_dir):
-        metadata_path = get_collection_metadata_path(user_id, collection_id)
-        if os.path.exists(metadata_path):
-            with open(metadata_path, 'r') as f:
-                collections.append(json.load(f))
-    return collections
+    """Get summaries of all collections for a specific user.
+
+    Each entry has the collection's fields plus memory_count, document_bytes
+    and updated_at, but not its memories. The list comes from the in-process
+    cache and must not be modified.
+    """
+    conn = get_collection_db()
+    return get_cached(
+        'collections', user_id, '',
+        None,
+        lambda path: collection_store.list_collection_summaries(conn, user_id),
+        lambda path, summaries: 500 * len(summaries) + 100,
+        version=collection_store.get_user_version(conn, user_id)
+    )
+
+def read_collection_metadata(user_id, collection_id):
+    """Read collection metadata from the store, bypassing the cache.
+
+    Returns a fresh dict the caller may modify, or None.
+    """
+    return collection_store.get_collection(get_collection_db(), user_id, collection_id)
 
 def get_collection(user_id, collection_id):
-    """Get collection metadata by ID"""
-    metadata_path = get_collection_metadata_path(user_id, collection_id)
-    if os.path.exists(metadata_path):
-        with open(metadata_path, 'r') as f:
-            return json.load(f)
-    return None
+    """Get collection metadata by ID.
+
+    The result comes from the in-process cache and is shared between requests,
+    so callers must not modify it.
+    """
+    conn = get_collection_db()
+    return get_cached(
+        'metadata', user_id, collection_id,
+        None,
+        lambda path: read_collection_metadata(user_id, collection_id),
+        lambda path, metadata: collection_store.get_collection_bytes(conn, collection_id),
+        version=collection_store.get_generation(conn, user_id, collection_id)
+    )
+
+def get_collection_vector_memory_ids(user_id, collection_id):
+    """Map each memory's base vector ID to the memory ID, or None if there is no collection.
+
+    Cached per collection generation and shared between requests, so callers
+    must not modify it.
+    """
+    conn = get_collection_db()
+    return get_cached(
+        'vector_memory_ids', user_id, collection_id,
+        None,
+        lambda path: {
+            get_memory_vector_id(memory_id): memory_id
+            for memory_id in collection_store.list_memory_ids(conn, collection_id)
+        },
+        lambda path, memory_ids: 100 * len(memory_ids) + 100,
+        version=collection_store.get_generation(conn, user_id, collection_id)
+    )
+
+def get_collection_memory(user_id, collection_id, memory_id):
+    """Look up a single memory's metadata by ID, or None"""
+    conn = get_collection_db()
+    if collection_store.get_generation(conn, user_id, collection_id) is None:
+        return None
+    return collection_store.get_memory(conn, collection_id, memory_id)
 
 def delete_collection(user_id, collection_id):
     """Delete a collection and all its data"""
-    collection_path = get_collection_path(user_id, collection_id)
-    if os.path.exists(collection_path):
-        shutil.rmtree(collection_path)
-        return True
-    return False
+    # Wait for in-flight writes, which then find the collection gone
+    with collection_write_lock(user_id, collection_id):
+        deleted = collection_store.delete_collection(get_collection_db(), user_id, collection_id)
+        collection_path = get_collection_path(user_id, collection_id)
+        if os.path.exists(collection_path):
+            shutil.rmtree(collection_path)
+            deleted = True
+        if deleted:
+            invalidate_collection(user_id, collection_id)
+    return deleted
 
 # Memory Processing Functions
 def extract_text_from_pdf(pdf_path):
@@ -170,23 +489,58 @@ def extract_text_from_pdf(pdf_path):
         print(f"Error extracting text from PDF: {e}")
         return ""
 
+def save_memory_upload(user_id, collection_id, file):
+    """Save an uploaded file into a collection's documents directory.
+
+    Returns (memory_id, saved_filename, original_filename).
+    """
+    # Create a unique ID for the memory
+    memory_id = str(uuid.uuid4())
+    
+    # Save the original file
+    filename = secure_filename(file.filename)
+    file_ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    saved_filename = f"{memory_id}.{file_ext}"
+    memory_dir = get_collection_documents_path(user_id, collection_id)
+    file.save(os.path.join(memory_dir, saved_filename))
+    
+    return memory_id, saved_filename, filename
+
 def process_memory(user_id, collection_id, file, memory_type, title, description=""):
     """Process a new memory and add it to the collection"""
-    collection = get_collection(user_id, collection_id)
-    if not collection:
+    if not get_collection(user_id, collection_id):
         return None, "Collection not found"
     
     try:
-        # Create a unique ID for the memory
-        memory_id = str(uuid.uuid4())
-        
-        # Save the original file
-        filename = secure_filename(file.filename)
-        file_ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
-        saved_filename = f"{memory_id}.{file_ext}"
+        memory_id, saved_filename, filename = save_memory_upload(user_id, collection_id, file)
+    except Exception as e:
+        return None, str(e)
+    
+    return ingest_memory(user_id, collection_id, memory_id, saved_filename, filename, memory_type, title, description)
+
+def ingest_memory(user_id, collection_id, memory_id, saved_filename, original_filename,
+                  memory_type, title, description="", progress=None):
+    """Extract, embed and index a memory whose file is already saved in the collection.
+
+    progress, if given, is called as progress(stage, fraction) between steps,
+    and as progress("transcribing", fraction, segments) with each batch of
+    partial transcript segments while an audio memory is transcribed.
+    """
+    if progress is None:
+        progress = lambda stage, fraction, segments=None: None
+    if not get_collection(user_id, collection_id):
+        return None, "Collection not found"
+    
+    # A job requeued after a crash may find its memory already committed
+    existing = collection_store.get_memory(get_collection_db(), collection_id, memory_id)
+    if existing:
+        return existing, None
+    
+    try:
+        filename = original_filename
         memory_dir = get_collection_documents_path(user_id, collection_id)
         file_path = os.path.join(memory_dir, saved_filename)
-        file.save(file_path)
+        progress("extracting", 0.05)
         
         # Extract text based on memory type
         memory_text = ""
@@ -197,8 +551,11 @@ def process_memory(user_id, collection_id, file, memory_type, title, description
                 # Try using the advanced diarization functionality
                 from upload_blueprint import process_audio_file_with_diarization
                 
+                def on_segments(segments, fraction):
+                    progress("transcribing", 0.05 + 0.45 * fraction, segments)
+                
                 print(f"Processing audio with diarization: {file_path}")
-                diarization_result = process_audio_file_with_diarization(file_path)
+                diarization_result = process_audio_file_with_diarization(file_path, on_segments=on_segments)
                 
                 if "error" in diarization_result:
                     # If diarization had an error but returned transcript
@@ -216,7 +573,8 @@ def process_memory(user_id, collection_id, file, memory_type, title, description
             except Exception as e:
                 # Fallback to original Whisper transcription
                 print(f"Diarization failed, falling back to basic transcription: {str(e)}")
-                result = whisper_model.transcribe(file_path)
+                with use_whisper_model(TRANSCRIPTION_MODEL_SIZE) as whisper_model:
+                    result = whisper_model.transcribe(file_path)
                 memory_text = result["text"]
         
         elif memory_type == 'pdf':
@@ -238,74 +596,244 @@ def process_memory(user_id, collection_id, file, memory_type, title, description
             "created_at": datetime.now().isoformat(),
         }
         
-        # Add diarization data if available
-        if memory_type == 'audio' and diarization_data:
-            memory_metadata["has_diarization"] = True
-            memory_metadata["diarization_segments"] = diarization_data
+        # Split the text into overlapping windows and embed each one
+        progress("embedding", 0.6)
+        chunks = chunk_text(memory_text)
+        memory_metadata["chunks"] = chunks
         
-        # Generate embedding for memory text
         try:
-            response = ollama.embeddings(model="nomic-embed-text", prompt=memory_text)
-            embedding = response["embedding"]
+            embeddings = embed_texts([get_chunk_text(memory_text, chunk) for chunk in chunks])
         except Exception as e:
             return None, f"Error generating embedding: {e}"
         
-        # Save text content
-        text_path = os.path.join(memory_dir, f"{memory_id}.txt")
-        with open(text_path, 'w', encoding='utf-8') as f:
-            f.write(memory_text)
+        progress("indexing", 0.9)
+        return commit_memory(
+            user_id, collection_id, memory_metadata, memory_text, embeddings,
+            diarization_data if memory_type == 'audio' else None
+        )
+    
+    except Exception as e:
+        return None, str(e)
+
+def commit_memory(user_id, collection_id, memory_metadata, memory_text, embeddings, segments=None):
+    """Write a processed memory into its collection.
+
+    The memory joins the collection's next group commit, so adds that finish
+    together share one index write and one metadata transaction. Returns
+    (memory_metadata, error).
+    """
+    return collection_writer.submit(
+        (str(user_id), collection_id),
+        (memory_metadata, memory_text, embeddings, segments),
+        lambda items: commit_memories(user_id, collection_id, items),
+        lambda: collection_write_lock(user_id, collection_id)
+    )
+
+def commit_memories(user_id, collection_id, items):
+    """Write processed memories into their collection as one journaled change.
+
+    items are (memory_metadata, memory_text, embeddings, segments) tuples.
+    Returns one (memory_metadata, error) per item. If the batch fails, its
+    memories are retried one at a time so one bad memory does not fail the
+    others.
+    """
+    with collection_write_lock(user_id, collection_id):
+        # Re-check the collection now, since extraction may have taken minutes
+        conn = get_collection_db()
+        collection = collection_store.get_collection(conn, user_id, collection_id, with_memories=False)
+        if not collection:
+            return [(None, "Collection not found")] * len(items)
         
-        # Update collection's FAISS index
-        index = faiss.read_index(get_collection_index_path(user_id, collection_id))
-        index.add(np.array([embedding]).astype('float32'))
-        faiss.write_index(index, get_collection_index_path(user_id, collection_id))
+        results = [None] * len(items)
+        new = []
+        for i, item in enumerate(items):
+            existing = collection_store.get_memory(conn, collection_id, item[0]["id"])
+            if existing:
+                results[i] = (existing, None)
+            else:
+                new.append(i)
+        if not new:
+            return results
         
-        # Update collection metadata
-        collection["memories"].append(memory_metadata)
-        with open(get_collection_metadata_path(user_id, collection_id), 'w') as f:
-            json.dump(collection, f)
+        try:
+            _write_memories(user_id, collection_id, collection, [items[i] for i in new])
+            for i in new:
+                results[i] = (items[i][0], None)
+        except Exception as e:
+            if len(new) == 1:
+                results[new[0]] = (None, str(e))
+            else:
+                print(f"Group commit of {len(new)} memories to collection {collection_id} failed, "
+                      f"committing them one at a time: {str(e)}")
+                for i in new:
+                    results[i] = commit_memories(user_id, collection_id, [items[i]])[0]
+        return results
+
+def _write_memories(user_id, collection_id, collection, items):
+    """Store and index new memories; the collection's write lock must be held"""
+    # Journal the change before writing anything, so a crash part way
+    # through is rolled back on the next start
+    collection_path = get_collection_path(user_id, collection_id)
+    entry_id = uuid.uuid4().hex
+    entry = {
+        "op": "add_memories",
+        "memories": [{"memory_id": item[0]["id"], "filename": item[0]["filename"]} for item in items]
+    }
+    collection_journal.begin(collection_path, entry_id, entry)
+    try:
+        vector_ids = []
+        memory_ids = []
+        vectors = []
+        for memory_metadata, memory_text, embeddings, segments in items:
+            memory_id = memory_metadata["id"]
+            
+            # Keep diarization segments in their own file, out of the metadata
+            if segments:
+                store_diarization_segments(user_id, collection_id, memory_metadata, segments)
+            
+            # Save text content
+            collection_journal.write_text_atomic(get_memory_text_path(user_id, collection_id, memory_id), memory_text)
+            
+            chunk_count = len(memory_metadata["chunks"])
+            base_vector_id = get_memory_vector_id(memory_id)
+            vector_ids.append(np.arange(base_vector_id, base_vector_id + chunk_count, dtype='int64'))
+            memory_ids.extend([memory_id] * chunk_count)
+            vectors.append(np.asarray(embeddings, dtype='float32').reshape(chunk_count, EMBEDDING_DIMENSION))
+        
+        vector_ids = np.concatenate(vector_ids)
+        vectors = np.concatenate(vectors)
+        
+        # Keep the raw vectors so rebuilds never need to call the model again
+        append_rows(collection_path, vector_ids, memory_ids, vectors, EMBEDDING_DIMENSION)
         
-        return memory_metadata, None
+        # Update collection's FAISS index once for the whole batch
+        index = load_collection_index(user_id, collection_id, collection)
+        index.add_with_ids(vectors, vector_ids)
+        write_collection_index(user_id, collection_id, index)
+        
+        # Update collection metadata and its summary; this commit is what
+        # makes the memories part of the collection
+        collection_store.add_memories(get_collection_db(), collection_id, [
+            (item[0], get_memory_bytes(user_id, collection_id, item[0])) for item in items
+        ])
+    except Exception:
+        recover_journal_entry(user_id, collection_id, entry_id, entry)
+        raise
+    collection_journal.commit(collection_path, entry_id)
+    bump_generation(user_id, collection_id)
     
+    # The memories are committed either way; a failed promotion is retried
+    # on the next add
+    try:
+        update_index_type(user_id, collection_id, collection, index)
+    except Exception as e:
+        print(f"Could not change the index type of collection {collection_id}: {str(e)}")
+
+def update_index_type(user_id, collection_id, collection=None, index=None):
+    """Rebuild a collection's index if its size or policy calls for another type.
+
+    Returns the index type the collection now uses.
+    """
+    with collection_write_lock(user_id, collection_id):
+        if collection is None:
+            collection = collection_store.get_collection(get_collection_db(), user_id, collection_id, with_memories=False)
+        if index is None:
+            index = load_collection_index(user_id, collection_id, collection)
+        
+        current = index_policy.get_index_type(index)
+        wanted = index_policy.choose_index_type(index.ntotal, collection.get("index_policy"))
+        if wanted == current:
+            return current
+        
+        print(f"Switching the index of collection {collection_id} from {current} to {wanted} "
+              f"at {index.ntotal} vectors")
+        rebuild_collection_index(user_id, collection_id)
+        return wanted
+
+def set_collection_index_policy(user_id, collection_id, policy):
+    """Change a collection's index policy, rebuilding its index if needed.
+
+    Returns (index_type, error).
+    """
+    if policy not in index_policy.INDEX_POLICIES:
+        return None, f"Index policy must be one of: {', '.join(index_policy.INDEX_POLICIES)}"
+    
+    try:
+        with collection_write_lock(user_id, collection_id):
+            conn = get_collection_db()
+            if collection_store.get_generation(conn, user_id, collection_id) is None:
+                return None, "Collection not found"
+            collection_store.set_collection_fields(conn, collection_id, {"index_policy": policy})
+            bump_generation(user_id, collection_id)
+            return update_index_type(user_id, collection_id), None
     except Exception as e:
         return None, str(e)
 
 # Chat and Query Functions
 def query_collection(user_id, collection_id, query_text, top_k=3):
-    """Query a collection with a question and get relevant memories"""
-    collection = get_collection(user_id, collection_id)
-    if not collection or not collection.get("memories"):
+    """Query a collection with a question and get the best-matching chunks.
+
+    Each result carries the chunk text as its content, so several results may
+    come from the same memory.
+    """
+    memory_ids = get_collection_vector_memory_ids(user_id, collection_id)
+    if not memory_ids:
         return [], "Collection not found or empty"
     
     try:
         # Generate embedding for the query
-        response = ollama.embeddings(model="nomic-embed-text", prompt=query_text)
-        query_embedding = np.array([response["embedding"]]).astype('float32')
+        query_embedding = embed_query(query_text).reshape(1, -1)
         
         # Load FAISS index
-        index = faiss.read_index(get_collection_index_path(user_id, collection_id))
+        searcher = get_collection_searcher(user_id, collection_id)
         
-        # Get top k most similar memories
-        k = min(top_k, len(collection["memories"]))
-        distances, indices = index.search(query_embedding, k)
+        # Get top k most similar chunks
+        k = min(top_k, searcher.ntotal)
+        if k == 0:
+            return [], None
+        distances, vector_ids = searcher.search(query_embedding, k)
         
-        # Retrieve memory content for each match
+        # Retrieve chunk content for each match, loading only the memories hit
+        conn = get_collection_db()
         memory_dir = get_collection_documents_path(user_id, collection_id)
+        memories = {}
+        memory_texts = {}
         relevant_memories = []
         
         for i in range(k):
-            memory_index = indices[0][i]
-            memory_metadata = collection["memories"][memory_index]
+            vector_id = int(vector_ids[0][i])
+            base_vector_id = get_vector_id_base(vector_id)
+            memory_id = memory_ids.get(base_vector_id)
+            if memory_id is not None and memory_id not in memories:
+                memories[memory_id] = collection_store.get_memory(conn, collection_id, memory_id)
+            memory_metadata = memories.get(memory_id)
+            if memory_metadata is None:
+                # Padding (-1) or a vector whose memory has been removed
+                continue
             
             # Get text content
-            text_path = os.path.join(memory_dir, f"{memory_metadata['id']}.txt")
-            with open(text_path, 'r', encoding='utf-8') as f:
-                content = f.read()
+            if memory_id not in memory_texts:
+                text_path = os.path.join(memory_dir, f"{memory_id}.txt")
+                with open(text_path, 'r', encoding='utf-8') as f:
+                    memory_texts[memory_id] = f.read()
+            memory_text = memory_texts[memory_id]
+            
+            chunks = get_memory_chunks(memory_metadata, memory_text)
+            chunk_index = vector_id - base_vector_id
+            if chunk_index >= len(chunks):
+                continue
+            chunk = chunks[chunk_index]
             
             relevant_memories.append({
                 "metadata": memory_metadata,
-                "content": content,
-                "distance": float(distances[0][i])
+                "content": get_chunk_text(memory_text, chunk),
+                "distance": float(distances[0][i]),
+                "chunk": {
+                    "index": chunk_index,
+                    "count": len(chunks),
+                    "start": chunk[0],
+                    "end": chunk[1]
+                }
             })
         
         return relevant_memories, None
@@ -313,19 +841,17 @@ def query_collection(user_id, collection_id, query_text, top_k=3):
     except Exception as e:
         return [], str(e)
 
-def generate_response(query, relevant_memories):
-    """Generate a response based on relevant memories"""
-    if not relevant_memories:
-        return "I don't have any relevant memories to answer your question."
-    
+def build_response_prompt(query, relevant_memories):
+    """Build the LLM prompt for answering a query from relevant memories"""
     # Combine memory contents for context
     context = ""
     for memory in relevant_memories:
-        context += f"Memory: {memory['metadata']['title']} (originally '{memory['metadata'].get('original_filename', 'unknown')}', type: {memory['metadata']['type']})\n{memory['content']}\n\n"
+        excerpt = ""
+        if memory.get("chunk") and memory["chunk"]["count"] > 1:
+            excerpt = f", excerpt {memory['chunk']['index'] + 1} of {memory['chunk']['count']}"
+        context += f"Memory: {memory['metadata']['title']} (originally '{memory['metadata'].get('original_filename', 'unknown')}', type: {memory['metadata']['type']}{excerpt})\n{memory['content']}\n\n"
     
-    try:
-        # Use local LLM to generate response
-        prompt = f"""
+    return f"""
         You are an AI assistant that helps users interact with their personal memories.
         Based on the following memories and the user's question, provide a helpful response.
         
@@ -339,6 +865,15 @@ def generate_response(query, relevant_memories):
         
         Your response:
         """
+
+def generate_response(query, relevant_memories):
+    """Generate a response based on relevant memories"""
+    if not relevant_memories:
+        return "I don't have any relevant memories to answer your question."
+    
+    try:
+        # Use local LLM to generate response
+        prompt = build_response_prompt(query, relevant_memories)
         
         output = ollama.generate(
             model="llama3",  # Using a lightweight model - can be changed based on available models
@@ -351,21 +886,32 @@ def generate_response(query, relevant_memories):
         print(f"Error generating response: {e}")
         return f"I had trouble processing your question. Technical error: {str(e)}"
 
+def generate_response_stream(query, relevant_memories):
+    """Generate a response like generate_response, yielding text as the LLM produces it"""
+    if not relevant_memories:
+        yield "I don't have any relevant memories to answer your question."
+        return
+    
+    yield from stream_llm_response(build_response_prompt(query, relevant_memories))
+
+def stream_llm_response(prompt):
+    """Yield response text pieces from a streaming llama3 generation"""
+    try:
+        for part in ollama.generate(model="llama3", prompt=prompt, stream=True):
+            if part.get('response'):
+                yield part['response']
+    except Exception as e:
+        print(f"Error generating response: {e}")
+        yield f"I had trouble processing your question. Technical error: {str(e)}"
+
 def query_specific_memory(user_id, collection_id, memory_id, query_text):
     """Query a specific memory with a question"""
     print(f"DEBUG: Starting query_specific_memory for memory_id={memory_id}")
-    collection = get_collection(user_id, collection_id)
-    if not collection:
+    if not get_collection(user_id, collection_id):
         print("DEBUG: Collection not found")
         return None, "Collection not found"
     
-    # Find the specific memory in the collection
-    memory_metadata = None
-    for mem in collection.get("memories", []):
-        if mem["id"] == memory_id:
-            memory_metadata = mem
-            break
-    
+    memory_metadata = get_collection_memory(user_id, collection_id, memory_id)
     if not memory_metadata:
         print("DEBUG: Memory not found")
         return None, "Memory not found"
@@ -398,76 +944,317 @@ def query_specific_memory(user_id, collection_id, memory_id, query_text):
 def delete_memory(user_id, collection_id, memory_id):
     """Delete a memory from a collection"""
     try:
-        # Get the collection
-        collection = get_collection(user_id, collection_id)
-        if not collection:
+        conn = get_collection_db()
+        if collection_store.get_generation(conn, user_id, collection_id) is None:
             return False, "Collection not found"
         
-        # Find the memory in the collection
-        memory_index = None
-        for i, memory in enumerate(collection.get("memories", [])):
-            if memory["id"] == memory_id:
-                memory_index = i
-                break
-        
-        if memory_index is None:
-            return False, "Memory not found"
-        
-        # Remove the memory from collection metadata
-        memory = collection["memories"].pop(memory_index)
-        
-        # Delete the memory files from disk
-        memory_dir = get_collection_documents_path(user_id, collection_id)
-        
-        # Delete the original file
-        original_file = os.path.join(memory_dir, memory["filename"])
-        if os.path.exists(original_file):
-            os.remove(original_file)
-        
-        # Delete the text content file
-        text_file = os.path.join(memory_dir, f"{memory_id}.txt")
-        if os.path.exists(text_file):
-            os.remove(text_file)
-        
-        # Save the updated collection metadata
-        with open(get_collection_metadata_path(user_id, collection_id), 'w') as f:
-            json.dump(collection, f)
-        
-        # Update FAISS index
-        # This is more complex as you'd need to rebuild the index without the deleted embedding
-        # For simplicity, you might want to just rebuild the entire index
-        rebuild_collection_index(user_id, collection_id)
+        with collection_write_lock(user_id, collection_id):
+            memory = collection_store.get_memory(conn, collection_id, memory_id)
+            if memory is None:
+                return False, "Memory not found"
+            
+            # Drop the memory's vectors before the metadata changes, so a legacy
+            # row-ordered index can still be upgraded with the right IDs
+            index = load_collection_index(user_id, collection_id)
+            
+            # Once journaled, the delete is finished on the next start even if
+            # the process dies part way through
+            collection_path = get_collection_path(user_id, collection_id)
+            entry = {"op": "delete_memory", "memory_id": memory_id, "filename": memory["filename"]}
+            collection_journal.begin(collection_path, memory_id, entry)
+            try:
+                _apply_memory_delete(user_id, collection_id, memory_id, memory["filename"], index)
+            except Exception:
+                recover_journal_entry(user_id, collection_id, memory_id, entry)
+                raise
+            collection_journal.commit(collection_path, memory_id)
+            bump_generation(user_id, collection_id)
+            
+            # The memory is gone either way; a failed compaction is retried
+            # on the next delete
+            try:
+                live_vectors = index.ntotal
+                if index_policy.get_index_type(index) == "hnsw":
+                    live_vectors -= len(read_deleted_vector_ids(user_id, collection_id))
+                compact_collection_embeddings(user_id, collection_id, live_vectors)
+            except Exception as e:
+                print(f"Could not compact the embedding store of collection {collection_id}: {str(e)}")
         
         return True, None
     except Exception as e:
         return False, str(e)
 
-def rebuild_collection_index(user_id, collection_id):
-    """Rebuild the FAISS index for a collection"""
-    collection = get_collection(user_id, collection_id)
+def compact_collection_embeddings(user_id, collection_id, live_vectors):
+    """Drop deleted memories' rows from the embedding store once there are enough.
+
+    live_vectors is how many vectors the collection's index holds. Returns
+    the number of rows removed.
+    """
+    collection_path = get_collection_path(user_id, collection_id)
+    stored = count_stored_vectors(collection_path, EMBEDDING_DIMENSION)
+    if stored == 0 or stored - live_vectors <= stored * EMBEDDING_COMPACT_FRACTION:
+        return 0
+    
+    with collection_write_lock(user_id, collection_id):
+        live_memory_ids = [memory["id"] for memory in collection_store.list_memories(get_collection_db(), collection_id)]
+        removed = compact_embedding_store(collection_path, EMBEDDING_DIMENSION, live_memory_ids)
+    if removed:
+        print(f"Compacted the embedding store of collection {collection_id}: {removed} rows removed")
+    return removed
+
+def _remove_memory_files(user_id, collection_id, memory_id, filename, keep_upload=False):
+    """Delete a memory's files, optionally keeping the original upload.
+
+    A text upload is saved under the same name as the extracted text, so
+    keeping the upload keeps that file too.
+    """
+    paths = [get_memory_text_path(user_id, collection_id, memory_id),
+             get_memory_segments_path(user_id, collection_id, memory_id)]
+    if filename:
+        upload_path = os.path.join(get_collection_documents_path(user_id, collection_id), filename)
+        paths = [path for path in paths if path != upload_path] if keep_upload else paths + [upload_path]
+    for path in paths:
+        collection_journal.remove_file(path)
+
+def _drop_memory_vectors(user_id, collection_id, memory_id, index, tombstone=True):
+    """Remove a memory's vectors from its collection index.
+
+    HNSW vectors are tombstoned until tombstones would pass
+    INDEX_DELETED_MAX_FRACTION of the index. Past that, or with
+    tombstone=False, and for indexes that cannot remove vectors at all, the
+    index is rebuilt from the store, so the memory must already be gone from
+    the metadata store. A rolled-back add passes tombstone=False, since the
+    retried ingestion job brings back the same memory ID.
+    """
+    if index_policy.supports_remove(index):
+        start_id, end_id = get_memory_vector_id_range(memory_id)
+        if index.remove_ids(faiss.IDSelectorRange(start_id, end_id)):
+            write_collection_index(user_id, collection_id, index)
+        return
+    
+    vector_ids = get_memory_vector_ids(index, memory_id)
+    if not len(vector_ids):
+        return
+    if tombstone and index_policy.get_index_type(index) == "hnsw":
+        deleted_ids = np.union1d(read_deleted_vector_ids(user_id, collection_id), vector_ids)
+        if len(deleted_ids) <= index.ntotal * index_policy.INDEX_DELETED_MAX_FRACTION:
+            write_deleted_vector_ids(user_id, collection_id, deleted_ids)
+            # Cached searchers are checked against the index file, so touch
+            # it for other processes to reload the tombstones
+            os.utime(get_collection_index_path(user_id, collection_id))
+            return
+    rebuild_collection_index(user_id, collection_id)
+
+def _apply_memory_delete(user_id, collection_id, memory_id, filename, index):
+    """Remove a memory's vectors, metadata and files, skipping any already gone"""
+    if index_policy.supports_remove(index):
+        _drop_memory_vectors(user_id, collection_id, memory_id, index)
+        collection_store.delete_memory(get_collection_db(), collection_id, memory_id)
+    else:
+        collection_store.delete_memory(get_collection_db(), collection_id, memory_id)
+        _drop_memory_vectors(user_id, collection_id, memory_id, index)
+    _remove_memory_files(user_id, collection_id, memory_id, filename)
+
+def _restore_memory_vectors(user_id, collection_id, memory, index):
+    """Re-add a committed memory's vectors from the embedding store.
+
+    Returns False if the store does not have all of them.
+    """
+    chunk_count = len(get_memory_chunks(memory))
+    start_id, end_id = get_memory_vector_id_range(memory["id"])
+    matrix, vector_ids, _ = load_embeddings(get_collection_path(user_id, collection_id), EMBEDDING_DIMENSION)
+    
+    # The latest row wins when a memory was appended more than once
+    rows = {}
+    for row, vector_id in enumerate(vector_ids):
+        if start_id <= vector_id < end_id:
+            rows[int(vector_id)] = row
+    wanted = [start_id + i for i in range(chunk_count)]
+    if any(vector_id not in rows for vector_id in wanted):
+        return False
+    
+    index.add_with_ids(np.array(matrix[[rows[vector_id] for vector_id in wanted]]), np.array(wanted, dtype='int64'))
+    write_collection_index(user_id, collection_id, index)
+    return True
+
+def _recover_memory_add(user_id, collection_id, memory_id, filename):
+    """Keep a committed memory, restoring missing vectors, or roll back one that was not"""
+    index = load_collection_index(user_id, collection_id)
+    memory = collection_store.get_memory(get_collection_db(), collection_id, memory_id)
+    
+    if memory is None:
+        _drop_memory_vectors(user_id, collection_id, memory_id, index, tombstone=False)
+        _remove_memory_files(user_id, collection_id, memory_id, filename, keep_upload=True)
+        return
+    
+    present = count_memory_vectors(index, memory_id)
+    if present == len(get_memory_chunks(memory)):
+        return
+    if present:
+        if not index_policy.supports_remove(index):
+            # The rebuild puts back exactly the memory's stored vectors
+            rebuild_collection_index(user_id, collection_id)
+            return
+        start_id, end_id = get_memory_vector_id_range(memory_id)
+        index.remove_ids(faiss.IDSelectorRange(start_id, end_id))
+    if not _restore_memory_vectors(user_id, collection_id, memory, index):
+        rebuild_collection_index(user_id, collection_id)
+
+def recover_journal_entry(user_id, collection_id, entry_id, entry):
+    """Bring a collection back in line after an interrupted journaled change.
+
+    Each added memory is kept, with any missing vectors restored, if its
+    metadata was committed, and rolled back otherwise; the original upload
+    stays so the requeued ingestion job can try again. A delete is always
+    finished. Returns True once the entry is resolved; on failure the entry
+    is left for the next recovery pass.
+    """
+    collection_path = get_collection_path(user_id, collection_id)
+    try:
+        with collection_write_lock(user_id, collection_id):
+            conn = get_collection_db()
+            if collection_store.get_generation(conn, user_id, collection_id) is None:
+                # The collection was deleted, nothing left to reconcile
+                collection_journal.commit(collection_path, entry_id)
+                return True
+            
+            recover_embedding_store(collection_path)
+            op = entry.get("op")
+            if op == "rebuild":
+                rebuild_collection_index(user_id, collection_id)
+            elif op == "delete_memory":
+                index = load_collection_index(user_id, collection_id)
+                _apply_memory_delete(user_id, collection_id, entry["memory_id"], entry.get("filename"), index)
+            elif op in ("add_memory", "add_memories"):
+                for added in entry.get("memories") or [entry]:
+                    _recover_memory_add(user_id, collection_id, added["memory_id"], added.get("filename"))
+            else:
+                print(f"Unknown journal entry {entry_id} in collection {collection_id}: {op}")
+            
+            collection_journal.commit(collection_path, entry_id)
+            bump_generation(user_id, collection_id)
+            return True
+    except Exception as e:
+        print(f"Could not recover journal entry {entry_id} of collection {collection_id}: {str(e)}")
+        return False
+
+def recover_collections():
+    """Resolve every change left pending in a collection journal.
+
+    Run at startup, before anything else writes to the collections.
+    Returns the number of entries resolved.
+    """
+    recovered = 0
+    for user_id, collection_id, entry_id, entry in list(collection_journal.find_pending(COLLECTIONS_DIR)):
+        print(f"Recovering interrupted {entry.get('op')} in collection {collection_id}")
+        if recover_journal_entry(user_id, collection_id, entry_id, entry):
+            recovered += 1
+    return recovered
+
+def rebuild_collection_index(user_id, collection_id, collection=None):
+    """Rebuild the FAISS index for a collection.
+
+    Vectors come from the collection's embedding store, then from the existing
+    ID-mapped index; only chunks missing from both are sent to the embedding
+    model, in batches. All vectors are normalised to unit length and the
+    embedding store is rewritten to hold exactly the live vectors.
+    """
+    with collection_write_lock(user_id, collection_id):
+        return _rebuild_collection_index(user_id, collection_id, collection)
+
+def _rebuild_collection_index(user_id, collection_id, collection):
+    """rebuild_collection_index, with the collection's write lock held"""
+    if collection is None:
+        collection = read_collection_metadata(user_id, collection_id)
     if not collection:
         return False
+    if "memories" not in collection:
+        collection["memories"] = collection_store.list_memories(get_collection_db(), collection_id)
+    
+    collection_path = get_collection_path(user_id, collection_id)
+    index_path = get_collection_index_path(user_id, collection_id)
+    
+    stored_matrix, stored_vector_ids, _ = load_embeddings(collection_path, EMBEDDING_DIMENSION)
+    stored_rows = {}
+    for row, vector_id in enumerate(stored_vector_ids):
+        stored_rows[int(vector_id)] = row
+    
+    old_index = None
+    if os.path.exists(index_path):
+        try:
+            old_index = faiss.read_index(index_path)
+        except Exception as e:
+            print(f"Could not read existing index for collection {collection_id}: {e}")
+    if old_index is not None and not isinstance(old_index, faiss.IndexIDMap2):
+        old_index = None
     
-    # Create a new empty index
-    index = faiss.IndexFlatL2(EMBEDDING_DIMENSION)
+    memory_dir = get_collection_documents_path(user_id, collection_id)
+    vector_ids = []
+    memory_ids = []
+    vectors = []
+    missing_rows = []
+    missing_texts = []
     
-    # Add all memories back to the index
     for memory in collection.get("memories", []):
-        memory_dir = get_collection_documents_path(user_id, collection_id)
-        text_path = os.path.join(memory_dir, f"{memory['id']}.txt")
-        
-        # Read the memory text content
-        with open(text_path, 'r', encoding='utf-8') as f:
-            memory_text = f.read()
-        
-        # Generate embedding
-        response = ollama.embeddings(model="nomic-embed-text", prompt=memory_text)
-        embedding = response["embedding"]
+        base_vector_id = get_memory_vector_id(memory["id"])
+        memory_text = None
         
-        # Add to index
-        index.add(np.array([embedding]).astype('float32'))
+        for chunk_index, chunk in enumerate(get_memory_chunks(memory)):
+            vector_id = base_vector_id + chunk_index
+            embedding = None
+            
+            if vector_id in stored_rows:
+                embedding = stored_matrix[stored_rows[vector_id]]
+            elif old_index is not None:
+                try:
+                    embedding = old_index.reconstruct(vector_id)
+                except RuntimeError:
+                    embedding = None
+            
+            if embedding is None:
+                if memory_text is None:
+                    # Read the memory text content
+                    text_path = os.path.join(memory_dir, f"{memory['id']}.txt")
+                    with open(text_path, 'r', encoding='utf-8') as f:
+                        memory_text = f.read()
+                missing_rows.append(len(vectors))
+                missing_texts.append(get_chunk_text(memory_text, chunk))
+                embedding = np.zeros(EMBEDDING_DIMENSION, dtype='float32')
+            
+            vector_ids.append(vector_id)
+            memory_ids.append(memory["id"])
+            vectors.append(np.asarray(embedding, dtype='float32'))
+    
+    vector_ids = np.array(vector_ids, dtype='int64')
+    vectors = np.array(vectors, dtype='float32').reshape(len(vector_ids), EMBEDDING_DIMENSION)
+    del stored_matrix
+    
+    # Embed everything that had no stored vector in as few requests as possible
+    if missing_texts:
+        vectors[missing_rows] = embed_texts(missing_texts)
+    if len(vector_ids):
+        faiss.normalize_L2(vectors)
+    
+    # Create a new index from the collected vectors, of the type the
+    # collection's size calls for (training it if needed)
+    index_type = index_policy.choose_index_type(len(vector_ids), collection.get("index_policy"))
+    index = index_policy.build_index(index_type, EMBEDDING_DIMENSION, vectors, vector_ids)
+    
+    # Save the updated index and embedding store; a crash in between is
+    # finished by running the rebuild again, which now reads the new store
+    collection_journal.begin(collection_path, REBUILD_JOURNAL_ID, {"op": "rebuild"})
+    write_embedding_store(collection_path, vector_ids, memory_ids, vectors, EMBEDDING_DIMENSION)
+    write_collection_index(user_id, collection_id, index)
+    # The new index has none of the tombstoned vectors; tombstones left by a
+    # crash before this point only name IDs the index no longer holds
+    collection_journal.remove_file(get_collection_deleted_ids_path(user_id, collection_id))
     
-    # Save the updated index
-    faiss.write_index(index, get_collection_index_path(user_id, collection_id))
+    if collection.get("index_version") != INDEX_VERSION:
+        collection["index_version"] = INDEX_VERSION
+        collection_store.set_index_version(get_collection_db(), collection_id, INDEX_VERSION)
+    collection_journal.commit(collection_path, REBUILD_JOURNAL_ID)
+    bump_generation(user_id, collection_id)
+    print(f"Rebuilt {index_type} index for collection {collection_id}: "
+          f"{len(vector_ids) - len(missing_texts)} vectors reused, {len(missing_texts)} re-embedded")
     
-    return True
\ No newline at end of file
+    return True
@@ -1,32 +1,56 @@
-from flask import Blueprint, request, jsonify, session, send_file
+from flask import Blueprint, Response, request, jsonify, session, send_file, current_app
 import os
 import datetime
 import time
 import shutil
 import uuid
 import tempfile
-import librosa
 import numpy as np
 import json
+import threading
+from types import MappingProxyType
 from auth_blueprint import login_required
-import torchaudio
-import whisper
-from resemblyzer import VoiceEncoder, preprocess_wav
-from sklearn.cluster import AgglomerativeClustering
-from sklearn.metrics import silhouette_score
-from sklearn.decomposition import PCA
-from scipy import signal
-import webrtcvad
+import model_registry
 import io
 
+# torchaudio, librosa, resemblyzer, sklearn and scipy are imported inside the
+# functions that use them so importing this blueprint stays cheap
+
 upload_bp = Blueprint('upload', __name__)
 
-# Initialize variables to store the models once loaded
-_whisper_model = None
-_voice_encoder = None
-_vad = None
+# Sample rate of the decoded buffer shared by Whisper, the VAD and the encoder
+AUDIO_SAMPLE_RATE = 16000
+
+# Recordings with fewer candidate VAD frames than this (~10 minutes of 30ms
+# frames) are not worth shipping to the VAD process pool
+VAD_POOL_MIN_FRAMES = 20000
+# Most processes a job's vad_workers may ask for, which is also the size of
+# the shared VAD pool
+VAD_MAX_WORKERS = int(os.environ.get('VAD_MAX_WORKERS', os.cpu_count() or 1))
+_vad_pool = None
+_pool_lock = threading.Lock()
+# Frames after a loud frame that still go through the VAD (WebRTC VAD's
+# hangover keeps marking speech for a few frames after it ends)
+VAD_HANGOVER_FRAMES = 8
+
+# Chunk ends are moved to the longest pause in this trailing fraction of the chunk
+TRANSCRIBE_CHUNK_SEARCH = 0.1
+# Characters of the previous chunk's transcript used to prompt the next one
+TRANSCRIBE_PROMPT_CHARS = 200
+# Most processes a job's transcribe_workers may ask for, which is also the
+# size of the shared transcription pool. Each worker loads its own Whisper
+# model, so this defaults low
+TRANSCRIBE_MAX_WORKERS = int(os.environ.get('TRANSCRIBE_MAX_WORKERS', 2))
+_transcribe_pool = None
 
-# Configurable parameters for diarization
+# Encrypts the stored copy of an upload while it is being transcribed
+_encrypt_executor = None
+
+# Memory budget for one batched forward pass of the speaker encoder
+SPEAKER_EMBED_BATCH_BYTES = int(os.environ.get('SPEAKER_EMBED_BATCH_BYTES', 64 * 1024 * 1024))
+
+# Default diarization parameters. Jobs never modify these: each one runs with
+# its own read-only copy from make_diarization_config
 DIARIZATION_CONFIG = {
     "min_segment_length": 0.5,      # Minimum segment length in seconds
     "word_gap_threshold": 0.3,       # Gap between words to create a new segment (seconds)
@@ -35,21 +59,78 @@ DIARIZATION_CONFIG = {
     "clustering_method": "average",  # Linkage method for clustering: 'ward', 'complete', 'average'
     "distance_threshold": 0.3,       # Distance threshold for clustering (used if num_speakers not provided)
     "smooth_window": 3,              # Window size for median filtering of speaker labels
-    "whisper_model_size": "base", # Options: "tiny", "base", "small", "medium", "large-v3", "turbo"
+    "whisper_model_size": os.environ.get('WHISPER_MODEL_SIZE', 'base'), # Options: "tiny", "base", "small", "medium", "large-v3", "turbo"
     "use_pca": True,                 # Whether to use PCA for embedding dimensionality reduction
     "pca_components": 32,            # Number of PCA components to keep
     "vad_aggressiveness": 3,         # WebRTC VAD aggressiveness (0-3)
     "vad_frame_ms": 30,              # VAD frame size in milliseconds (10, 20, or 30)
     "min_vad_speech_duration": 0.2,  # Minimum speech duration to keep a segment after VAD
+    "vad_energy_gate_db": -60.0,     # Frames below this level (dBFS) skip the VAD as silence
+    "vad_workers": 0,                # Processes for the VAD pass on long recordings (0 = in-process)
+    "transcribe_chunk_seconds": 120.0, # Length of the chunks long recordings are transcribed in
+    "transcribe_workers": 0,         # Processes transcribing chunks in parallel (0 = in-process)
 }
 
-def get_vad():
-    """Lazy load the VAD model"""
-    global _vad
-    if _vad is None:
-        print("Initializing WebRTC VAD...")
-        _vad = webrtcvad.Vad(DIARIZATION_CONFIG["vad_aggressiveness"])
-    return _vad
+# Allowed values for the settings that select a model or algorithm
+DIARIZATION_CHOICES = {
+    "whisper_model_size": ("tiny", "tiny.en", "base", "base.en", "small", "small.en", "medium", "medium.en",
+                           "large", "large-v1", "large-v2", "large-v3", "large-v3-turbo", "turbo"),
+    "clustering_method": ("ward", "complete", "average", "single"),
+    "vad_aggressiveness": (0, 1, 2, 3),
+    "vad_frame_ms": (10, 20, 30),
+}
+
+def _coerce_config_value(key, value):
+    """Convert an override (possibly a form string) to the default's type"""
+    default = DIARIZATION_CONFIG[key]
+    if isinstance(default, bool):
+        if isinstance(value, str):
+            return value.lower() in ["true", "1", "yes"]
+        return bool(value)
+    if isinstance(default, int):
+        return int(float(value))
+    if isinstance(default, float):
+        return float(value)
+    return str(value)
+
+def make_diarization_config(overrides=None):
+    """Build a read-only diarization config from the defaults and overrides.
+
+    Unknown keys and invalid values are ignored. Worker counts come from the
+    upload form, so they are capped at the server's configured maximum. The
+    result is safe to share between threads.
+    """
+    config = dict(DIARIZATION_CONFIG)
+    for key, value in (overrides or {}).items():
+        if key not in DIARIZATION_CONFIG:
+            continue
+        try:
+            value = _coerce_config_value(key, value)
+        except (TypeError, ValueError):
+            print(f"Invalid value for {key}: {value}")
+            continue
+        if key in DIARIZATION_CHOICES and value not in DIARIZATION_CHOICES[key]:
+            print(f"Invalid value for {key}: {value}")
+            continue
+        if key == "vad_workers":
+            value = max(0, min(value, VAD_MAX_WORKERS))
+        if key == "transcribe_workers":
+            value = max(0, min(value, TRANSCRIBE_MAX_WORKERS))
+        config[key] = value
+    return MappingProxyType(config)
+
+def _resolve_config(config):
+    return make_diarization_config() if config is None else config
+
+def get_vad(config=None):
+    """Create a WebRTC VAD with the configured aggressiveness.
+
+    The VAD keeps state between frames, so every stream gets its own; they
+    are cheap to create.
+    """
+    import webrtcvad
+    config = _resolve_config(config)
+    return webrtcvad.Vad(int(config["vad_aggressiveness"]))
 
 def convert_webm_to_mp3(webm_file_path):
     """Convert WebM file to WAV format using pydub which can handle WebM with Opus codec
@@ -97,92 +178,300 @@ def convert_webm_to_mp3(webm_file_path):
 
 def preprocess_audio(file_path):
     """Preprocess audio using torchaudio to bypass FFmpeg dependency"""
+    import torchaudio
     waveform, sample_rate = torchaudio.load(file_path)
-    if sample_rate != 16000:
-        resampler = torchaudio.transforms.Resample(orig_freq=sample_rate, new_freq=16000)
-        waveform = resampler(waveform)
+    # Downmix before resampling so only one channel goes through the resampler
     if waveform.shape[0] > 1:
         waveform = waveform.mean(dim=0, keepdim=True)
-    return waveform.squeeze().numpy().astype("float32")
+    if sample_rate != AUDIO_SAMPLE_RATE:
+        resampler = torchaudio.transforms.Resample(orig_freq=sample_rate, new_freq=AUDIO_SAMPLE_RATE)
+        waveform = resampler(waveform)
+    return np.ascontiguousarray(waveform.squeeze(0).numpy(), dtype=np.float32)
+
+def load_audio(file_path):
+    """Decode a file once into the 16 kHz mono float32 buffer the pipeline shares.
 
-def get_diarization_models():
-    """Lazy load the diarization models only when needed"""
-    global _whisper_model, _voice_encoder
-    if _whisper_model is None:
-        print(f"Loading Whisper model ({DIARIZATION_CONFIG['whisper_model_size']}) for diarization...")
-        _whisper_model = whisper.load_model(DIARIZATION_CONFIG["whisper_model_size"])
+    Whisper, the VAD and the voice encoder all read (views of) this buffer,
+    so a diarization run never decodes or resamples the file again.
+    """
+    try:
+        return preprocess_audio(file_path)
+    except Exception as e:
+        print(f"torchaudio could not decode {file_path} ({str(e)}), falling back to librosa")
+        import librosa
+        audio, _ = librosa.load(file_path, sr=AUDIO_SAMPLE_RATE, mono=True, dtype=np.float32)
+        return audio
+
+def get_audio_duration_seconds(audio):
+    """Duration of a decoded buffer in seconds"""
+    return len(audio) / AUDIO_SAMPLE_RATE
+
+def get_diarization_models(config=None):
+    """Get the Whisper model and voice encoder from the shared model registry.
+
+    Work that runs for a while should hold the models with
+    model_registry.use_whisper_model / use_voice_encoder instead.
+    """
+    config = _resolve_config(config)
+    whisper_model = model_registry.get_whisper_model(config["whisper_model_size"])
+    voice_encoder = model_registry.get_voice_encoder()
+    return whisper_model, voice_encoder
+
+def get_transcription_chunks(num_samples, speech_mask=None, config=None):
+    """Split a recording into (start, end) sample ranges for chunked transcription.
+
+    Chunks are about transcribe_chunk_seconds long. When a VAD speech mask is
+    given, each chunk ends in the middle of the longest pause found in its
+    last TRANSCRIBE_CHUNK_SEARCH fraction, so words are not cut in half.
+    """
+    config = _resolve_config(config)
+    # Whisper decodes 30 second windows, so shorter chunks only add overhead
+    chunk_samples = int(max(config["transcribe_chunk_seconds"], 30) * AUDIO_SAMPLE_RATE)
+    frame_samples = int(AUDIO_SAMPLE_RATE * config["vad_frame_ms"] / 1000.0)
     
-    if _voice_encoder is None:
-        print("Loading voice encoder model...")
-        _voice_encoder = VoiceEncoder()
+    chunks = []
+    start = 0
+    while num_samples - start > chunk_samples:
+        end = start + chunk_samples
+        if speech_mask is not None:
+            first = (end - int(chunk_samples * TRANSCRIBE_CHUNK_SEARCH)) // frame_samples
+            last = min(end // frame_samples, len(speech_mask))
+            silent = np.flatnonzero(speech_mask[first:last] == 0)
+            if len(silent):
+                # Split the silent frames into runs and take the longest
+                runs = np.split(silent, np.flatnonzero(np.diff(silent) > 1) + 1)
+                longest = max(runs, key=len)
+                end = (first + int(longest[len(longest) // 2])) * frame_samples
+        chunks.append((start, end))
+        start = end
+    chunks.append((start, num_samples))
+    return chunks
+
+def _shift_segments(segments, offset_seconds):
+    """Move chunk-relative Whisper timestamps onto the recording's timeline"""
+    for segment in segments:
+        segment["start"] += offset_seconds
+        segment["end"] += offset_seconds
+        for word in segment.get("words", []):
+            word["start"] += offset_seconds
+            word["end"] += offset_seconds
+    return segments
+
+def _transcribe_chunk(audio_chunk, offset_seconds, model_size, initial_prompt=None):
+    """Transcribe one chunk, returning segments on the recording's timeline"""
+    with model_registry.use_whisper_model(model_size) as whisper_model:
+        result = whisper_model.transcribe(audio_chunk, word_timestamps=True, initial_prompt=initial_prompt)
+    return _shift_segments(result["segments"], offset_seconds)
+
+def _init_transcribe_worker(threads):
+    import torch
+    torch.set_num_threads(threads)
+
+def _get_audio_key():
+    """The audio master key, from app config or AUDIO_ENCRYPTION_KEY.
+
+    Raises RuntimeError when it is not set. Read it in the request and pass
+    it on: background encryption and streamed responses run outside the app
+    context.
+    """
+    from audio_crypto import load_encryption_key
+    return current_app.config.get('AUDIO_ENCRYPTION_KEY') or load_encryption_key()
+
+def _get_encrypt_executor():
+    global _encrypt_executor
+    with _pool_lock:
+        if _encrypt_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _encrypt_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='audio-encrypt')
+        return _encrypt_executor
+
+def _make_process_pool(workers, **kwargs):
+    """Create a process pool whose workers start from a fresh interpreter.
+
+    Forking this process (threaded, with torch and OpenMP loaded) can leave
+    locks held in the child, so workers are spawned instead.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), **kwargs)
+
+def _get_transcribe_pool():
+    """Get the shared transcription pool of TRANSCRIBE_MAX_WORKERS processes"""
+    global _transcribe_pool
+    with _pool_lock:
+        if _transcribe_pool is None:
+            threads = max(1, (os.cpu_count() or 1) // TRANSCRIBE_MAX_WORKERS)
+            _transcribe_pool = _make_process_pool(TRANSCRIBE_MAX_WORKERS, initializer=_init_transcribe_worker,
+                                                  initargs=(threads,))
+        return _transcribe_pool
+
+def stream_transcription(audio, speech_mask=None, config=None):
+    """Transcribe a decoded buffer chunk by chunk.
+
+    Yields (segments, fraction_done) after each chunk, with timestamps on the
+    recording's timeline. Whisper only ever works on one chunk, so its mel
+    spectrogram and decoder state are bounded by transcribe_chunk_seconds.
+    The decoded buffer itself is still the whole recording (about 230 MB per
+    hour), since the VAD and the voice encoder read it too.
+    Sequential chunks are prompted with the end of the previous chunk's text;
+    with transcribe_workers > 1 chunks are spread over the process pool, at
+    most transcribe_workers in flight, and still yielded in order.
+    """
+    config = _resolve_config(config)
+    model_size = config["whisper_model_size"]
+    chunks = get_transcription_chunks(len(audio), speech_mask, config)
+    total = max(len(audio), 1)
+    workers = int(config["transcribe_workers"])
     
-    return _whisper_model, _voice_encoder
+    if workers > 1 and len(chunks) > 1:
+        from collections import deque
+        pool = _get_transcribe_pool()
+        pending = deque()
+        for start, end in chunks:
+            pending.append((end, pool.submit(_transcribe_chunk, audio[start:end], start / AUDIO_SAMPLE_RATE, model_size)))
+            if len(pending) >= workers:
+                chunk_end, future = pending.popleft()
+                yield future.result(), chunk_end / total
+        while pending:
+            chunk_end, future = pending.popleft()
+            yield future.result(), chunk_end / total
+        return
+    
+    previous_text = None
+    for start, end in chunks:
+        segments = _transcribe_chunk(audio[start:end], start / AUDIO_SAMPLE_RATE, model_size, previous_text)
+        if segments:
+            previous_text = "".join(segment["text"] for segment in segments)[-TRANSCRIBE_PROMPT_CHARS:]
+        yield segments, end / total
+
+def transcribe_audio_with_timestamps(audio, speech_mask=None, on_segments=None, config=None):
+    """Transcribe audio using Whisper with timestamps.
 
-def transcribe_audio_with_timestamps(audio_path):
-    """Transcribe audio using Whisper with timestamps"""
-    print(f"Transcribing audio with timestamps from {audio_path}")
-    whisper_model, _ = get_diarization_models()
+    Accepts a file path or a buffer from load_audio. Long recordings are
+    transcribed in VAD-bounded chunks; on_segments(segments, fraction_done),
+    if given, receives each chunk's segments as soon as they are ready.
+    """
+    if isinstance(audio, str):
+        print(f"Transcribing audio with timestamps from {audio}")
+        audio = load_audio(audio)
     
-    # Preprocess audio using torchaudio instead of relying on Whisper's built-in processing
-    audio = preprocess_audio(audio_path)
+    segments = []
+    for chunk_segments, fraction in stream_transcription(audio, speech_mask, config):
+        segments.extend(chunk_segments)
+        if on_segments is not None:
+            on_segments(chunk_segments, fraction)
     
-    # Use the preprocessed audio array instead of the file path
-    result = whisper_model.transcribe(audio, word_timestamps=True)
-    return result
+    for i, segment in enumerate(segments):
+        segment["id"] = i
+    return {"text": "".join(segment["text"] for segment in segments), "segments": segments}
 
-def apply_vad(audio, sample_rate=16000):
-    """Apply Voice Activity Detection to identify speech segments"""
-    vad = get_vad()
+def _vad_frames_worker(frame_bytes, frame_len, sample_rate, aggressiveness):
+    """Run WebRTC VAD over a block of frames in a worker process"""
+    import webrtcvad
+    vad = webrtcvad.Vad(int(aggressiveness))
+    buffer = memoryview(frame_bytes)
+    step = frame_len * 2
+    return [vad.is_speech(buffer[i:i + step], sample_rate) for i in range(0, len(buffer), step)]
+
+def _get_vad_pool():
+    """Get the shared VAD pool of VAD_MAX_WORKERS processes"""
+    global _vad_pool
+    with _pool_lock:
+        if _vad_pool is None:
+            _vad_pool = _make_process_pool(VAD_MAX_WORKERS)
+        return _vad_pool
+
+def apply_vad(audio, sample_rate=16000, config=None):
+    """Apply Voice Activity Detection to identify speech segments.
+
+    Frames whose energy is below vad_energy_gate_db are marked as silence
+    without calling the VAD. The remaining frames are read straight out of
+    the int16 buffer through a memoryview, in the process pool when
+    vad_workers is set and the recording is long enough to pay for it. A job
+    keeps at most vad_workers blocks in flight there.
+    """
+    from scipy import signal
+    config = _resolve_config(config)
     
     # Frame parameters based on the VAD configuration
-    frame_ms = DIARIZATION_CONFIG["vad_frame_ms"]
+    frame_ms = config["vad_frame_ms"]
     frame_len = int(sample_rate * (frame_ms / 1000.0))
     
-    # Pad audio to ensure we have complete frames
-    pad_size = frame_len - (len(audio) % frame_len)
-    if pad_size < frame_len:
-        audio = np.pad(audio, (0, pad_size), 'constant')
+    # Scale to the int16 range in one zero-padded buffer of complete frames
+    num_frames = -(-len(audio) // frame_len)
+    scaled = np.zeros(num_frames * frame_len, dtype=np.float32)
+    np.multiply(audio, 32767, out=scaled[:len(audio)])
+    np.clip(scaled, -32768, 32767, out=scaled)
     
-    # Convert float audio to int16 for VAD
-    audio_int16 = (audio * 32767).astype(np.int16).tobytes()
+    # Energy pre-gate: frames quieter than the gate can't be speech
+    scaled_frames = scaled.reshape(num_frames, frame_len)
+    power = np.einsum('ij,ij->i', scaled_frames, scaled_frames) / frame_len
+    level_db = 10 * np.log10(power / (32767.0 ** 2) + 1e-12)
+    loud = level_db > config["vad_energy_gate_db"]
+    # Keep running the VAD for a few frames after loud ones so its hangover
+    # still marks the tail of each utterance as speech
+    loud = np.convolve(loud, np.ones(VAD_HANGOVER_FRAMES + 1), 'full')[:len(loud)] > 0
+    candidates = np.flatnonzero(loud)
     
-    # Process frames
-    speech_frames = []
-    for i in range(0, len(audio) - frame_len + 1, frame_len):
-        frame = audio_int16[i*2:(i+frame_len)*2]  # *2 because each int16 is 2 bytes
-        if vad.is_speech(frame, sample_rate):
-            speech_frames.append(1)
-        else:
-            speech_frames.append(0)
+    # Convert to int16 for VAD, one row per frame
+    audio_int16 = scaled.astype(np.int16)
+    frames = audio_int16.reshape(num_frames, frame_len)
+    speech_mask = np.zeros(num_frames, dtype=np.int64)
     
-    # Convert to numpy array for easier manipulation
-    speech_mask = np.array(speech_frames)
+    workers = int(config["vad_workers"])
+    if workers > 1 and len(candidates) >= VAD_POOL_MIN_FRAMES:
+        from collections import deque
+        pool = _get_vad_pool()
+        pending = deque()
+        for block in np.array_split(candidates, workers * 4):
+            pending.append((block, pool.submit(_vad_frames_worker, frames[block].tobytes(), frame_len,
+                                               sample_rate, config["vad_aggressiveness"])))
+            if len(pending) >= workers:
+                done, future = pending.popleft()
+                speech_mask[done] = future.result()
+        while pending:
+            done, future = pending.popleft()
+            speech_mask[done] = future.result()
+    else:
+        vad = get_vad(config)
+        buffer = memoryview(audio_int16).cast('B')
+        step = frame_len * 2  # each int16 sample is 2 bytes
+        speech_mask[candidates] = [
+            vad.is_speech(buffer[i * step:(i + 1) * step], sample_rate) for i in candidates
+        ]
     
     # Smooth the speech mask
     speech_mask = signal.medfilt(speech_mask, 5)
     
     return speech_mask
 
-def segment_audio(audio_path, min_segment_length=None):
-    """Segment audio based on voice activity and silence"""
+def segment_audio(audio, min_segment_length=None, on_segments=None, config=None):
+    """Segment audio based on voice activity and silence.
+
+    Accepts a file path or a buffer from load_audio. Segment audio is
+    returned as views into the buffer, not copies. on_segments is passed on
+    to transcribe_audio_with_timestamps.
+    """
+    config = _resolve_config(config)
     if min_segment_length is None:
-        min_segment_length = DIARIZATION_CONFIG["min_segment_length"]
+        min_segment_length = config["min_segment_length"]
     
     print("Segmenting audio based on speech activity")
     
-    # Load audio file using librosa
-    y, sr = librosa.load(audio_path, sr=16000, mono=True)
+    if isinstance(audio, str):
+        audio = load_audio(audio)
+    y, sr = audio, AUDIO_SAMPLE_RATE
     
     # Apply VAD to get speech mask
-    speech_mask = apply_vad(y, sr)
+    speech_mask = apply_vad(y, sr, config)
     
     # Get word-level transcription to use as segments
-    result = transcribe_audio_with_timestamps(audio_path)
+    result = transcribe_audio_with_timestamps(y, speech_mask, on_segments, config)
     
     segments = []
     current_segment = {"start": None, "end": None, "text": "", "words": []}
     
-    word_gap_threshold = DIARIZATION_CONFIG["word_gap_threshold"]
+    word_gap_threshold = config["word_gap_threshold"]
     
     for segment in result["segments"]:
         for word in segment.get("words", []):
@@ -210,7 +499,7 @@ def segment_audio(audio_path, min_segment_length=None):
     audio_segments = []
     
     # Add some padding for each segment for better speaker identification
-    overlap_window = DIARIZATION_CONFIG["overlap_window"]
+    overlap_window = config["overlap_window"]
     
     for i, segment in enumerate(segments):
         start_time = max(0, segment["start"] - overlap_window/2)
@@ -231,8 +520,8 @@ def segment_audio(audio_path, min_segment_length=None):
         
         # Check if the segment has enough speech based on VAD
         # Convert time to frame indices
-        start_frame = int(start_time / (DIARIZATION_CONFIG["vad_frame_ms"] / 1000.0))
-        end_frame = int(end_time / (DIARIZATION_CONFIG["vad_frame_ms"] / 1000.0))
+        start_frame = int(start_time / (config["vad_frame_ms"] / 1000.0))
+        end_frame = int(end_time / (config["vad_frame_ms"] / 1000.0))
         
         # Ensure indices are within bounds
         start_frame = max(0, min(start_frame, len(speech_mask) - 1))
@@ -253,75 +542,138 @@ def segment_audio(audio_path, min_segment_length=None):
     
     return audio_segments, result["text"]
 
-def extract_embeddings_with_sliding_window(audio_data, sr=16000):
-    """Extract speaker embeddings using sliding windows for better representation"""
-    _, voice_encoder = get_diarization_models()
-    
-    # If the audio is too short, return a single embedding
-    if len(audio_data) / sr < DIARIZATION_CONFIG["embedding_frame_length"]:
-        processed_wav = preprocess_wav(audio_data, source_sr=sr)
-        return voice_encoder.embed_utterance(processed_wav)
+def _get_embedding_windows(audio_data, sr, frame_seconds):
+    """Split a segment into the windows whose embeddings are averaged"""
+    # If the audio is too short, use a single window
+    if len(audio_data) / sr < frame_seconds:
+        return [audio_data]
     
     # Use sliding windows for longer segments
-    frame_length = int(DIARIZATION_CONFIG["embedding_frame_length"] * sr)
+    frame_length = int(frame_seconds * sr)
     hop_length = frame_length // 2  # 50% overlap
+    windows = [audio_data[i:i+frame_length] for i in range(0, len(audio_data) - frame_length + 1, hop_length)]
     
-    embeddings = []
+    # Fallback to using the entire segment
+    return windows or [audio_data]
+
+def _get_partial_mels(voice_encoder, wav, rate=1.3, min_coverage=0.75):
+    """Mel spectrograms of the partial utterances embed_utterance would use"""
+    from resemblyzer.audio import wav_to_mel_spectrogram
+    wav_slices, mel_slices = voice_encoder.compute_partial_slices(len(wav), rate, min_coverage)
+    max_wave_length = wav_slices[-1].stop
+    if max_wave_length >= len(wav):
+        wav = np.pad(wav, (0, max_wave_length - len(wav)), "constant")
+    mel = wav_to_mel_spectrogram(wav)
+    return [mel[s] for s in mel_slices]
+
+def _get_partials_per_batch():
+    """How many partial utterances fit in SPEAKER_EMBED_BATCH_BYTES"""
+    from resemblyzer.hparams import partials_n_frames, mel_n_channels, model_hidden_size, model_num_layers
+    bytes_per_partial = partials_n_frames * (mel_n_channels + 4 * model_hidden_size * model_num_layers) * 4
+    return max(1, SPEAKER_EMBED_BATCH_BYTES // bytes_per_partial)
+
+def embed_segments(segment_audios, sr=16000, voice_encoder=None, config=None):
+    """Embed many segments with batched forward passes of the voice encoder.
+
+    Every sliding window of every segment is split into resemblyzer partial
+    utterances, which are forwarded in batches bounded by
+    SPEAKER_EMBED_BATCH_BYTES. Partial embeddings are then folded back the
+    way embed_utterance does (L2-normed mean per window) and averaged per
+    segment. Returns an array with one embedding per segment.
+    """
+    import torch
+    from resemblyzer import preprocess_wav
+    config = _resolve_config(config)
+    if voice_encoder is None:
+        voice_encoder = model_registry.get_voice_encoder()
     
-    for i in range(0, len(audio_data) - frame_length + 1, hop_length):
-        frame = audio_data[i:i+frame_length]
-        processed_frame = preprocess_wav(frame, source_sr=sr)
-        embedding = voice_encoder.embed_utterance(processed_frame)
-        embeddings.append(embedding)
+    batch_size = _get_partials_per_batch()
+    partial_embeds = []
+    pending = []
+    window_partials = []  # partial count per window
+    segment_windows = []  # window count per segment
     
-    # Return average embedding
-    if embeddings:
-        return np.mean(embeddings, axis=0)
-    else:
-        # Fallback to using the entire segment
-        processed_wav = preprocess_wav(audio_data, source_sr=sr)
-        return voice_encoder.embed_utterance(processed_wav)
+    def flush():
+        with torch.no_grad():
+            mels = torch.from_numpy(np.stack(pending)).to(voice_encoder.device)
+            partial_embeds.append(voice_encoder(mels).cpu().numpy())
+        pending.clear()
+    
+    for audio_data in segment_audios:
+        windows = _get_embedding_windows(audio_data, sr, config["embedding_frame_length"])
+        segment_windows.append(len(windows))
+        for window in windows:
+            mels = _get_partial_mels(voice_encoder, preprocess_wav(window, source_sr=sr))
+            window_partials.append(len(mels))
+            pending.extend(mels)
+            if len(pending) >= batch_size:
+                flush()
+    if pending:
+        flush()
+    
+    if not segment_windows:
+        return np.empty((0, 0), dtype=np.float32)
+    
+    # Partials and windows are contiguous per owner, so reduceat folds them back
+    partial_embeds = np.concatenate(partial_embeds)
+    window_starts = np.cumsum([0] + window_partials[:-1])
+    window_embeds = np.add.reduceat(partial_embeds, window_starts, axis=0)
+    window_embeds /= np.linalg.norm(window_embeds, axis=1, keepdims=True)
+    
+    segment_starts = np.cumsum([0] + segment_windows[:-1])
+    segment_embeds = np.add.reduceat(window_embeds, segment_starts, axis=0)
+    return segment_embeds / np.array(segment_windows, dtype=np.float32)[:, None]
 
-def get_speaker_embeddings(audio_segments):
+def extract_embeddings_with_sliding_window(audio_data, sr=16000, voice_encoder=None, config=None):
+    """Extract speaker embeddings using sliding windows for better representation"""
+    return embed_segments([audio_data], sr, voice_encoder, config)[0]
+
+def get_speaker_embeddings(audio_segments, config=None):
     """Extract speaker embeddings from audio segments"""
     print("Extracting speaker embeddings")
-    embeddings = []
-    
-    for segment in audio_segments:
-        if len(segment["audio"]) == 0:
-            continue
-            
-        # Get embedding using sliding window approach
-        embedding = extract_embeddings_with_sliding_window(segment["audio"])
-        embeddings.append(embedding)
+    segment_audios = [segment["audio"] for segment in audio_segments if len(segment["audio"]) > 0]
     
-    return np.array(embeddings)
+    with model_registry.use_voice_encoder() as voice_encoder:
+        return embed_segments(segment_audios, AUDIO_SAMPLE_RATE, voice_encoder, config)
 
 def estimate_num_speakers(embeddings):
-    """Estimate the optimal number of speakers using silhouette score"""
-    min_speakers = 1
+    """Estimate the optimal number of speakers using silhouette score.
+
+    One Ward linkage tree is built and cut at every candidate count, and the
+    silhouette of each cut is computed from the same precomputed distance
+    matrix, so the cost is about one clustering fit whatever the range.
+    """
+    from scipy.cluster.hierarchy import linkage, cut_tree
+    from scipy.spatial.distance import pdist, squareform
+    from sklearn.metrics import silhouette_score
+    # A single cluster has no silhouette, so the smallest candidate is 2
+    min_speakers = 2
     max_speakers = min(8, len(embeddings) // 3)  # More reasonable upper bound
     
     if len(embeddings) < 4:  # Too few segments to estimate reliably
         return min(2, len(embeddings))
     
+    # Skip counts that would leave fewer embeddings than clusters
+    candidates = [n for n in range(min_speakers, max_speakers + 1) if n < len(embeddings)]
+    if not candidates:
+        return 2
+    
+    condensed = pdist(embeddings)
+    tree = linkage(condensed, method="ward")
+    distances = squareform(condensed)
+    cuts = cut_tree(tree, n_clusters=candidates)
+    
     best_score = -1
     best_n = 2
     
-    # Try different numbers of speakers and keep the one with the best silhouette score
-    for n in range(min_speakers, max_speakers + 1):
-        if len(embeddings) <= n:  # Skip if we have fewer embeddings than clusters
-            continue
-            
-        clustering = AgglomerativeClustering(n_clusters=n)
-        labels = clustering.fit_predict(embeddings)
-        
+    # Keep the number of speakers with the best silhouette score
+    for n, labels in zip(candidates, cuts.T):
         # Skip if we have clusters with only one sample
         unique_labels, counts = np.unique(labels, return_counts=True)
         if min(counts) < 2:
             continue
             
-        score = silhouette_score(embeddings, labels)
+        score = silhouette_score(distances, labels, metric="precomputed")
         
         if score > best_score:
             best_score = score
@@ -330,13 +682,16 @@ def estimate_num_speakers(embeddings):
     print(f"Estimated number of speakers: {best_n}")
     return best_n
 
-def cluster_speakers(embeddings, num_speakers=None):
+def cluster_speakers(embeddings, num_speakers=None, config=None):
     """Cluster speaker embeddings to identify unique speakers"""
+    from sklearn.cluster import AgglomerativeClustering
+    from sklearn.decomposition import PCA
     print("Clustering speakers")
+    config = _resolve_config(config)
     
     # Apply PCA to reduce dimensionality if configured
-    if DIARIZATION_CONFIG["use_pca"] and len(embeddings) > DIARIZATION_CONFIG["pca_components"]:
-        pca = PCA(n_components=min(DIARIZATION_CONFIG["pca_components"], len(embeddings)-1))
+    if config["use_pca"] and len(embeddings) > config["pca_components"]:
+        pca = PCA(n_components=min(config["pca_components"], len(embeddings)-1))
         embeddings = pca.fit_transform(embeddings)
         print(f"Applied PCA: reduced dimensions to {embeddings.shape[1]}")
     
@@ -349,17 +704,18 @@ def cluster_speakers(embeddings, num_speakers=None):
     # Perform clustering with the specified linkage method
     clustering = AgglomerativeClustering(
         n_clusters=num_speakers,
-        linkage=DIARIZATION_CONFIG["clustering_method"]
+        linkage=config["clustering_method"]
     )
     
     labels = clustering.fit_predict(embeddings)
     
     return labels
 
-def smooth_speaker_labels(labels, window_size=None):
+def smooth_speaker_labels(labels, window_size=None, config=None):
     """Apply median filtering to smooth speaker transitions"""
+    from scipy import signal
     if window_size is None:
-        window_size = DIARIZATION_CONFIG["smooth_window"]
+        window_size = _resolve_config(config)["smooth_window"]
         
     if len(labels) <= window_size:
         return labels
@@ -367,26 +723,40 @@ def smooth_speaker_labels(labels, window_size=None):
     smoothed = signal.medfilt(labels, window_size)
     return smoothed
 
-def process_audio_file_with_diarization(file_path, num_speakers=None):
-    """Process audio file to transcribe and identify speakers"""
+def process_audio_file_with_diarization(file_path, num_speakers=None, audio=None, on_segments=None, config=None):
+    """Process audio file to transcribe and identify speakers.
+
+    The file is decoded once; pass audio (from load_audio) to skip even that.
+    on_segments(segments, fraction_done) receives partial transcription
+    results while the recording is being transcribed. config comes from
+    make_diarization_config and applies to this job only, so concurrent
+    jobs can use different settings and Whisper sizes.
+    """
     print(f"Processing audio file with diarization: {file_path}")
+    config = _resolve_config(config)
+    if audio is None:
+        audio = load_audio(file_path)
     
     # Segment the audio
-    audio_segments, full_transcript = segment_audio(file_path)
+    audio_segments, full_transcript = segment_audio(audio, on_segments=on_segments, config=config)
     
     # Get speaker embeddings
-    embeddings = get_speaker_embeddings(audio_segments)
+    embeddings = get_speaker_embeddings(audio_segments, config)
     
     # Skip speaker identification if we couldn't extract embeddings
     if len(embeddings) == 0:
-        return {"error": "Could not extract speaker information from the audio", "full_transcript": full_transcript}
+        return {
+            "error": "Could not extract speaker information from the audio",
+            "full_transcript": full_transcript,
+            "duration": get_audio_duration_seconds(audio)
+        }
     
     # Cluster to identify speakers
-    speaker_labels = cluster_speakers(embeddings, num_speakers)
+    speaker_labels = cluster_speakers(embeddings, num_speakers, config)
     
     # Apply smoothing to speaker labels
     if len(speaker_labels) > 3:  # Only smooth if we have enough segments
-        speaker_labels = smooth_speaker_labels(speaker_labels)
+        speaker_labels = smooth_speaker_labels(speaker_labels, config=config)
     
     # Assign speakers to segments
     result = []
@@ -413,27 +783,25 @@ def process_audio_file_with_diarization(file_path, num_speakers=None):
     
     return {
         "segments": result,
-        "full_transcript": full_transcript
+        "full_transcript": full_transcript,
+        "duration": get_audio_duration_seconds(audio)
     }
 
-def adjust_diarization_config(config_updates=None):
-    """Update diarization configuration with provided values"""
-    global DIARIZATION_CONFIG
-    if config_updates:
-        for key, value in config_updates.items():
-            if key in DIARIZATION_CONFIG:
-                print(f"Updating diarization config: {key} = {value}")
-                DIARIZATION_CONFIG[key] = value
-    return DIARIZATION_CONFIG
-
 @upload_bp.route('/upload', methods=['POST'])
 @login_required
 def upload_audio():
+    started = time.perf_counter()
+    timings = {}
     try:
         user_id = session['user_id']
         
-        from utils import get_user_dirs, encrypt_file_in_place, decrypt_file, save_transcription, get_audio_duration
+        from utils import get_user_dirs, save_transcription
+        from audio_crypto import encrypt_file_in_place
         
+        try:
+            audio_key = _get_audio_key()
+        except RuntimeError as e:
+            return jsonify({"success": False, "error": str(e)}), 503
         user_dirs = get_user_dirs(user_id)
         
         if 'audio' not in request.files:
@@ -475,6 +843,7 @@ def upload_audio():
         
         audio_file.save(audio_path)
         print(f"Saved audio file to: {audio_path}")
+        timings["save"] = time.perf_counter() - started
         
         # Convert WebM to WAV if needed since Whisper doesn't support WebM well
         final_audio_path = audio_path
@@ -534,55 +903,59 @@ def upload_audio():
                     print(f"All WebM conversion methods failed: {str(e2)}")
                     print("Continuing with original WebM file, but transcription may fail")
         
-        # Get duration: prefer provided duration, fallback to get_audio_duration
-        duration = 0
+        # Get duration: prefer provided duration, otherwise it is taken from
+        # the decoded audio below instead of decoding the file separately
+        duration = None
         if 'duration' in request.form:
             try:
                 duration = float(request.form['duration'])
                 if duration <= 0:
                     print("Provided duration is zero or negative, calculating duration")
-                    duration = get_audio_duration(final_audio_path)
+                    duration = None
                 else:
                     print(f"Using provided duration: {duration} seconds")
             except ValueError:
                 print("Invalid duration provided, calculating duration")
-                duration = get_audio_duration(final_audio_path)
-        else:
-            duration = get_audio_duration(final_audio_path)
-        print(f"Final duration: {duration} seconds")
         
-        # Check for diarization configuration parameters
-        diarization_config_updates = {}
-        for key in DIARIZATION_CONFIG.keys():
-            if key in request.form:
-                try:
-                    # Handle different parameter types
-                    if key in ["use_pca"]:
-                        value = request.form[key].lower() in ["true", "1", "yes"]
-                    elif key in ["whisper_model_size", "clustering_method"]:
-                        value = request.form[key]
-                    else:
-                        value = float(request.form[key])
-                    diarization_config_updates[key] = value
-                except ValueError:
-                    print(f"Invalid value for {key}: {request.form[key]}")
-        
-        # Apply any configuration updates
+        # Diarization parameters in the form apply to this upload only
+        diarization_config_updates = {key: request.form[key] for key in DIARIZATION_CONFIG if key in request.form}
         if diarization_config_updates:
-            adjust_diarization_config(diarization_config_updates)
+            print(f"Diarization config overrides: {diarization_config_updates}")
+        diarization_config = make_diarization_config(diarization_config_updates)
         
-        # Encrypt the audio file after duration calculation
-        try:
-            encrypt_file_in_place(final_audio_path, user_id)
-            print(f"File encrypted successfully: {final_audio_path}")
-        except Exception as e:
-            print(f"Warning: File encryption failed: {str(e)}")
-
-        temp_decrypted_path = os.path.join('temp', f"decrypted_{timestamp}{os.path.splitext(final_audio_path)[1]}")
+        def encrypt_stored_copy():
+            """Encrypt the stored copy, returning an error message if that failed"""
+            encrypt_started = time.perf_counter()
+            try:
+                encrypt_file_in_place(final_audio_path, user_id, audio_key)
+                print(f"File encrypted successfully: {final_audio_path}")
+                return None
+            except Exception as e:
+                # Never leave a plaintext recording where it would be served
+                # as a stored one; the upload fails instead
+                print(f"File encryption failed, removing the recording: {str(e)}")
+                if os.path.exists(final_audio_path):
+                    os.remove(final_audio_path)
+                return f"Could not store the recording securely: {str(e)}"
+            finally:
+                timings["encrypt"] = time.perf_counter() - encrypt_started
+        
+        encryption = None
         try:
-            decrypt_file(final_audio_path, temp_decrypted_path, user_id)
+            # Decode the plaintext upload once, then encrypt the stored copy in
+            # the background while the decoded buffer is transcribed, instead
+            # of encrypting it and decrypting it straight back to a temp file
+            stage_started = time.perf_counter()
+            audio = load_audio(final_audio_path)
+            timings["decode"] = time.perf_counter() - stage_started
+            encryption = _get_encrypt_executor().submit(encrypt_stored_copy)
+            
+            if duration is None:
+                duration = get_audio_duration_seconds(audio)
+            print(f"Final duration: {duration} seconds")
             
             # Process audio with diarization
+            stage_started = time.perf_counter()
             try:
                 print("Starting diarization processing...")
                 # Get number of speakers if provided
@@ -590,12 +963,20 @@ def upload_audio():
                 if 'num_speakers' in request.form and request.form['num_speakers'].isdigit():
                     num_speakers = int(request.form['num_speakers'])
                         
-                diarization_result = process_audio_file_with_diarization(temp_decrypted_path, num_speakers)
+                diarization_result = process_audio_file_with_diarization(
+                    final_audio_path, num_speakers, audio=audio, config=diarization_config
+                )
                 print(f"Diarization completed with {len(diarization_result.get('segments', []))} segments")
+                timings["diarization"] = time.perf_counter() - stage_started
                 
                 # Extract transcription from diarization result
                 text = diarization_result.get("full_transcript", "")
                 
+                # The stored file is only recorded once it is encrypted
+                encryption_error = encryption.result()
+                if encryption_error:
+                    return jsonify({"success": False, "error": encryption_error}), 500
+                
                 # Save transcription
                 if "error" in diarization_result:
                     print(f"Diarization failed: {diarization_result['error']}")
@@ -614,15 +995,18 @@ def upload_audio():
                 print(f"Error during audio processing: {str(e)}")
                 # Fallback to basic transcription if diarization fails
                 try:
-                    result = transcribe_audio_with_timestamps(temp_decrypted_path)
+                    result = transcribe_audio_with_timestamps(audio, config=diarization_config)
                     text = result["text"]
+                    encryption_error = encryption.result()
+                    if encryption_error:
+                        return jsonify({"success": False, "error": encryption_error}), 500
                     transcription_entry = save_transcription(user_id, text, final_audio_path, duration)
                 except Exception as e2:
                     print(f"Fallback transcription failed: {str(e2)}")
                     return jsonify({"success": False, "error": f"Audio processing failed: {str(e)}"}), 500
-
-            if os.path.exists(temp_decrypted_path):
-                os.remove(temp_decrypted_path)
+            
+            timings["total"] = time.perf_counter() - started
+            print("Upload timings: " + ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in timings.items()))
 
             return jsonify({
                 "success": True,
@@ -632,9 +1016,14 @@ def upload_audio():
 
         except Exception as e:
             print(f"Transcription error: {str(e)}")
-            if os.path.exists(temp_decrypted_path):
-                os.remove(temp_decrypted_path)
             return jsonify({"success": False, "error": f"Transcription failed: {str(e)}"}), 500
+        finally:
+            # Never leave the stored copy in plaintext, even if decoding failed.
+            # A failed encryption has already removed it
+            if encryption is None:
+                encrypt_stored_copy()
+            else:
+                encryption.result()
 
     except Exception as e:
         import traceback
@@ -677,6 +1066,107 @@ def cleanup_old_playback_files(user_id, max_age=3600):
     except Exception as e:
         print(f"Error cleaning up playback files: {str(e)}")
 
+def get_audio_mime_type(filename):
+    """Guess the MIME type of a stored recording from its extension"""
+    if filename.endswith('.mp3'):
+        return 'audio/mpeg'
+    elif filename.endswith('.wav'):
+        return 'audio/wav'
+    elif filename.endswith('.ogg'):
+        return 'audio/ogg'
+    elif filename.endswith('.webm'):
+        return 'audio/webm'
+    return 'audio/mpeg'  # Default fallback
+
+def send_encrypted_audio(encrypted_path, user_id, mime_type, audio_key):
+    """Stream a chunked encrypted file, decrypting only the requested range.
+
+    Honours single-range Range requests (with If-Range) and If-None-Match,
+    so seeking in the browser only decrypts the chunks it asks for and
+    nothing is written to disk. Multi-range requests get the whole file,
+    which RFC 9110 allows a server to send instead.
+    """
+    import audio_crypto
+    
+    stat = os.stat(encrypted_path)
+    size = audio_crypto.get_plaintext_size(encrypted_path)
+    etag = f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+    
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": f'"{etag}"',
+        "Cache-Control": "private, max-age=0",
+    }
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    
+    start, end, status = 0, size, 200
+    # A date in If-Range is a weak validator, so only an ETag match keeps the range
+    single_range = (request.range is not None and request.range.units == "bytes"
+                    and len(request.range.ranges) == 1)
+    if single_range and request.if_range.etag in (None, etag) and request.if_range.date is None:
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status=416, headers=headers)
+        start, end = byte_range
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+    headers["Content-Length"] = str(end - start)
+    
+    return Response(
+        audio_crypto.iter_decrypted(encrypted_path, user_id, audio_key, start, end),
+        status=status,
+        mimetype=mime_type,
+        headers=headers,
+        direct_passthrough=True
+    )
+
+def send_legacy_encrypted_audio(encrypted_path, user_id, filename, mime_type):
+    """Serve a file from the old whole-file encryption through a temp copy"""
+    from utils import decrypt_file
+    
+    playback_id = str(uuid.uuid4())
+    user_playback_dir = get_user_playback_dir(user_id)
+    cleanup_old_playback_files(user_id)
+    
+    temp_decrypted_path = os.path.join(user_playback_dir, f"{playback_id}_{filename}")
+    
+    try:
+        decrypt_file(encrypted_path, temp_decrypted_path, user_id)
+        print(f"File decrypted successfully to: {temp_decrypted_path}")
+        response = send_file(
+            temp_decrypted_path,
+            mimetype=mime_type,
+            as_attachment=False,
+            conditional=True
+        )
+    except Exception:
+        if os.path.exists(temp_decrypted_path):
+            os.remove(temp_decrypted_path)
+        raise
+    
+    # Add cleanup function to remove the temporary file after streaming
+    @response.call_on_close
+    def remove_temp_file():
+        try:
+            if os.path.exists(temp_decrypted_path):
+                os.remove(temp_decrypted_path)
+                print(f"Removed temporary decrypted file: {temp_decrypted_path}")
+        except Exception as e:
+            print(f"Error removing temporary file: {str(e)}")
+    
+    return response
+
+def send_user_audio(encrypted_path, user_id, filename, audio_key):
+    """Serve a stored recording, streaming it when it uses chunked encryption"""
+    import audio_crypto
+    
+    mime_type = get_audio_mime_type(filename)
+    if audio_crypto.is_chunked_file(encrypted_path):
+        return send_encrypted_audio(encrypted_path, user_id, mime_type, audio_key)
+    return send_legacy_encrypted_audio(encrypted_path, user_id, filename, mime_type)
+
 @upload_bp.route('/play_audio/<filename>', methods=['GET'])
 @login_required
 def play_audio_file(filename):
@@ -685,7 +1175,7 @@ def play_audio_file(filename):
         if not current_user_id:
             return jsonify({"success": False, "error": "User not authenticated"}), 401
         
-        from utils import get_user_dirs, decrypt_file
+        from utils import get_user_dirs
         
         user_dirs = get_user_dirs(current_user_id)
         encrypted_path = os.path.join(user_dirs['audio'], filename)
@@ -693,53 +1183,16 @@ def play_audio_file(filename):
         if not os.path.exists(encrypted_path):
             return jsonify({"success": False, "error": "Audio file not found"}), 404
         
-        playback_id = str(uuid.uuid4())
-        user_playback_dir = get_user_playback_dir(current_user_id)
-        cleanup_old_playback_files(current_user_id)
-        
-        temp_decrypted_filename = f"{playback_id}_{filename}"
-        temp_decrypted_path = os.path.join(user_playback_dir, temp_decrypted_filename)
+        try:
+            audio_key = _get_audio_key()
+        except RuntimeError as e:
+            return jsonify({"success": False, "error": str(e)}), 503
         
         try:
-            decrypt_file(encrypted_path, temp_decrypted_path, current_user_id)
-            print(f"File decrypted successfully to: {temp_decrypted_path}")
+            return send_user_audio(encrypted_path, current_user_id, filename, audio_key)
         except Exception as e:
             print(f"Error decrypting audio file: {str(e)}")
             return jsonify({"success": False, "error": "Failed to decrypt audio file"}), 500
-        
-        # Determine MIME type based on file extension
-        if filename.endswith('.mp3'):
-            mime_type = 'audio/mpeg'
-        elif filename.endswith('.wav'):
-            mime_type = 'audio/wav'
-        elif filename.endswith('.ogg'):
-            mime_type = 'audio/ogg'
-        elif filename.endswith('.webm'):
-            mime_type = 'audio/webm'
-        else:
-            mime_type = 'audio/mpeg'  # Default fallback
-            
-        abs_temp_path = os.path.abspath(temp_decrypted_path)
-        print(f"Playing audio from complete file path: {abs_temp_path}")
-        
-        response = send_file(
-            temp_decrypted_path,
-            mimetype=mime_type,
-            as_attachment=False,
-            conditional=True
-        )
-        
-        # Add cleanup function to remove the temporary file after streaming
-        @response.call_on_close
-        def remove_temp_file():
-            try:
-                if os.path.exists(temp_decrypted_path):
-                    os.remove(temp_decrypted_path)
-                    print(f"Removed temporary decrypted file: {temp_decrypted_path}")
-            except Exception as e:
-                print(f"Error removing temporary file: {str(e)}")
-        
-        return response
             
     except Exception as e:
         import traceback
@@ -755,7 +1208,7 @@ def serve_user_audio_file(user_id, filename):
         if str(current_user_id) != str(user_id):
             return jsonify({"success": False, "error": "Access denied"}), 403
         
-        from utils import get_user_dirs, decrypt_file
+        from utils import get_user_dirs
         
         user_dirs = get_user_dirs(current_user_id)
         encrypted_path = os.path.join(user_dirs['audio'], filename)
@@ -763,49 +1216,17 @@ def serve_user_audio_file(user_id, filename):
         if not os.path.exists(encrypted_path):
             return jsonify({"success": False, "error": "File not found"}), 404
         
-        user_playback_dir = get_user_playback_dir(current_user_id)
-        playback_id = str(uuid.uuid4())
-        temp_decrypted_filename = f"{playback_id}_{filename}"
-        temp_decrypted_path = os.path.join(user_playback_dir, temp_decrypted_filename)
+        try:
+            audio_key = _get_audio_key()
+        except RuntimeError as e:
+            return jsonify({"success": False, "error": str(e)}), 503
         
         try:
-            decrypt_file(encrypted_path, temp_decrypted_path, current_user_id)
-            
-            # Determine the correct MIME type based on file extension
-            if filename.endswith('.mp3'):
-                mime_type = 'audio/mpeg'
-            elif filename.endswith('.wav'):
-                mime_type = 'audio/wav'
-            elif filename.endswith('.ogg'):
-                mime_type = 'audio/ogg'
-            elif filename.endswith('.webm'):
-                mime_type = 'audio/webm'
-            else:
-                mime_type = 'audio/mpeg'  # Default fallback
-            
-            response = send_file(
-                temp_decrypted_path,
-                mimetype=mime_type,
-                as_attachment=False,
-                conditional=True
-            )
-            
-            @response.call_on_close
-            def remove_temp_file():
-                try:
-                    if os.path.exists(temp_decrypted_path):
-                        os.remove(temp_decrypted_path)
-                except Exception as e:
-                    print(f"Error removing temp file: {str(e)}")
-            
-            return response
-            
+            return send_user_audio(encrypted_path, current_user_id, filename, audio_key)
         except Exception as e:
             print(f"Error decrypting/serving audio file: {str(e)}")
-            if os.path.exists(temp_decrypted_path):
-                os.remove(temp_decrypted_path)
             return jsonify({"success": False, "error": "Failed to process audio file"}), 500
             
     except Exception as e:
         print(f"Error serving audio file {filename}: {str(e)}")
-        return jsonify({"success": False, "error": str(e)}), 500
\ No newline at end of file
+        return jsonify({"success": False, "error": str(e)}), 500
\ No newline at end of file